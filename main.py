@@ -1,4 +1,6 @@
 
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI 
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -8,6 +10,10 @@ import os
 load_dotenv()
 
 from routers import polls, emails
+from polls.storage import ensure_indexes
+from polls import compute, startup, scheduler
+from messages.transport import close_transport
+from messages.outbox import ensure_outbox_indexes
 
 origins = [
     "http://localhost:3000",
@@ -16,7 +22,24 @@ origins = [
     "https://dev.stablevoting.org"
 ]
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    await ensure_outbox_indexes()
+    if startup.WARM_UP:
+        # keep a reference so the task is not garbage collected
+        app.state.warm_up = asyncio.create_task(startup.warm_up())
+    if scheduler.FINALIZE_POLLS:
+        app.state.scheduler = asyncio.create_task(scheduler.run_scheduler())
+    yield
+    if scheduler.FINALIZE_POLLS:
+        app.state.scheduler.cancel()
+    compute.shutdown()
+    await close_transport()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,3 +20,19 @@ def participate_email(poll_title, poll_description, url):
 
 </body></html>'''
 
+
+
+def vote_link(poll_id, voter_id):
+    return f"https://stablevoting.org/vote/{poll_id}?vid={voter_id}"
+
+
+def invitation_emails(poll_id, poll_title, poll_description, voters):
+    '''the invitation to each (email, voter id) in voters, with the voter's own link'''
+    return [
+        {
+            "to_email": email,
+            "subject": f"Participate in the poll: {poll_title}",
+            "html_body": participate_email(poll_title, poll_description, vote_link(poll_id, voter_id)),
+        }
+        for email, voter_id in voters
+    ]
@@ -1,19 +1,19 @@
 
 from bson import ObjectId
-from messages.conf import send_email, send_batch_emails, SKIP_EMAILS
+from messages.outbox import enqueue_batch
 from messages.helpers import participate_email
 
 
 async def is_poll_owner(id, oid):
     """Return True if oid is the owner id of the poll with the given id."""
-    from polls.manage import db
+    from polls.storage import get_poll
     if oid is None or not ObjectId.is_valid(id):
         return False
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, ["owner_id"])
     return document is not None and document.get("owner_id") == oid
 
 
-async def send_contact_form_email(message, background_tasks, vid=None, oid=None):
+async def send_contact_form_email(message, vid=None, oid=None):
     """Send contact form email to administrators"""
     
     subject = "Contact form message"
@@ -33,19 +33,17 @@ async def send_contact_form_email(message, background_tasks, vid=None, oid=None)
     
     # Send to all admin emails
     admin_emails = ['stablevoting.org@gmail.com', 'epacuit@umd.edu', 'wesholliday@berkeley.edu']
-    for admin_email in admin_emails:
-        background_tasks.add_task(
-            send_email,
-            to_email=admin_email,
-            subject=subject,
-            html_body=html_body,
-            tag="contact-form"
-        )
+    await enqueue_batch(
+        recipients=admin_emails,
+        subject=subject,
+        html_body=html_body,
+        tag="contact-form"
+    )
     
     return {"success": f"Message sent to administrators."}
 
 
-async def send_emails_to_voters(emails_data, id, background_tasks, oid=None):
+async def send_emails_to_voters(emails_data, id, oid=None):
     """Send invitation emails to voters"""
 
     if not await is_poll_owner(id, oid):
@@ -60,9 +58,8 @@ async def send_emails_to_voters(emails_data, id, background_tasks, oid=None):
     
     subject = f"Participate in the poll: {emails_data.title}"
     
-    # Send emails in batch
-    background_tasks.add_task(
-        send_batch_emails,
+    # Queue the emails (sent in batches by the email worker)
+    await enqueue_batch(
         recipients=emails_data.emails,
         subject=subject,
         html_body=html_body,
@@ -72,7 +69,7 @@ async def send_emails_to_voters(emails_data, id, background_tasks, oid=None):
     return {"success": f"Emails queued for {len(emails_data.emails)} voters."}
 
 
-async def send_email_to_owner(emails_data, id, background_tasks, oid=None):
+async def send_email_to_owner(emails_data, id, oid=None):
     """Send poll creation confirmation to owner"""
 
     if not await is_poll_owner(id, oid):
@@ -109,13 +106,11 @@ async def send_email_to_owner(emails_data, id, background_tasks, oid=None):
     subject = f"Created poll: {emails_data.title}"
     
     # Send to all specified emails (usually just the owner)
-    for email in emails_data.emails:
-        background_tasks.add_task(
-            send_email,
-            to_email=email,
-            subject=subject,
-            html_body=html_body,
-            tag=f"poll-created-{id}"
-        )
+    await enqueue_batch(
+        recipients=emails_data.emails,
+        subject=subject,
+        html_body=html_body,
+        tag=f"poll-created-{id}"
+    )
     
     return {"success": "Owner notification sent."}
\ No newline at end of file
@@ -0,0 +1,132 @@
+# messages/outbox.py
+#
+# Outbox of the email sent by the app.
+#
+# The web process does not send email: it adds the messages to the Outbox
+# collection (one document per message) and returns. The messages are sent by the
+# email worker (messages/worker.py), a separate process, so they survive a restart
+# of the web process and sending them never competes with the requests.
+#
+# A message document goes from "pending" to "sending" when a worker claims it and
+# then to "sent" or "failed". A claim expires after CLAIM_SECONDS, so the messages
+# of a worker that died while sending them are claimed again. A message whose
+# sending failed is retried after a backoff, up to MAX_ATTEMPTS times.
+#
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from pymongo import ASCENDING
+
+from messages import conf
+from polls.storage import client, data_base
+
+logger = logging.getLogger(__name__)
+
+outbox_db = client[data_base].Outbox
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 6))
+# the backoff after the n-th failed attempt is BACKOFF_SECONDS * 2**(n-1), at most MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = float(os.getenv('EMAIL_BACKOFF_SECONDS', 30))
+MAX_BACKOFF_SECONDS = float(os.getenv('EMAIL_MAX_BACKOFF_SECONDS', 3600))
+CLAIM_SECONDS = float(os.getenv('EMAIL_CLAIM_SECONDS', 300))
+# sent and failed messages are kept this long
+KEEP_DAYS = int(os.getenv('EMAIL_KEEP_DAYS', 7))
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+async def ensure_outbox_indexes():
+    """Create the indexes on the Outbox collection (run at startup)."""
+    await outbox_db.create_index([("status", ASCENDING), ("next_attempt", ASCENDING)])
+    await outbox_db.create_index([("claim", ASCENDING)])
+    await outbox_db.create_index("done_at", expireAfterSeconds=KEEP_DAYS * 24 * 3600)
+
+
+async def enqueue_emails(emails: List[dict], tag: Optional[str] = None):
+    """Add emails to the outbox. Each email is a dict with to_email, subject,
+    html_body and (optionally) text_body. Returns the number of emails added."""
+    if len(emails) == 0:
+        return 0
+    if conf.SKIP_EMAILS:
+        logger.info(f"[EMAIL SKIPPED] {len(emails)} emails, Tag: {tag}")
+        print(f"[EMAIL SKIPPED] {len(emails)} emails, Tag: {tag}")
+        return 0
+    now = _now()
+    await outbox_db.insert_many([
+        {
+            "message": conf.make_message(
+                e["to_email"], e["subject"], e["html_body"], e.get("text_body"), tag),
+            "status": PENDING,
+            "attempts": 0,
+            "created_at": now,
+            "next_attempt": now,
+        }
+        for e in emails
+    ], ordered=False)
+    return len(emails)
+
+
+async def enqueue_batch(recipients: List[str], subject: str, html_body: str,
+                        text_body: Optional[str] = None, tag: Optional[str] = None):
+    """Add the same email to each recipient to the outbox."""
+    return await enqueue_emails(
+        [{"to_email": r, "subject": subject, "html_body": html_body, "text_body": text_body}
+         for r in recipients], tag)
+
+
+async def claim(limit: int):
+    """Claim up to limit messages that are due (pending, or claimed by a worker
+    whose claim expired) and return them."""
+    now = _now()
+    due = {"$or": [
+        {"status": PENDING, "next_attempt": {"$lte": now}},
+        {"status": SENDING, "claimed_until": {"$lte": now}},
+    ]}
+    ids = [d["_id"] async for d in outbox_db.find(due, {"_id": 1}).sort("next_attempt", ASCENDING).limit(limit)]
+    if len(ids) == 0:
+        return []
+    # the ids are claimed only if no other worker claimed them in the meantime
+    token = uuid.uuid4().hex
+    await outbox_db.update_many(
+        {"_id": {"$in": ids}, **due},
+        {"$set": {"status": SENDING, "claim": token,
+                  "claimed_until": now + timedelta(seconds=CLAIM_SECONDS)}})
+    return [d async for d in outbox_db.find({"claim": token, "status": SENDING})]
+
+
+def backoff(attempts: int) -> float:
+    """Seconds to wait before retrying a message after its attempts-th failure"""
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+async def mark_sent(docs: List[dict]):
+    if len(docs) > 0:
+        await outbox_db.update_many(
+            {"_id": {"$in": [d["_id"] for d in docs]}},
+            {"$set": {"status": SENT, "done_at": _now()}, "$inc": {"attempts": 1},
+             "$unset": {"claim": "", "claimed_until": ""}})
+
+
+async def mark_failed(doc: dict, error: str, retry: bool = True):
+    """Record a failed attempt: the message is retried after a backoff unless retry
+    is False or it reached MAX_ATTEMPTS."""
+    attempts = doc.get("attempts", 0) + 1
+    update = {"attempts": attempts, "error": error}
+    if retry and attempts < MAX_ATTEMPTS:
+        update.update(status=PENDING, next_attempt=_now() + timedelta(seconds=backoff(attempts)))
+    else:
+        update.update(status=FAILED, done_at=_now())
+        logger.error(f"Giving up on the email to {doc['message']['To']}: {error}")
+    await outbox_db.update_one(
+        {"_id": doc["_id"]},
+        {"$set": update, "$unset": {"claim": "", "claimed_until": ""}})
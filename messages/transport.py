@@ -0,0 +1,130 @@
+# messages/transport.py
+#
+# Async transport for outgoing email.
+#
+# All the email sent by the app goes through one shared transport: an async HTTP
+# client for the Postmark API whose connections are kept alive and reused, with a
+# bound on the number of requests in flight, so sending never blocks the event loop
+# and a mass invitation does not open a connection per message.
+#
+# The transport is pluggable: set_transport replaces it (e.g., by one talking to a
+# local stand-in server in tests), and POSTMARK_API_URL points the default one to
+# another server.
+#
+import os
+import asyncio
+import logging
+from typing import List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+POSTMARK_API_URL = os.getenv('POSTMARK_API_URL', 'https://api.postmarkapp.com')
+POSTMARK_SERVER_TOKEN = os.getenv('POSTMARK_SERVER_TOKEN', 'POSTMARK_API_TEST')
+
+# requests in flight at once, and the connections kept alive between requests
+EMAIL_CONCURRENCY = int(os.getenv('EMAIL_CONCURRENCY', 8))
+EMAIL_TIMEOUT = float(os.getenv('EMAIL_TIMEOUT', 30))
+
+# Postmark allows up to 500 messages per batch request
+MAX_BATCH_SIZE = 500
+
+
+class EmailSendError(Exception):
+    """Postmark rejected a request (or a message)."""
+
+
+class PostmarkTransport:
+    """Sends messages (dicts in the Postmark API format) over a shared pool of
+    keep-alive connections. http_transport is passed to httpx, e.g., an
+    httpx.MockTransport standing in for the server."""
+
+    def __init__(
+        self,
+        server_token: str = POSTMARK_SERVER_TOKEN,
+        base_url: str = POSTMARK_API_URL,
+        concurrency: int = EMAIL_CONCURRENCY,
+        timeout: float = EMAIL_TIMEOUT,
+        http_transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.server_token = server_token
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.http_transport = http_transport
+        self._client = None
+        self._slots = asyncio.Semaphore(concurrency)
+
+    def _http(self):
+        # created on first use, inside the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Accept": "application/json",
+                    "X-Postmark-Server-Token": self.server_token,
+                },
+                limits=httpx.Limits(
+                    max_connections=self.concurrency,
+                    max_keepalive_connections=self.concurrency),
+                timeout=self.timeout,
+                transport=self.http_transport,
+            )
+        return self._client
+
+    async def _post(self, path: str, payload):
+        async with self._slots:
+            response = await self._http().post(path, json=payload)
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code != 200:
+            message = data.get("Message", response.text) if isinstance(data, dict) else response.text
+            raise EmailSendError(f"Postmark returned {response.status_code}: {message}")
+        return data
+
+    async def send(self, message: dict):
+        """Send one message and return Postmark's response."""
+        data = await self._post("/email", message)
+        if data.get("ErrorCode", 0) != 0:
+            raise EmailSendError(data.get("Message", "Unknown error"))
+        return data
+
+    async def send_batch(self, messages: List[dict]):
+        """Send up to MAX_BATCH_SIZE messages in one request and return Postmark's
+        per-message responses (failed messages have a non-zero ErrorCode)."""
+        if len(messages) > MAX_BATCH_SIZE:
+            raise ValueError(f"At most {MAX_BATCH_SIZE} messages can be sent in a batch.")
+        return await self._post("/email/batch", messages)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_transport = None
+
+
+def get_transport() -> PostmarkTransport:
+    """The shared transport (created on first use)."""
+    global _transport
+    if _transport is None:
+        _transport = PostmarkTransport()
+    return _transport
+
+
+def set_transport(transport: Optional[PostmarkTransport]):
+    """Replace the shared transport (None restores the default on next use).
+    Returns the previous one."""
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
+
+
+async def close_transport():
+    """Close the shared transport's connections (at app shutdown)."""
+    if _transport is not None:
+        await _transport.aclose()
@@ -0,0 +1,100 @@
+# messages/worker.py
+#
+# Email worker: sends the messages in the outbox (see messages/outbox.py).
+#
+#     python -m messages.worker
+#
+# It claims the due messages in batches of up to EMAIL_BATCH_SIZE, sends each
+# batch in one Postmark request and records the outcome of every message. At most
+# EMAIL_RATE messages are sent per second. If a batch request fails (e.g., Postmark
+# is unavailable or rate limits us) all its messages are retried with a backoff; a
+# message that Postmark rejects (e.g., an invalid or inactive address) is not.
+# Several workers can run at once, as each claims its own messages.
+#
+import os
+import time
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from messages import outbox
+from messages.transport import get_transport, close_transport, MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+EMAIL_BATCH_SIZE = min(int(os.getenv('EMAIL_BATCH_SIZE', MAX_BATCH_SIZE)), MAX_BATCH_SIZE)
+EMAIL_RATE = float(os.getenv('EMAIL_RATE', 50))
+# how long to wait before looking again when the outbox is empty (in seconds)
+EMAIL_POLL_SECONDS = float(os.getenv('EMAIL_POLL_SECONDS', 5))
+
+
+class RateLimiter:
+    """Spaces out the sends so that on average at most rate messages are sent per
+    second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = time.monotonic()
+
+    async def wait(self, num_messages):
+        now = time.monotonic()
+        if self.next_time > now:
+            await asyncio.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + num_messages / self.rate
+
+
+async def send_claimed(docs):
+    """Send the claimed messages in one batch and record the outcome of each."""
+    try:
+        responses = await get_transport().send_batch([d["message"] for d in docs])
+    except Exception as e:
+        print(f"Failed to send a batch of {len(docs)} emails: {e}")
+        for d in docs:
+            await outbox.mark_failed(d, str(e))
+        return 0
+
+    # Postmark answers with one response per message, in order
+    sent = [d for d, r in zip(docs, responses) if r.get("ErrorCode", 0) == 0]
+    await outbox.mark_sent(sent)
+    for d, r in zip(docs, responses):
+        if r.get("ErrorCode", 0) != 0:
+            await outbox.mark_failed(d, f'{r.get("ErrorCode")}: {r.get("Message")}', retry=False)
+    return len(sent)
+
+
+async def drain_once(limiter=None, batch_size=EMAIL_BATCH_SIZE):
+    """Claim and send one batch of due messages. Returns the number of messages
+    claimed (0 when none are due)."""
+    docs = await outbox.claim(batch_size)
+    if len(docs) == 0:
+        return 0
+    if limiter is not None:
+        await limiter.wait(len(docs))
+    num_sent = await send_claimed(docs)
+    print(f"Sent {num_sent} of {len(docs)} emails")
+    return len(docs)
+
+
+async def run_worker():
+    await outbox.ensure_outbox_indexes()
+    limiter = RateLimiter(EMAIL_RATE)
+    print(f"Email worker started (batches of {EMAIL_BATCH_SIZE}, {EMAIL_RATE} emails per second)")
+    try:
+        while True:
+            try:
+                if await drain_once(limiter) == 0:
+                    await asyncio.sleep(EMAIL_POLL_SECONDS)
+            except Exception as e:
+                # e.g., the database is unreachable: keep the worker alive and retry
+                logger.exception(e)
+                print(f"Email worker error: {e}")
+                await asyncio.sleep(EMAIL_POLL_SECONDS)
+    finally:
+        await close_transport()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
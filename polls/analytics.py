@@ -0,0 +1,349 @@
+#
+# Superuser analytics
+#
+# The dashboard's analytics are built from one record per poll, computed from the
+# poll's tally (so from its distinct rankings, not its ballots) and saved in the
+# poll's "analytics" field, {"version": ..., "record": ...}, keyed by the poll's
+# ballot_version like the cached outcome (see polls/cache.py). A refresh of the
+# dashboard only computes the records of the polls whose ballots changed since
+# their record was computed, and then sums up the records of all the polls, so its
+# cost no longer grows with the total number of ballots.
+#
+# The polls are summed up as partial stats (counters, histograms and lists) that
+# can be merged, so a refresh can analyze several polls at once, each task adding
+# its polls to its own partial stats (see _parallel_stats).
+#
+
+import asyncio
+import os
+from collections import Counter
+
+from polls import compute
+from polls.outcome import SU_METHOD_NAMES, method_winners
+from polls.storage import db, ensure_tally
+from polls.tally import tally_profile
+from polls.voting import ranking_from_key, margin_matrix, majority_relations
+
+MNAMES = SU_METHOD_NAMES
+
+CAND_B = [(2, 2, "2"), (3, 3, "3"), (4, 4, "4"), (5, 5, "5"), (6, 7, "6-7"),
+          (8, 10, "8-10"), (11, 15, "11-15"), (16, 10**9, "16+")]
+VOTER_B = [(1, 4, "1-4"), (5, 9, "5-9"), (10, 24, "10-24"), (25, 49, "25-49"),
+           (50, 99, "50-99"), (100, 10**9, "100+")]
+
+# the computations run in a pool of their own, so a refresh of the dashboard never
+# holds up (or, with a method that times out, stops) those of the results pages; by
+# default it gets the cores the results pages' pool leaves over
+ANALYTICS_WORKERS = int(os.getenv('ANALYTICS_WORKERS', max(1, (os.cpu_count() or 1) - compute.COMPUTE_WORKERS)))
+analytics_pool = compute.ComputePool(ANALYTICS_WORKERS)
+# the number of polls analyzed at once by a dashboard refresh (1 analyzes them one
+# at a time)
+ANALYTICS_IN_FLIGHT = int(os.getenv('ANALYTICS_IN_FLIGHT', 2 * ANALYTICS_WORKERS))
+
+# the fields of a poll needed to compute and sum up its record
+ANALYTICS_FIELDS = {"candidates": 1, "tally": 1, "ballot_storage": 1, "ballot_version": 1,
+                    "analytics": 1, "is_completed": 1, "is_private": 1}
+# the fields of a poll needed to sum up its record, and to tell if it is current
+SUMMARY_FIELDS = {"analytics": 1, "ballot_version": 1, "is_completed": 1, "is_private": 1}
+
+
+def _ballot_type(rmap, ncand):
+    ranked = list(rmap.keys())
+    if len(ranked) == 0:
+        return None
+    ranks = list(rmap.values())
+    has_ties = len(set(ranks)) != len(ranks)
+    truncated = len(ranked) < ncand
+    return {"linear": (not has_ties) and (not truncated), "truncated": truncated,
+            "ties": has_ties, "bullet": len(ranked) == 1}
+
+
+def _plurality_ws(prof):
+    """Approval-at-top plurality winners: each voter gives one point to every
+    candidate at their top (first) rank; a voter tied k-at-top counts for all k.
+    Returns the set of top-scoring candidates (as strings), or None."""
+    scores = {c: 0 for c in prof.candidates}
+    for r, cnt in zip(*prof.rankings_counts):
+        if len(r.rmap) == 0:
+            continue
+        top = min(r.rmap.values())
+        for c, rk in r.rmap.items():
+            if rk == top and c in scores:
+                scores[c] += cnt
+    if not scores or max(scores.values()) == 0:
+        return None
+    mx = max(scores.values())
+    return frozenset(str(c) for c in scores if scores[c] == mx)
+
+
+def ballot_type_mix(tally, ncand):
+    """The fraction of the (non-empty) ballots of each type, or None."""
+    types = [(_ballot_type(ranking_from_key(key), ncand), n) for key, n in tally["types"].items() if n > 0]
+    types = [(t, n) for t, n in types if t]
+    if not types:
+        return None
+    num_typed = sum(n for _, n in types)
+    return {k: sum(n for t, n in types if t[k]) / num_typed
+            for k in ("linear", "truncated", "ties", "bullet")}
+
+
+def profile_analytics(prof):
+    """The Condorcet status and the plurality winners of a profile (run in the
+    analytics pool)."""
+    relations = majority_relations(margin_matrix(prof)[1])
+    try:
+        pl = _plurality_ws(prof)
+    except Exception:
+        pl = None
+    return {
+        "cw": relations["condorcet_winner"] is not None,
+        "weak_cw": len(relations["weak_condorcet_winners"]) > 0,
+        "cl": relations["condorcet_loser"] is not None,
+        "weak_cl": len(relations["weak_condorcet_losers"]) > 0,
+        "cycle": relations["cycle"],
+        "plurality": sorted(pl) if pl is not None else None,
+    }
+
+
+async def _winset(name, prof, timeout=2):
+    try:
+        return sorted(await analytics_pool.run(method_winners, name, prof, timeout=timeout))
+    except Exception:
+        return None
+
+
+async def poll_record(document):
+    """The analytics record of a poll: its size, ballot-type mix, Condorcet status,
+    Stable Voting and plurality winners and, for polls with at least 5 ballots and 3
+    candidates, the winners of every dashboard method (None if one timed out)."""
+    tally = await ensure_tally(document)
+    ncand, nb = len(document.get("candidates", []) or []), tally["num_ballots"]
+    record = {"ncand": ncand, "nb": nb}
+    if nb == 0 or ncand < 2:
+        return record
+    prof = tally_profile(tally)
+    if not any(len(r.rmap) > 0 for r in prof.rankings_counts[0]):
+        return record
+    record["bt"] = ballot_type_mix(tally, ncand)
+    try:
+        record.update(await analytics_pool.run(profile_analytics, prof))
+    except Exception:
+        pass
+    # Stable Voting with the site's own routine, so it matches the results page,
+    # with a generous timeout (this runs in the background)
+    sv = await _winset("Stable Voting", prof, timeout=20)
+    record["sv"] = sv
+    if nb >= 5 and ncand >= 3:
+        record["methods"] = {name: await _winset(name, prof) if name != "Stable Voting" else sv
+                             for name in MNAMES}
+    return record
+
+
+def _is_current(document):
+    return document.get("analytics", {}).get("version") == document.get("ballot_version", 0)
+
+
+async def update_poll_record(document):
+    """Compute the poll's record and save it, unless a ballot was written in the
+    meantime. Returns the record."""
+    version = document.get("ballot_version", 0)
+    record = await poll_record(document)
+    await db.update_one(
+        {"_id": document["_id"], "$expr": {"$eq": [{"$ifNull": ["$ballot_version", 0]}, version]}},
+        {"$set": {"analytics": {"version": version, "record": record}}})
+    return record
+
+
+async def refresh_poll_analytics(full=False):
+    """Compute the records of the polls whose ballots changed since their record
+    was computed (or that have none), or of all the polls if full. Returns the
+    number of records computed."""
+    stale = {} if full else {"$expr": {"$ne": [{"$ifNull": ["$analytics.version", -1]},
+                                               {"$ifNull": ["$ballot_version", 0]}]}}
+    num = 0
+    async for doc in db.find(stale, ANALYTICS_FIELDS):
+        await update_poll_record(doc)
+        num += 1
+    return num
+
+
+def _summary(xs):
+    if not xs:
+        return {"mean": 0, "median": 0, "std": 0, "max": 0}
+    s = sorted(xs)
+    n = len(s)
+    med = s[n // 2] if n % 2 else (s[n // 2 - 1] + s[n // 2]) / 2
+    mean = sum(s) / n
+    std = (sum((x - mean) ** 2 for x in s) / n) ** 0.5
+    return {"mean": round(mean, 1), "median": med, "std": round(std, 1), "min": s[0], "max": s[-1]}
+
+
+def empty_stats():
+    """Partial stats (counters, histograms and lists) that polls are added to."""
+    stats = {k: 0 for k in ("total", "withb", "total_votes", "closed", "private", "restricted",
+                            "sv_unique", "sv_tied", "plur_ne", "plur_base", "bt_polls")}
+    stats.update({k: [] for k in ("cand_counts", "voter_counts")})
+    stats.update({k: Counter() for k in ("cand", "voter", "ts", "cond", "pair",
+                                         "wset_sizes", "wset_counts", "bt")})
+    return stats
+
+
+def add_poll(stats, poll, record=None):
+    """Add a poll (a dict with its _id, is_completed and is_private) to the partial
+    stats, with its analytics record (by default the one saved in the poll)."""
+    stats["total"] += 1
+    if poll.get("is_completed"):
+        stats["closed"] += 1
+    if poll.get("is_private"):
+        stats["private"] += 1
+    try:
+        stats["ts"][poll["_id"].generation_time.strftime("%Y-%m")] += 1
+    except Exception:
+        pass
+    if record is None:
+        record = poll.get("analytics", {}).get("record", {"ncand": 0, "nb": 0})
+    ncand, nb = record["ncand"], record["nb"]
+    for lo, hi, lbl in CAND_B:
+        if lo <= ncand <= hi:
+            stats["cand"][lbl] += 1
+            break
+    for lo, hi, lbl in VOTER_B:
+        if lo <= nb <= hi:
+            stats["voter"][lbl] += 1
+            break
+    if nb == 0 or ncand < 2:
+        return stats
+    stats["withb"] += 1
+    stats["total_votes"] += nb
+    stats["cand_counts"].append(ncand)
+    stats["voter_counts"].append(nb)
+
+    if record.get("bt") is not None:
+        stats["bt"].update(record["bt"])
+        stats["bt_polls"] += 1
+    for k in ("cw", "weak_cw", "cl", "weak_cl", "cycle"):
+        if record.get(k):
+            stats["cond"][k] += 1
+
+    sv = record.get("sv")
+    if sv is not None:
+        stats["sv_unique" if len(sv) == 1 else "sv_tied"] += 1
+        if record.get("plurality") is not None:
+            stats["plur_base"] += 1
+            if record["plurality"] != sv:
+                stats["plur_ne"] += 1
+
+    ws = record.get("methods")
+    if ws is not None:
+        stats["restricted"] += 1
+        for name in MNAMES:
+            if ws.get(name) is not None:
+                stats["wset_sizes"][name] += len(ws[name])
+                stats["wset_counts"][name] += 1
+        for i in range(len(MNAMES)):
+            for j in range(i + 1, len(MNAMES)):
+                a, b = MNAMES[i], MNAMES[j]
+                if ws.get(a) is not None and ws.get(b) is not None and ws[a] != ws[b]:
+                    stats["pair"][a + "|" + b] += 1
+    return stats
+
+
+def merge_stats(stats, other):
+    """Add the partial stats other to stats."""
+    for k, v in other.items():
+        if isinstance(v, Counter):
+            stats[k].update(v)
+        elif isinstance(v, list):
+            stats[k].extend(v)
+        else:
+            stats[k] += v
+    return stats
+
+
+def finish_stats(stats):
+    """The dashboard payload of the partial stats of all the polls."""
+    total, with_ballots = stats["total"], stats["withb"]
+    bt_polls, wset_counts = stats["bt_polls"], stats["wset_counts"]
+    return {
+        "total": total,
+        "withb": with_ballots,
+        "total_votes": stats["total_votes"],
+        "size": {"voters": _summary(stats["voter_counts"]), "candidates": _summary(stats["cand_counts"])},
+        "cand": dict(stats["cand"]),
+        "voter": dict(stats["voter"]),
+        "cond": {**{k: stats["cond"][k] for k in ("cw", "weak_cw", "cl", "weak_cl", "cycle")},
+                 "base": with_ballots},
+        "status": {"closed": stats["closed"], "open": total - stats["closed"],
+                   "private": stats["private"], "public": total - stats["private"]},
+        "sv": {"unique": stats["sv_unique"], "tied": stats["sv_tied"],
+               "base": stats["sv_unique"] + stats["sv_tied"]},
+        "plurality": {"ne_sv": stats["plur_ne"], "base": stats["plur_base"]},
+        "ts": sorted(stats["ts"].items()),
+        "pair": dict(stats["pair"]),
+        "restricted": stats["restricted"],
+        "method_winset": {n: round(stats["wset_sizes"][n] / wset_counts[n], 3)
+                          for n in MNAMES if wset_counts[n]},
+        "bt": {k: (stats["bt"][k] / bt_polls if bt_polls else 0)
+               for k in ("linear", "truncated", "ties", "bullet")},
+    }
+
+
+def summarize(polls):
+    """The dashboard analytics summed up from the polls (dicts with the poll's _id,
+    is_completed, is_private and analytics record)."""
+    stats = empty_stats()
+    for poll in polls:
+        add_poll(stats, poll)
+    return finish_stats(stats)
+
+
+async def _parallel_stats(full=False, in_flight=ANALYTICS_IN_FLIGHT):
+    """One pass over the polls that computes the stale records (all of them if
+    full) concurrently, so their computations are spread over the analytics
+    pool's processes, with at most in_flight polls being analyzed at a time.
+    Each task adds its polls to its own partial stats, merged at the end. Only the
+    stale polls are read with their tally."""
+    queue = asyncio.Queue(maxsize=in_flight)
+    num_computed = 0
+
+    async def analyze():
+        nonlocal num_computed
+        stats = empty_stats()
+        while (doc := await queue.get()) is not None:
+            try:
+                if full or not _is_current(doc):
+                    poll = await db.find_one({"_id": doc["_id"]}, ANALYTICS_FIELDS)
+                    if poll is None:  # deleted meanwhile
+                        continue
+                    add_poll(stats, poll, await update_poll_record(poll))
+                    num_computed += 1
+                else:
+                    add_poll(stats, doc)
+            except Exception as e:
+                print(f"Analytics of poll {doc['_id']} failed: {e}")
+                add_poll(stats, doc, {"ncand": 0, "nb": 0})
+        return stats
+
+    tasks = [asyncio.create_task(analyze()) for _ in range(in_flight)]
+    try:
+        async for doc in db.find({}, SUMMARY_FIELDS):
+            await queue.put(doc)
+    finally:
+        for _ in tasks:
+            await queue.put(None)
+    stats = empty_stats()
+    for partial in await asyncio.gather(*tasks):
+        merge_stats(stats, partial)
+    print(f"Computed the analytics of {num_computed} polls")
+    return finish_stats(stats)
+
+
+async def dashboard_analytics(full=False):
+    """Refresh the stale poll records (all of them if full) and sum up the records
+    of all the polls, in parallel if ANALYTICS_IN_FLIGHT > 1."""
+    if ANALYTICS_IN_FLIGHT > 1:
+        return await _parallel_stats(full)
+    num = await refresh_poll_analytics(full)
+    print(f"Computed the analytics of {num} polls")
+    cursor = db.find({}, {"analytics.record": 1, "is_completed": 1, "is_private": 1})
+    return summarize([poll async for poll in cursor])
@@ -0,0 +1,81 @@
+#
+# Cache of poll outcomes and rankings
+#
+# The part of a poll's outcome computed from its ballots (margins, winners,
+# explanations, ...) only changes when the ballots do, and every ballot write
+# increments the poll's "ballot_version" (see polls/storage.py). So the outcome is
+# cached keyed by that version at two levels:
+#
+#   - an in-process LRU, keyed by (poll id, ballot version)
+#   - the poll's "outcome_cache" field, {"version": ..., "outcome": ...}, shared by
+#     all the processes serving the app
+#
+# Views between two votes are served from the cache without any computation or
+# write; the first view after a vote computes the outcome and stores it once.
+#
+# The Stable Voting ranking (the tiers of /polls/ranking) is cached the same way,
+# in the poll's "ranking_cache" field. Once a poll is completed its ranking is
+# saved in the "ranking" field next to its "result" (see polls/manage.py).
+#
+
+import os
+from collections import OrderedDict
+
+from polls.storage import db
+
+OUTCOME_CACHE_SIZE = int(os.getenv('OUTCOME_CACHE_SIZE', 256))
+
+_cache = OrderedDict()
+
+
+def _key(document, field):
+    return (field, str(document["_id"]), document.get("ballot_version", 0))
+
+
+def _remember(key, value):
+    _cache[key] = value
+    _cache.move_to_end(key)
+    while len(_cache) > OUTCOME_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _cached(document, field, name):
+    key = _key(document, field)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    cached = document.get(field)
+    if cached is not None and cached.get("version") == key[2]:
+        _remember(key, cached[name])
+        return cached[name]
+    return None
+
+
+async def _store(document, field, name, value):
+    key = _key(document, field)
+    _remember(key, value)
+    await db.update_one(
+        {"_id": document["_id"], "$expr": {"$eq": [{"$ifNull": ["$ballot_version", 0]}, key[2]]}},
+        {"$set": {field: {"version": key[2], name: value}}})
+
+
+def cached_outcome(document):
+    """The cached outcome for the poll's current ballot version, or None."""
+    return _cached(document, "outcome_cache", "outcome")
+
+
+async def store_outcome(document, outcome):
+    """Cache the outcome computed for the poll's current ballot version. It is saved
+    in the poll only if no ballot was written since the poll was read."""
+    await _store(document, "outcome_cache", "outcome", outcome)
+
+
+def cached_ranking(document):
+    """The cached ranking tiers for the poll's current ballot version, or None."""
+    return _cached(document, "ranking_cache", "tiers")
+
+
+async def store_ranking(document, tiers):
+    """Cache the ranking tiers computed for the poll's current ballot version (see
+    store_outcome)."""
+    await _store(document, "ranking_cache", "tiers", tiers)
@@ -0,0 +1,187 @@
+#
+# Compute service
+#
+# The outcome computations (polls/outcome.py) are CPU bound, so running them in
+# the request handlers would block the event loop and every other request on the
+# worker. They are submitted to a bounded pool of worker processes instead, each
+# with a deadline.
+#
+# Each worker process runs one computation at a time and talks to the app through
+# its own pipe. A computation's deadline starts when a worker starts running it
+# (not while it waits for a free worker), and a computation that misses it is
+# really stopped: its worker process is killed and replaced, and the computations
+# running in the other workers are not affected. A worker imports the heavy
+# libraries when it starts, before it takes its first computation, so a new worker
+# does not eat into the deadline of the computation it runs first.
+#
+# Separate workloads use separate pools (e.g., the superuser dashboard's analytics,
+# see polls/analytics.py), so they never hold up the results pages.
+#
+
+import asyncio
+import multiprocessing
+import os
+
+COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', 2))
+
+# default deadlines (in seconds)
+OUTCOME_TIMEOUT = float(os.getenv('OUTCOME_TIMEOUT', 10))
+RANKING_TIMEOUT = float(os.getenv('RANKING_TIMEOUT', 30))
+# time allowed to a new worker process to import the libraries
+START_TIMEOUT = float(os.getenv('COMPUTE_START_TIMEOUT', 120))
+
+# spawn rather than fork: the app process runs an event loop and threads
+_context = multiprocessing.get_context("spawn")
+_pools = []
+
+
+class ComputeTimeout(Exception):
+    """A computation did not finish before its deadline."""
+
+
+def _serve(conn):
+    """The loop of a worker process: run the computations sent through conn."""
+    from polls.startup import import_modules
+    import_modules()
+    conn.send(None)
+    while True:
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (True, fn(*args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # the result (or the exception) cannot be pickled
+            conn.send((False, RuntimeError(repr(e))))
+
+
+def _call(conn, fn, args):
+    conn.send((fn, args))
+    return conn.recv()
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+    def stop(self):
+        # the pipe is left open (and closed when it is collected): a thread may still
+        # be reading from it, until it sees the process exit
+        self.process.terminate()
+
+
+class ComputePool:
+    """A pool of up to `workers` processes, each running one computation at a time.
+    The processes are started when they are first needed (or by start)."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._idle = []       # the started workers waiting for a computation
+        self._live = set()    # all the started workers
+        self._starting = set() # the tasks starting replacement workers
+        self._slots = None
+        self._loop = None
+        _pools.append(self)
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._slots = loop, asyncio.Semaphore(self.workers)
+        return self._slots
+
+    def _start_worker(self):
+        conn, child_conn = _context.Pipe()
+        process = _context.Process(target=_serve, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = _Worker(process, conn)
+        self._live.add(worker)
+        try:
+            if not conn.poll(START_TIMEOUT):
+                raise RuntimeError(f"A compute worker did not start within {START_TIMEOUT} seconds.")
+            conn.recv()
+        except BaseException:
+            self._stop(worker)
+            raise
+        return worker
+
+    def _stop(self, worker):
+        self._live.discard(worker)
+        worker.stop()
+
+    def _replace(self):
+        """Start a worker in the background, in place of a stopped one."""
+        async def replace():
+            try:
+                worker = await asyncio.to_thread(self._start_worker)
+                if len(self._live) > self.workers:
+                    # a computation started a worker meanwhile
+                    self._stop(worker)
+                else:
+                    self._idle.append(worker)
+            except Exception as e:
+                print(f"Starting a compute worker failed: {e}")
+            finally:
+                self._starting.discard(task)
+        task = asyncio.create_task(replace())
+        self._starting.add(task)
+
+    async def start(self):
+        """Start the pool's processes (so the first computations do not wait for them)."""
+        workers = await asyncio.gather(
+            *[asyncio.to_thread(self._start_worker) for _ in range(self.workers - len(self._live))])
+        self._idle.extend(workers)
+
+    async def run(self, fn, *args, timeout=OUTCOME_TIMEOUT):
+        """Run fn(*args) in a worker process and return its result. fn and its
+        arguments must be picklable (fn a module-level function). Raises
+        ComputeTimeout if it runs for more than timeout seconds."""
+        async with self._semaphore():
+            worker = self._idle.pop() if self._idle else await asyncio.to_thread(self._start_worker)
+            try:
+                ok, value = await asyncio.wait_for(
+                    asyncio.to_thread(_call, worker.conn, fn, args), timeout)
+            except TimeoutError:
+                self._stop(worker)
+                self._replace()
+                raise ComputeTimeout(f"{fn.__name__} did not finish within {timeout} seconds.")
+            except BaseException:
+                # the request was cancelled or the worker died: the worker may still
+                # be running the computation, so it is not reused
+                self._stop(worker)
+                raise
+            self._idle.append(worker)
+        if not ok:
+            raise value
+        return value
+
+    def shutdown(self):
+        for worker in list(self._live):
+            self._stop(worker)
+        self._idle = []
+
+
+# the pool of the results pages
+_default = ComputePool(COMPUTE_WORKERS)
+
+
+async def run(fn, *args, timeout=OUTCOME_TIMEOUT):
+    """ComputePool.run in the results pages' pool."""
+    return await _default.run(fn, *args, timeout=timeout)
+
+
+async def start():
+    """Start the processes of the results pages' pool."""
+    await _default.start()
+
+
+def shutdown():
+    """Stop the processes of all the pools (at app shutdown)."""
+    for pool in _pools:
+        pool.shutdown()
@@ -0,0 +1,84 @@
+#
+# Leases
+#
+# A lease is a named lock kept in the Leases collection, so that at most one of
+# the processes serving the app (on any machine) runs some job at a time:
+#
+#   {"_id": name, "owner": token, "expires_at": datetime}
+#
+# It is acquired by the first process to set itself as owner while the lease is
+# free or expired, and it expires on its own if its owner dies. While the job runs,
+# a heartbeat renews the lease; the other processes simply skip the job.
+#
+
+import asyncio
+import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from polls.storage import client, data_base
+
+leases_db = client[data_base].Leases
+
+LEASE_SECONDS = float(os.getenv('LEASE_SECONDS', 60))
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+async def acquire(name, ttl=LEASE_SECONDS):
+    """Acquire the lease for ttl seconds. Returns the owner token, or None if
+    another owner holds the lease."""
+    token = uuid.uuid4().hex
+    now = _now()
+    try:
+        await leases_db.find_one_and_update(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"owner": token, "expires_at": now + timedelta(seconds=ttl), "acquired_at": now}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # the lease exists and has not expired
+        return None
+    return token
+
+
+async def renew(name, token, ttl=LEASE_SECONDS):
+    """Extend the lease by ttl seconds. Returns False if it is no longer ours."""
+    result = await leases_db.update_one(
+        {"_id": name, "owner": token},
+        {"$set": {"expires_at": _now() + timedelta(seconds=ttl)}})
+    return result.matched_count > 0
+
+
+async def release(name, token):
+    await leases_db.delete_one({"_id": name, "owner": token})
+
+
+async def _heartbeat(name, token, ttl):
+    while True:
+        await asyncio.sleep(ttl / 3)
+        if not await renew(name, token, ttl):
+            print(f"Lost the lease {name}")
+            return
+
+
+@asynccontextmanager
+async def single_flight(name, ttl=LEASE_SECONDS):
+    """Hold the lease for the duration of the block, renewing it every ttl / 3
+    seconds. Yields whether the lease was acquired; if not, another process is
+    running the job and the block should do nothing."""
+    token = await acquire(name, ttl)
+    if token is None:
+        yield False
+        return
+    heartbeat = asyncio.create_task(_heartbeat(name, token, ttl))
+    try:
+        yield True
+    finally:
+        heartbeat.cancel()
+        await release(name, token)
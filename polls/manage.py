@@ -6,48 +6,42 @@
 # Functions to manage polls
 #
 
-from fastapi import BackgroundTasks, File, UploadFile
+from fastapi import File, UploadFile
 import arrow
+import asyncio
 import random
-from pymongo import AsyncMongoClient
 import csv
 import io
 import os
 import time
 from bson import ObjectId
 import humanize
-import networkx as nx
-from collections import defaultdict
-from func_timeout import func_timeout, FunctionTimedOut
-
-from pref_voting.profiles_with_ties import ProfileWithTies
-from pref_voting.voting_methods import (
-    split_cycle_defeat, stable_voting, split_cycle,
-    minimax, copeland, MWSL, borda_for_profile_with_ties, approval_irv,
-)
+
 from polls.models import CreatePoll, UpdatePoll
 from polls.helpers import generate_voter_ids
-from messages.helpers import participate_email
-from polls.voting import is_linear, generate_columns_from_profiles, stable_voting_with_explanations_, get_splitting_numbers, generate_csv_data
+from messages.helpers import invitation_emails, vote_link
+from polls.voting import (
+    generate_columns_from_profiles, generate_csv_data, iter_csv_rows, normalized_ranks,
+    ranking_key, ranking_from_key, group_rankings, build_profile,
+)
+from polls.outcome import (
+    EMPTY_OUTCOME, profile_outcome, tally_outcome, tally_ranking_tiers,
+)
+from polls import compute
+from polls.cache import cached_outcome, store_outcome, cached_ranking, store_ranking
+from polls.analytics import dashboard_analytics
+from polls.lease import single_flight
+from polls.tally import empty_tally, tally_profile
+from polls.storage import (
+    db, superuser_cache, BALLOT_STORAGE, EMBEDDED, POLL_FIELDS,
+    BALLOT_FIELDS, VOTER_FIELDS, OUTCOME_PROJECTION, RANKING_PROJECTION, get_poll, ballot_count,
+    ensure_tally, get_voter_ballot, put_voter_ballot, add_ballot,
+    remove_voter_ballot, rename_voter, add_ballots, replace_ballots, delete_poll_ballots,
+)
 
 # UPDATED IMPORTS - removed fastapi_mail, added new email functions
-from messages.conf import SKIP_EMAILS, send_email
-import certifi
-
-# MongoDB connection
-mongo_details = os.getenv('MONGODB_URI')
-
-# Check if we're in development (local MongoDB doesn't use SSL)
-if mongo_details and ('localhost' in mongo_details or '127.0.0.1' in mongo_details):
-    # Local connection without SSL
-    client = AsyncMongoClient(mongo_details)
-else:
-    # Production connection with SSL
-    client = AsyncMongoClient(mongo_details, tlsCAFile=certifi.where(), tls=True)
-
-data_base = os.getenv('MONGO_DB_NAME', 'StableVoting')
-db = client[data_base].Polls
-superuser_cache = client[data_base]["superuser_cache"]
+from messages.conf import SKIP_EMAILS
+from messages.outbox import enqueue_batch, enqueue_emails
 
 
 def _multiple_vote_allowed(pwd):
@@ -75,7 +69,7 @@ async def superuser_list_polls():
             "title": {"$ifNull": ["$title", "(untitled)"]},
             "oid": "$owner_id",
             "nc": {"$size": {"$ifNull": ["$candidates", []]}},
-            "nb": {"$size": {"$ifNull": ["$ballots", []]}},
+            "nb": {"$ifNull": ["$tally.num_ballots", {"$size": {"$ifNull": ["$ballots", []]}}]},
             "done": {"$ifNull": ["$is_completed", False]},
             "priv": {"$ifNull": ["$is_private", False]},
         }},
@@ -85,250 +79,52 @@ async def superuser_list_polls():
     return await cursor.to_list(length=None)
 
 
-def _sv_winners_only(prof, curr_cands=None):
-    """Stable Voting winners via the site's own routine (split-cycle based, so it
-    stays feasible on large polls) — matches what the results page shows, unlike
-    pref_voting's raw stable_voting which recurses over every candidate."""
-    ws, _, _ = stable_voting_with_explanations_(prof, curr_cands=curr_cands)
-    return ws
-
-
-_SU_METHODS = None
-def _su_methods():
-    global _SU_METHODS
-    if _SU_METHODS is None:
-        _SU_METHODS = {
-            "Minimax": minimax, "Copeland": copeland, "Stable Voting": _sv_winners_only,
-            "Split Cycle": split_cycle, "MWSL": MWSL,
-            "Borda": borda_for_profile_with_ties, "IRV": approval_irv,
-        }
-    return _SU_METHODS
-
-
-def _ballot_type(rmap, ncand):
-    ranked = list(rmap.keys())
-    if len(ranked) == 0:
-        return None
-    ranks = list(rmap.values())
-    has_ties = len(set(ranks)) != len(ranks)
-    truncated = len(ranked) < ncand
-    return {"linear": (not has_ties) and (not truncated), "truncated": truncated,
-            "ties": has_ties, "bullet": len(ranked) == 1}
-
-
-def _plurality_ws(prof):
-    """Approval-at-top plurality winners: each voter gives one point to every
-    candidate at their top (first) rank; a voter tied k-at-top counts for all k.
-    Returns the set of top-scoring candidates (as strings), or None."""
-    scores = {c: 0 for c in prof.candidates}
-    for r, cnt in zip(prof.rankings, prof.rcounts):
-        if len(r.rmap) == 0:
-            continue
-        top = min(r.rmap.values())
-        for c, rk in r.rmap.items():
-            if rk == top and c in scores:
-                scores[c] += cnt
-    if not scores or max(scores.values()) == 0:
-        return None
-    mx = max(scores.values())
-    return frozenset(str(c) for c in scores if scores[c] == mx)
-
-
 _SU_TTL = 6 * 3600           # recompute at most every 6 hours when viewed
-_SU_COMPUTING = {"running": False}
 
 
-async def superuser_stats(background_tasks=None, refresh=False):
+async def superuser_stats(background_tasks=None, refresh=False, full=False):
     """Return the cached dashboard analytics, recomputing in the background when
     the cache is missing, stale, or a refresh is requested. The heavy computation
     (~25s) never blocks the request: callers get the previous result immediately
     (with computing=True) while a fresh one is computed, or {computing: True} on
-    the very first run."""
+    the very first run. full recomputes the records of all the polls, not only of
+    those whose ballots changed."""
     doc = await superuser_cache.find_one({"_id": "stats"})
     now = time.time()
-    fresh = doc is not None and not refresh and (now - doc.get("computed_at", 0) < _SU_TTL)
+    fresh = doc is not None and not refresh and not full and (now - doc.get("computed_at", 0) < _SU_TTL)
     if fresh:
         return {**doc["data"], "cached_at": doc["computed_at"], "computing": False}
     if background_tasks is not None:
-        background_tasks.add_task(_superuser_compute_and_store)
+        background_tasks.add_task(_superuser_compute_and_store, full)
     if doc is not None:
         return {**doc["data"], "cached_at": doc.get("computed_at"), "computing": True}
     return {"computing": True, "cached_at": None}
 
 
-async def _superuser_compute_and_store():
-    """Run the heavy analytics computation and persist it (single-flight)."""
-    if _SU_COMPUTING["running"]:
-        return
-    _SU_COMPUTING["running"] = True
-    try:
-        data = await _superuser_stats_compute()
+async def _superuser_compute_and_store(full=False):
+    """Run the heavy analytics computation and persist it. Single-flight across
+    all the app's processes: while one holds the lease (see polls/lease.py) the
+    others skip the computation and keep serving the cached stats."""
+    async with single_flight("superuser_stats") as acquired:
+        if not acquired:
+            print("The superuser stats are being computed by another process")
+            return
+        data = await _superuser_stats_compute(full)
         await superuser_cache.update_one(
             {"_id": "stats"}, {"$set": {"data": data, "computed_at": time.time()}}, upsert=True,
         )
-    finally:
-        _SU_COMPUTING["running"] = False
 
 
-async def _superuser_stats_compute():
+async def _superuser_stats_compute(full=False):
     """Analytics over every poll: totals, size and Condorcet distributions,
     poll-creation time series, ballot-type mix, Stable Voting outcomes, poll
-    status, and pairwise winner disagreement across voting methods."""
-    METHODS = _su_methods()
-    MNAMES = list(METHODS.keys())
+    status, and pairwise winner disagreement across voting methods. Built from the
+    per-poll records of polls/analytics.py, recomputed only for the polls whose
+    ballots changed (or for all of them if full), several polls at a time."""
+    return await dashboard_analytics(full)
 
-    def winset(fn, prof, timeout=2):
-        try:
-            return frozenset(str(c) for c in func_timeout(timeout, fn, args=(prof,)))
-        except BaseException:
-            return None
-
-    CAND_B = [(2, 2, "2"), (3, 3, "3"), (4, 4, "4"), (5, 5, "5"), (6, 7, "6-7"),
-              (8, 10, "8-10"), (11, 15, "11-15"), (16, 10**9, "16+")]
-    VOTER_B = [(1, 4, "1-4"), (5, 9, "5-9"), (10, 24, "10-24"), (25, 49, "25-49"),
-               (50, 99, "50-99"), (100, 10**9, "100+")]
-
-    total = with_ballots = total_votes = 0
-    cand_counts, voter_counts = [], []
-    cand_hist, voter_hist, by_month, pair_diff = defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(int)
-    wset_sizes, wset_counts = defaultdict(float), defaultdict(int)
-    cw = wcw = cl = wcl = cycle = restricted = 0
-    closed_ct = private_ct = 0
-    sv_unique = sv_tied = plur_ne = plur_base = 0
-    bt_sums = {"linear": 0.0, "truncated": 0.0, "ties": 0.0, "bullet": 0.0}
-    bt_polls = 0
-
-    cursor = db.find({}, {"candidates": 1, "ballots": 1, "is_completed": 1, "is_private": 1})
-    async for doc in cursor:
-        total += 1
-        if doc.get("is_completed"):
-            closed_ct += 1
-        if doc.get("is_private"):
-            private_ct += 1
-        cands = doc.get("candidates", []) or []
-        ballots = doc.get("ballots", []) or []
-        ncand, nb = len(cands), len(ballots)
-        for lo, hi, lbl in CAND_B:
-            if lo <= ncand <= hi:
-                cand_hist[lbl] += 1
-                break
-        for lo, hi, lbl in VOTER_B:
-            if lo <= nb <= hi:
-                voter_hist[lbl] += 1
-                break
-        try:
-            by_month[doc["_id"].generation_time.strftime("%Y-%m")] += 1
-        except Exception:
-            pass
-        if nb == 0 or ncand < 2:
-            continue
-        with_ballots += 1
-        total_votes += nb
-        cand_counts.append(ncand)
-        voter_counts.append(nb)
-
-        cand_to_cidx = {c: i for i, c in enumerate(cands)}
-        try:
-            prof = ProfileWithTies([
-                {cand_to_cidx[c]: rank for c, rank in b["ranking"].items() if c in cand_to_cidx}
-                for b in ballots])
-        except Exception:
-            continue
-        if not any(len(r.rmap) > 0 for r in prof.rankings):
-            continue
-
-        types = [t for t in (_ballot_type(b["ranking"], ncand) for b in ballots) if t]
-        if types:
-            for k in bt_sums:
-                bt_sums[k] += sum(1 for t in types if t[k]) / len(types)
-            bt_polls += 1
-
-        try:
-            ci = list(prof.candidates)
-            m = {a: {b: prof.margin(a, b) for b in ci} for a in ci}
-            if prof.condorcet_winner() is not None:
-                cw += 1
-            if any(all(m[o][c] <= 0 for o in ci if o != c) for c in ci):
-                wcw += 1
-            if any(all(m[o][c] > 0 for o in ci if o != c) for c in ci):
-                cl += 1
-            if any(all(m[c][o] <= 0 for o in ci if o != c) for c in ci):
-                wcl += 1
-            g = nx.DiGraph()
-            g.add_nodes_from(ci)
-            for x in ci:
-                for y in ci:
-                    if x != y and m[x][y] > 0:
-                        g.add_edge(x, y)
-            if not nx.is_directed_acyclic_graph(g):
-                cycle += 1
-        except Exception:
-            pass
-
-        # Stable Voting winner set (unique vs. tied) + plurality-vs-SV agreement,
-        # using the site's own SV routine so it matches the results page. Computed
-        # once with a generous timeout (this runs in the background, so even the
-        # few slow polls are covered) and reused for the heatmap below.
-        sv = winset(_sv_winners_only, prof, timeout=20)
-        if sv is not None:
-            if len(sv) == 1:
-                sv_unique += 1
-            else:
-                sv_tied += 1
-            try:
-                pl = _plurality_ws(prof)
-            except Exception:
-                pl = None
-            if pl is not None:
-                plur_base += 1
-                if pl != sv:
-                    plur_ne += 1
-
-        if nb >= 5 and ncand >= 3:
-            ws = {name: winset(fn, prof) for name, fn in METHODS.items() if name != "Stable Voting"}
-            ws["Stable Voting"] = sv  # reuse the generously-computed SV winner set
-            restricted += 1
-            for name in MNAMES:
-                if ws[name] is not None:
-                    wset_sizes[name] += len(ws[name])
-                    wset_counts[name] += 1
-            for i in range(len(MNAMES)):
-                for j in range(i + 1, len(MNAMES)):
-                    a, b = MNAMES[i], MNAMES[j]
-                    if ws[a] is not None and ws[b] is not None and ws[a] != ws[b]:
-                        pair_diff[a + "|" + b] += 1
-
-    def summary(xs):
-        if not xs:
-            return {"mean": 0, "median": 0, "std": 0, "max": 0}
-        s = sorted(xs)
-        n = len(s)
-        med = s[n // 2] if n % 2 else (s[n // 2 - 1] + s[n // 2]) / 2
-        mean = sum(s) / n
-        std = (sum((x - mean) ** 2 for x in s) / n) ** 0.5
-        return {"mean": round(mean, 1), "median": med, "std": round(std, 1), "min": s[0], "max": s[-1]}
-
-    result = {
-        "total": total,
-        "withb": with_ballots,
-        "total_votes": total_votes,
-        "size": {"voters": summary(voter_counts), "candidates": summary(cand_counts)},
-        "cand": dict(cand_hist),
-        "voter": dict(voter_hist),
-        "cond": {"cw": cw, "weak_cw": wcw, "cl": cl, "weak_cl": wcl, "cycle": cycle, "base": with_ballots},
-        "status": {"closed": closed_ct, "open": total - closed_ct, "private": private_ct, "public": total - private_ct},
-        "sv": {"unique": sv_unique, "tied": sv_tied, "base": sv_unique + sv_tied},
-        "plurality": {"ne_sv": plur_ne, "base": plur_base},
-        "ts": sorted(by_month.items()),
-        "pair": dict(pair_diff),
-        "restricted": restricted,
-        "method_winset": {n: round(wset_sizes[n] / wset_counts[n], 3) for n in MNAMES if wset_counts[n]},
-        "bt": {k: (bt_sums[k] / bt_polls if bt_polls else 0) for k in bt_sums},
-    }
-    return result
 
-
-async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
+async def create_poll(poll_data: CreatePoll):
     """Create a poll."""
     print("HERE!!!!! creating a poll...")
     now = arrow.now()
@@ -355,29 +151,21 @@ async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
         "can_view_outcome_before_closing": poll_data.can_view_outcome_before_closing,
         "show_outcome": poll_data.show_outcome,
         "allow_multiple_votes": poll_data.allow_multiple_votes,
-        "ballots": [],
+        "ballot_storage": BALLOT_STORAGE,
+        "tally": empty_tally(len(poll_data.candidates)),
+        "ballot_version": 0,
         "is_completed": False,
         "result": None,
         "creation_dt": now.format('MMMM DD, YYYY @ HH:mm')
     }
+    if BALLOT_STORAGE == EMBEDDED:
+        poll["ballots"] = []
     result = await db.insert_one(poll)
 
     if not SKIP_EMAILS:
-        # UPDATED: Admin notification using new send_email
-        background_tasks.add_task(
-            send_email,
-            to_email="stablevoting.org@gmail.com",
-            subject="New Poll Created",
-            html_body=f"""<p>Poll Created: https://stablevoting.org/results/{result.inserted_id}?oid={owner_id}</p>
-            <p>vote: https://stablevoting.org/vote/{result.inserted_id}?oid={owner_id}</p>            
-            <p>admin: https://stablevoting.org/admin/{result.inserted_id}?oid={owner_id}</p><p></p><p>{poll}</p>""",
-            tag="admin-poll-created"
-        )
-        
-        # Also send to Eric
-        background_tasks.add_task(
-            send_email,
-            to_email="epacuit@umd.edu",
+        # Admin notification (to the site's email and to Eric)
+        await enqueue_batch(
+            recipients=["stablevoting.org@gmail.com", "epacuit@umd.edu"],
             subject="New Poll Created",
             html_body=f"""<p>Poll Created: https://stablevoting.org/results/{result.inserted_id}?oid={owner_id}</p>
             <p>vote: https://stablevoting.org/vote/{result.inserted_id}?oid={owner_id}</p>            
@@ -385,29 +173,24 @@ async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
             tag="admin-poll-created"
         )
 
-        # UPDATED: Send voter invitations using new send_email
-        for em, voter_id in zip(poll_data.voter_emails, voter_ids):
-            print("sending email to ", em)
-            link = f"https://stablevoting.org/vote/{result.inserted_id}?vid={voter_id}"
-            print(participate_email(poll_data.title, poll_data.description, link))
-            
-            background_tasks.add_task(
-                send_email,
-                to_email=em,
-                subject=f"Participate in the poll: {poll_data.title}",
-                html_body=participate_email(poll_data.title, poll_data.description, link),
+        # Voter invitations, each with the voter's own link, queued for the email worker
+        if len(poll_data.voter_emails) > 0:
+            print(f"queueing {len(poll_data.voter_emails)} invitations")
+            await enqueue_emails(
+                invitation_emails(result.inserted_id, poll_data.title, poll_data.description,
+                                  zip(poll_data.voter_emails, voter_ids)),
                 tag="voter-invitation"
             )
 
     return {"id": str(result.inserted_id), "owner_id": owner_id}
 
 
-async def update_poll(id, owner_id, poll_data: UpdatePoll, background_tasks: BackgroundTasks):
+async def update_poll(id, owner_id, poll_data: UpdatePoll):
     """Update a poll. """
 
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, VOTER_FIELDS, count_ballots=True)
     poll_data = poll_data.model_dump()
     if document is None: # poll not found
         return {"error": "Poll not found."}
@@ -452,35 +235,39 @@ async def update_poll(id, owner_id, poll_data: UpdatePoll, background_tasks: Bac
             "can_view_outcome_before_closing": get_data("can_view_outcome_before_closing"),
             "show_outcome": get_data("show_outcome"),
             "allow_multiple_votes": get_data("allow_multiple_votes"),
-            "ballots": document["ballots"],
             "is_completed": get_data("is_completed"),
-            "result": document["result"],
-            "creation_dt": document["creation_dt"],
             }
         resp = {"success": "Poll updated."}
-        if len(document["ballots"]) > 0: 
+        if ballot_count(document) > 0: 
             new_poll["candidates"] = document["candidates"]
             if poll_data["candidates"] is not None:
                 resp["message"] = "Since voters have submitted ballots, candidate names cannot be changed.   The other changes have been made to the poll." 
         else: 
             new_poll["candidates"] =  get_data("candidates") 
-        
-        result = await db.update_one({"_id": ObjectId(id)}, {"$set": new_poll})
+            if poll_data["candidates"] is not None:
+                new_poll["tally"] = empty_tally(len(new_poll["candidates"]))
+        if not new_poll["is_completed"] and not poll_closed(new_poll["closing_datetime"], new_poll["timezone"]):
+            # the poll is (re)opened, so any saved result and ranking no longer apply,
+            # nor do the scheduler's attempts to finalize it (see polls/scheduler.py)
+            new_poll["result"] = None
+            new_poll["ranking"] = None
+            new_poll["finalize_attempts"] = 0
+            new_poll["finalize_after"] = None
+        update = {"$set": new_poll}
+        if "tally" in new_poll:
+            update["$inc"] = {"ballot_version": 1}
+
+        result = await db.update_one({"_id": ObjectId(id)}, update)
 
         if not SKIP_EMAILS: 
             if len(new_voter_ids) > 0: 
-                # UPDATED: Send emails to new voters using new send_email
-                for em, voter_id in zip(poll_data["new_voter_emails"], new_voter_ids):
-                    print("sending email to ", em)
-                    link = f"https://stablevoting.org/vote/{id}?vid={voter_id}"
-
-                    background_tasks.add_task(
-                        send_email,
-                        to_email=em,
-                        subject=f'Participate in the poll: {new_poll["title"]}',
-                        html_body=participate_email(new_poll["title"], new_poll["description"], link),
-                        tag="voter-invitation-update"
-                    )
+                # Invitations to the new voters, queued for the email worker
+                print(f"queueing {len(new_voter_ids)} invitations")
+                await enqueue_emails(
+                    invitation_emails(id, new_poll["title"], new_poll["description"],
+                                      zip(poll_data["new_voter_emails"], new_voter_ids)),
+                    tag="voter-invitation-update"
+                )
 
     return resp
 
@@ -490,7 +277,7 @@ async def delete_poll(id, oid):
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found. Invalid poll id."}
 
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, ["owner_id"])
 
     if document is None: 
         return {"error": "Poll not found."}
@@ -502,6 +289,7 @@ async def delete_poll(id, oid):
     if result.deleted_count == 0: 
         return {"error": "There was a problem.  The poll was not deleted."}
     else: 
+        await delete_poll_ballots(id)
         return {"success": "Poll deleted."}
 
 
@@ -512,8 +300,7 @@ async def poll_information(id, oid):
     if not ObjectId.is_valid(id): 
         return {"error": "Poll not found."}
 
-    document = await db.find_one({"_id": ObjectId(id)})  
-    print(document) 
+    document = await get_poll(id, VOTER_FIELDS, count_ballots=True)
 
     if document is None: # poll not found
         return {"error": "Poll not found."}
@@ -530,7 +317,7 @@ async def poll_information(id, oid):
         "title": document.get("title", "n/a"),
         "description": document.get("description", "n/a"),
         "hide_description": document.get("hide_description", False),
-        "num_ballots": len(document["ballots"]),
+        "num_ballots": ballot_count(document),
         "candidates": document.get("candidates", []),
         "is_private": document.get("is_private", False),
         "num_invited_voters": len(document.get("voter_ids", list())) if document.get("is_private", False) else None,
@@ -577,7 +364,7 @@ async def delete_voter(poll_id: str, voter_id: str, owner_id: str):
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await get_poll(poll_id, BALLOT_FIELDS)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -588,45 +375,29 @@ async def delete_voter(poll_id: str, voter_id: str, owner_id: str):
     if not document.get("is_private", False):
         return {"error": "Can only manage voters in private polls."}
     
-    # Get current voter lists
     voter_ids = document.get("voter_ids", [])
-    voter_email_map = document.get("voter_email_map", {})
     
     if voter_id not in voter_ids:
         return {"error": "Voter not found."}
     
-    # Remove voter_id from the list
-    voter_ids.remove(voter_id)
-    
-    # Remove from email map if present
-    if voter_id in voter_email_map:
-        del voter_email_map[voter_id]
-    
-    # Remove any ballots from this voter
-    ballots = [b for b in document["ballots"] if b.get("voter_id") != voter_id]
-    
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
-            "voter_ids": voter_ids,
-            "voter_email_map": voter_email_map,
-            "ballots": ballots
-        }}
-    )
-    
-    if result.modified_count > 0:
+    # Remove the voter id, the email and any ballot from this voter
+    result = await remove_voter_ballot(document, voter_id, {
+        "$pull": {"voter_ids": voter_id},
+        "$unset": {f"voter_email_map.{voter_id}": ""},
+    })
+
+    if result is not None and result.modified_count > 0:
         return {"success": "Voter deleted."}
     else:
         return {"error": "Failed to delete voter."}    
 
 
-async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, background_tasks: BackgroundTasks):
+async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str):
     """Generate a new voter ID for an existing voter."""
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await get_poll(poll_id, VOTER_FIELDS)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -657,36 +428,28 @@ async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, back
         del voter_email_map[voter_id]
         voter_email_map[new_voter_id] = email
     
-    # Update any existing ballot to use the new voter_id
-    ballots = document["ballots"]
-    for ballot in ballots:
-        if ballot.get("voter_id") == voter_id:
-            ballot["voter_id"] = new_voter_id
-    
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
+    # Update the database, moving any existing ballot over to the new voter_id
+    result = await rename_voter(document, voter_id, new_voter_id, {
+        "$set": {
             "voter_ids": voter_ids,
             "voter_email_map": voter_email_map,
-            "ballots": ballots
-        }}
-    )
+        }})
     
     if result.modified_count > 0:
         # Send email with new link
         if email and not SKIP_EMAILS:
-            link = f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_id}"
+            link = vote_link(poll_id, new_voter_id)
             
-            background_tasks.add_task(
-                send_email,
-                to_email=email,
-                subject=f"New voting link for: {document['title']}",
-                html_body=f"""<p>A new voting link has been generated for you.</p>
+            await enqueue_emails(
+                [{
+                    "to_email": email,
+                    "subject": f"New voting link for: {document['title']}",
+                    "html_body": f"""<p>A new voting link has been generated for you.</p>
                 <p>Poll: {document['title']}</p>
                 <p>Your new voting link: <a href="{link}">{link}</a></p>
                 <p>Your previous link has been deactivated.</p>
                 <p>You can use this link to vote or update your existing vote.</p>""",
+                }],
                 tag="voter-link-regenerated"
             )
         
@@ -704,7 +467,7 @@ async def delete_all_ballots(id, owner_id):
     if not ObjectId.is_valid(id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, POLL_FIELDS, count_ballots=True)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -720,16 +483,13 @@ async def delete_all_ballots(id, owner_id):
         return {"error": "Cannot delete ballots from a closed poll."}
     
     # Get the number of ballots to be deleted for the response
-    num_ballots = len(document.get("ballots", []))
+    num_ballots = ballot_count(document)
     
     if num_ballots == 0:
         return {"error": "No ballots to delete."}
     
     # Delete all ballots
-    result = await db.update_one(
-        {"_id": ObjectId(id)},
-        {"$set": {"ballots": []}}
-    )
+    result = await replace_ballots(document, [])
     
     if result.modified_count > 0:
         return {"success": f"Successfully deleted {num_ballots} ballot(s)."}
@@ -741,7 +501,7 @@ async def submit_ballot(ballot, id, vid, allow_multiple_vote_pwd):
 
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, BALLOT_FIELDS)
     if document is None: # poll not found
         return {"error": "Poll not found."}
 
@@ -765,22 +525,17 @@ async def submit_ballot(ballot, id, vid, allow_multiple_vote_pwd):
     if document["is_private"]:
         if vid is None or vid not in document["voter_ids"]:
             return {"error": "The poll is private."}
-        # atomically replace this voter's existing ballot, if there is one
-        result = await db.update_one(
-            {"_id": ObjectId(id), "ballots.voter_id": vid},
-            {"$set": {"ballots.$": b}})
-        if result.matched_count > 0:
-            return {"success": "Ballot submitted."}
+        # replace this voter's existing ballot, if there is one
+        if not await put_voter_ballot(document, vid, b):
+            return {"error": "The ballot could not be submitted, please try again."}
+        return {"success": "Ballot submitted."}
     elif not allow_multiple_votes and ballot.ip not in (None, "n/a"):
-        # atomically append only if no ballot with this ip exists yet
-        result = await db.update_one(
-            {"_id": ObjectId(id), "ballots.ip": {"$ne": ballot.ip}},
-            {"$push": {"ballots": b}})
-        if result.matched_count == 0:
+        # add the ballot only if no ballot with this ip exists yet
+        if not await add_ballot(document, b, unique_ip=ballot.ip):
             return {"error": "Already submitted a ballot."}
         return {"success": "Ballot submitted."}
 
-    await db.update_one({"_id": ObjectId(id)}, {"$push": {"ballots": b}})
+    await add_ballot(document, b)
     return {"success": "Ballot submitted."}
 
 
@@ -788,25 +543,45 @@ async def delete_ballot(id, vid):
     """Given a voter id, delete a ballot from the poll"""
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, BALLOT_FIELDS)
     if document is None: # poll not found
         return {"error": "Poll not found."}
     if not document["is_private"]:
         return {"error": "Can only delete ballots in private polls."}
     if vid is None or vid not in document["voter_ids"]:
         return {"error": "Voter id not found, cannot delete the ballot."}
-    result = await db.update_one(
-        {"_id": ObjectId(id)}, {"$pull": {"ballots": {"voter_id": vid}}})
-    if result.modified_count > 0:
+    result = await remove_voter_ballot(document, vid)
+    if result is not None and result.modified_count > 0:
         return {"success": "Ballot deleted."}
     return {"error": "Ballot not found."}
 
 
+# number of distinct rankings written at once by a bulk import
+BULK_BATCH_SIZE = 1000
+
+
+def _csv_rankings(ranking_reader, cands, num_cands):
+    """Iterate over the (row index, ranking, count) of the non-empty rows of a csv
+    file of rankings, where the count is the optional column after the ranks (1 by
+    default). Raises ValueError on a rank that is not a number."""
+    for rowidx, row in enumerate(ranking_reader):
+        if len([v for v in row if v.strip() != '']) == 0:
+            continue
+        count = int(row[num_cands]) if len(row) > num_cands and row[num_cands] != '' and row[num_cands].isdigit() else 1
+        if count == 0:
+            continue
+        try:
+            ranking = {c: int(r) for c, r in zip(cands, row[0:num_cands]) if r.strip() != ''}
+        except ValueError:
+            raise ValueError(f"Row {rowidx + 2} of the file contains a rank that is not a number.")
+        yield rowidx, ranking, count
+
+
 async def add_rankings(id, owner_id, csv_file, overwrite):
     """add rankings to a poll from a csv file."""
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, POLL_FIELDS)
     if document is None: # poll not found
         return {"error": "Poll not found."}
     if owner_id != document["owner_id"]:
@@ -815,7 +590,11 @@ async def add_rankings(id, owner_id, csv_file, overwrite):
     candidates = document["candidates"]
     num_cands = len(candidates)
 
-    # parse the upload in memory: no temp file to write, leak, or traverse
+    # the upload is parsed incrementally twice: a first pass checks every row (so a
+    # bad row is reported before anything is written), the second stores the rows
+    # as weighted ballots, one per distinct ranking. Added ballots are written in
+    # batches; ballots that overwrite the poll's ballots are written all at once, so
+    # the poll never holds a partial import in place of its ballots
     csvfile = io.TextIOWrapper(csv_file.file, encoding="utf-8", errors="replace")
     ranking_reader = csv.reader(csvfile, delimiter=',')
     try:
@@ -826,30 +605,47 @@ async def add_rankings(id, owner_id, csv_file, overwrite):
     if not sorted(candidates) == sorted(cands[0:num_cands]):
         return {"error": "The candidates in the file do not match the candidates in the poll."}
 
-    new_ballots = list()
-    rowidx = 0
+    num_rows = num_ballots = 0
     try:
-        for rowidx, row in enumerate(ranking_reader):
-            if len([v for v in row if v.strip() != '']) == 0:
-                continue
-            num_ballot = int(row[num_cands]) if len(row) > num_cands and row[num_cands] != '' and row[num_cands].isdigit() else 1
-            for nb in range(num_ballot):
-                new_ballots += [{
-                    "ranking": {c:int(r) for c,r in zip(cands, row[0:num_cands]) if r.strip() != ''},
-                    "voter_id": f"bulk{rowidx}_{nb+1}",
-                    "submission_date": None,
-                    "ip": csv_file.filename
-                }]
-    except ValueError:
-        return {"error": f"Row {rowidx + 2} of the file contains a rank that is not a number."}
+        for _, _, count in _csv_rankings(ranking_reader, cands, num_cands):
+            num_rows += 1
+            num_ballots += count
+    except ValueError as e:
+        return {"error": str(e)}
+
+    csvfile.seek(0)
+    ranking_reader = csv.reader(csvfile, delimiter=',')
+    next(ranking_reader)
+    batch = dict()
+    num_added = 0
+    for rowidx, ranking, count in _csv_rankings(ranking_reader, cands, num_cands):
+        key = tuple(sorted(ranking.items()))
+        if key in batch:
+            batch[key]["count"] += count
+        else:
+            batch[key] = {
+                "ranking": ranking,
+                "count": count,
+                "voter_id": f"bulk{rowidx}",
+                "submission_date": None,
+                "ip": csv_file.filename
+            }
+        if not overwrite and len(batch) >= BULK_BATCH_SIZE:
+            await add_ballots(document, list(batch.values()))
+            num_added += sum(b["count"] for b in batch.values())
+            print(f"bulk import {id}: {num_added} of {num_ballots} ballots added")
+            batch = dict()
+    if overwrite:
+        await replace_ballots(document, list(batch.values()))
+    else:
+        await add_ballots(document, list(batch.values()))
+    csvfile.detach()
 
     if overwrite:
-        await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": new_ballots}})
-        success_message = f"Replaced all the ballots with {len(new_ballots)} ballots in the poll: {document['title']}."
+        success_message = f"Replaced all the ballots with {num_ballots} ballots in the poll: {document['title']}."
     else:
-        await db.update_one( {"_id": ObjectId(id)}, {"$push": {"ballots": {"$each": new_ballots}}})
-        success_message = f"Added {len(new_ballots)} ballots to the poll: {document['title']}."
-    return {"success": success_message}
+        success_message = f"Added {num_ballots} ballots to the poll: {document['title']}."
+    return {"success": success_message, "num_rows": num_rows, "num_ballots": num_ballots}
 
 
 ###
@@ -922,7 +718,7 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
     if not ObjectId.is_valid(id):
         return not_found_response()
 
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, BALLOT_FIELDS)
 
     if document is None: # poll not found
         return not_found_response()
@@ -983,9 +779,9 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
         }
     print("poll_ranking_information: resp", resp)
     if document["is_private"] and (vid is not None and vid in document["voter_ids"]): 
-        for b in document["ballots"]: 
-            if b["voter_id"] == vid: 
-                resp["ranking"] = b["ranking"]
+        b = await get_voter_ballot(document, vid)
+        if b is not None: 
+            resp["ranking"] = b["ranking"]
     return resp
 
 
@@ -994,7 +790,7 @@ async def submitted_ranking_information(id, owner_id):
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
 
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, POLL_FIELDS + ["tally"])
 
     if document is None: # poll not found
         return {"error": "Poll not found."}
@@ -1005,9 +801,12 @@ async def submitted_ranking_information(id, owner_id):
             print("Not a owner.")
             return {"error": "You must be the owner to view the ranking data."}
         
-        unranked_candidates = [c for c in document["candidates"] if all([c not in b["ranking"].keys() for b in document["ballots"]])]
-        
-        num_empty_ballots = len([b for b in document["ballots"] if all([c not in b["ranking"].keys() for c in document["candidates"]])])
+        # everything here is computed from the ranking types in the tally, without
+        # loading the ballots
+        tally = await ensure_tally(document)
+        unranked_candidates = [c for c, n in zip(document["candidates"], tally["ranked"]) if n == 0]
+        empty_key = ranking_key({}, {c: i for i, c in enumerate(document["candidates"])})
+        num_empty_ballots = tally["types"].get(empty_key, 0)
         cand_to_cidx = {c: str(i) for i, c in enumerate(document["candidates"])}
         cmap = {str(cidx):c for c,cidx in cand_to_cidx.items()}
 
@@ -1021,12 +820,9 @@ async def submitted_ranking_information(id, owner_id):
             "cmap": cmap,
         }
 
-        if len(document["ballots"]) > 0:
+        if tally["num_ballots"] > 0:
 
-            prof = ProfileWithTies([{cand_to_cidx[c]: rank 
-                                     for c,rank in r["ranking"].items()} 
-                                     for r in document["ballots"]])
-            prof.display()
+            prof = tally_profile(tally)
             num_voters = prof.num_voters
             print(num_voters)
             columns, num_rows = generate_columns_from_profiles(prof)
@@ -1037,6 +833,136 @@ async def submitted_ranking_information(id, owner_id):
     return resp
 
 
+async def export_rankings(id, owner_id):
+    """The rankings of the poll as csv rows, for the owner's download: a header with
+    all the candidates, then one row per distinct ranking with its number of ballots.
+    Returns the file name and an async iterator over the lines of the file, built
+    one row at a time from the ranking types in the poll's tally."""
+    if not ObjectId.is_valid(id):
+        return {"error": "Poll not found."}
+    document = await get_poll(id, ["owner_id", "title", "candidates", "ballot_storage", "tally"])
+    if document is None:
+        return {"error": "Poll not found."}
+    if document["owner_id"] != owner_id:
+        return {"error": "You must be the owner to export the rankings."}
+
+    tally = await ensure_tally(document)
+    candidates = document["candidates"]
+    # rankings that only differ in their rank numbers share a row
+    types = [(key, n) for key, n in tally["types"].items() if n > 0]
+    rankings, counts = group_rankings(
+        [normalized_ranks(ranking_from_key(key)) for key, _ in types],
+        {i: i for i in range(len(candidates))},
+        counts=[n for _, n in types])
+
+    async def lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in iter_csv_rows(zip(rankings, counts), range(len(candidates)), candidates):
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    return {"filename": f"poll_{id}_rankings.csv", "lines": lines()}
+
+
+async def poll_result(document, can_view=True):
+    """The result of the poll (its outcome, candidate map and show_rankings), the
+    error message and whether computing the outcome timed out. The outcome is empty
+    if there are no ballots or it cannot be viewed."""
+    tally = await ensure_tally(document)
+    timed_out = False
+    if can_view and tally["num_ballots"] > 0:
+        outcome = cached_outcome(document)
+        if outcome is None:
+            try:
+                outcome = await compute.run(tally_outcome, tally, timeout=compute.OUTCOME_TIMEOUT)
+                await store_outcome(document, outcome)
+            except compute.ComputeTimeout:
+                timed_out = True
+                outcome = {**EMPTY_OUTCOME, "error": "The outcome is taking too long to compute, please try again later."}
+    else:
+        outcome = EMPTY_OUTCOME
+    result = {k: v for k, v in outcome.items() if k != "error"}
+    result["cmap"] = {str(i): c for i, c in enumerate(document["candidates"])}
+    result["show_rankings"] = document["show_rankings"]
+    result["selected_sv_winner"] = None # only set if the poll is completed
+    return result, outcome.get("error", ''), timed_out
+
+
+async def final_ranking(document):
+    """The ranking tiers of a closed poll (see poll_ranking), or None if computing
+    them timed out: the ranking is then computed when it is first viewed."""
+    tally = await ensure_tally(document)
+    if tally["num_ballots"] == 0:
+        return []
+    tiers = cached_ranking(document)
+    if tiers is None:
+        try:
+            tiers = await compute.run(tally_ranking_tiers, tally, len(document["candidates"]) + 1,
+                                      timeout=compute.RANKING_TIMEOUT)
+        except compute.ComputeTimeout:
+            return None
+    return tiers
+
+
+async def save_result(document, result, ranking=None):
+    """Save the result (and the ranking) of a closed poll and mark the poll completed,
+    unless a result was saved in the meantime (by another request or process).
+    Returns the result saved in the poll, so every caller gets the same one. If there
+    is a tie, one of the Stable Voting winners is selected at random."""
+    if len(result["sv_winners"]) > 1:
+        result["selected_sv_winner"] = random.choice(result["sv_winners"])
+    saved = await db.update_one(
+        {"_id": document["_id"], "result": None},
+        {"$set": {"result": result, "ranking": ranking, "is_completed": True}})
+    if saved.matched_count == 0:
+        stored = await db.find_one({"_id": document["_id"]}, {"result": 1})
+        if stored is not None and stored.get("result", None) is not None:
+            return stored["result"]
+    return result
+
+
+# the finalizations running in this process, by poll id, so the requests for a poll
+# that just closed share one computation
+_finalizing = dict()
+
+
+async def _finalize(document):
+    await ensure_tally(document)
+    # the outcome and the ranking are computed side by side, in two workers
+    (result, error_message, timed_out), ranking = await asyncio.gather(
+        poll_result(document), final_ranking(document))
+    if not timed_out:
+        result = await save_result(document, result, ranking)
+    return result, error_message, timed_out
+
+
+async def finalize_result(document):
+    """poll_result for a closed poll, saved with save_result. The concurrent calls for
+    the same poll wait for the first one instead of computing the result again."""
+    id = str(document["_id"])
+    if id not in _finalizing:
+        task = asyncio.ensure_future(_finalize(document))
+        _finalizing[id] = task
+        task.add_done_callback(lambda _: _finalizing.pop(id, None))
+    # a cancelled request does not cancel the computation the others wait for
+    result, error_message, timed_out = await asyncio.shield(_finalizing[id])
+    return dict(result), error_message, timed_out
+
+
+async def finalize_poll(id):
+    """Compute and save the result and the ranking of a closed poll (see
+    polls/scheduler.py). Returns False if computing the outcome timed out, so the
+    poll is tried again later."""
+    document = await get_poll(id, OUTCOME_PROJECTION)
+    if document is None or document.get("result", None) is not None:
+        return True
+    _, _, timed_out = await finalize_result(document)
+    return not timed_out
+
+
 async def poll_outcome(id, owner_id, voter_id):
     print("Generating poll outcome for ", id)
     print("Owner id ", owner_id)
@@ -1044,17 +970,13 @@ async def poll_outcome(id, owner_id, voter_id):
     if not ObjectId.is_valid(id): 
         return {"error": "Poll not found."}
     print("Getting document...")
-    document = await db.find_one({"_id": ObjectId(id)}) 
+    document = await get_poll(id, OUTCOME_PROJECTION)
     print("got document")
-    print(document)
     error_message = ''
     if document is None: # poll not found
         print("Poll not found.")
         return {"error": "Poll not found."}
     else: 
-        cand_to_cidx = {c: str(i) for i, c in enumerate(document["candidates"])}
-        cmap = {str(cidx):c for c,cidx in cand_to_cidx.items()}
-
         is_voter, is_owner = voter_type(document, voter_id, owner_id)
 
         can_view = can_view_outcome(
@@ -1070,7 +992,6 @@ async def poll_outcome(id, owner_id, voter_id):
         print("can_view ", can_view)
         title = str(document["title"])
         print("title", title)
-        print(document)
         closing_datetime =  dt_string(document.get("closing_datetime", None), document.get("timezone", None))
         timezone = document.get("timezone") or "N/A"
         is_closed = poll_closed(document.get("closing_datetime", None), document.get("timezone", None))
@@ -1079,90 +1000,16 @@ async def poll_outcome(id, owner_id, voter_id):
         print(document.get("result", None))
         print(document.get("is_completed", False) and document.get("result", None) is not None)
 
-        if document.get("is_completed", False) and document.get("result", None) is not None: 
+        if not can_view:
+            result, error_message, _ = await poll_result(document, can_view)
+        elif document.get("is_completed", False) and document.get("result", None) is not None: 
             """The poll is completed and there is a saved result."""
             result = document["result"]
+        elif is_closed or document.get("is_completed", False):
+            # close the poll and save the result (including the selected winner if there is a tie)
+            result, error_message, _ = await finalize_result(document)
         else: # otherwise generate the result.    
-            show_rankings = document["show_rankings"] 
-            margins= {}
-            num_voters = 0
-            sv_winners = []
-            sc_winners = []
-            condorcet_winner = "N/A"
-            defeat_relation = {}
-            explanations = {}
-            prof_is_linear = False
-            linear_order = []
-            splitting_numbers = {}
-            num_rows = 0
-            columns = [[]]
-            if can_view and len(document["ballots"]) > 0:
-
-                prof = ProfileWithTies([{cand_to_cidx[c]: rank 
-                                         for c,rank in r["ranking"].items()} 
-                                         for r in document["ballots"]])
-                prof.display()
-
-                if not any([len(list(r.rmap.keys())) > 0 for r in prof.rankings]):
-                    error_message = "No candidates are ranked."
-                else: 
-                    margins = {c1: {c2: prof.margin(c1, c2) for c2 in prof.candidates} for c1 in prof.candidates}
-                    condorcet_winner = prof.condorcet_winner()
-
-                    try:
-                        sc_defeat = func_timeout(2, split_cycle_defeat, args=(prof,), kwargs=None)
-                        sc_winners = [str(c) for c in prof.candidates if not any([c2 for c2 in prof.candidates if sc_defeat.has_edge(c2,c)])]
-                        defeat_relation = {str(c): {str(c2): sc_defeat.has_edge(c,c2) for c2 in prof.candidates} for c in prof.candidates }
-                    except FunctionTimedOut:
-                        sc_defeat = dict()
-                        sc_winners = split_cycle(prof)
-                        defeat_relation = {str(c): {} for c in prof.candidates }
-
-                    try:
-                        sv_winners, _, explanations = func_timeout(2, stable_voting_with_explanations_, args=(prof,), kwargs = {"curr_cands": None, "mem_sv_winners": {}, "explanations": {}})
-                    except FunctionTimedOut:
-                        sv_winners = stable_voting(prof)
-                        explanations = dict()
-
-                    num_voters = prof.num_voters
-                    prof_is_linear, linear_order = is_linear(prof)
-                    columns, num_rows = generate_columns_from_profiles(prof)
-                    if condorcet_winner is None: 
-                        try:
-                            splitting_numbers = func_timeout(2, get_splitting_numbers, args=(prof,), kwargs=None)
-                        except FunctionTimedOut:
-                            splitting_numbers = {}
-                    else: 
-                        splitting_numbers = {}
-
-            result = {
-                "margins": margins, 
-                "num_voters": str(num_voters),
-                "cmap": cmap,
-                "show_rankings": show_rankings, 
-                "sv_winners": sv_winners, 
-                "sc_winners": sc_winners, 
-                "selected_sv_winner": None, # only set if the poll is completed
-                "condorcet_winner": condorcet_winner, 
-                "explanations": explanations,
-                "defeats": defeat_relation,
-                "splitting_numbers": splitting_numbers,
-                "prof_is_linear": prof_is_linear,
-                "linear_order": linear_order if prof_is_linear else [],
-                "num_rows": num_rows,
-                "columns":columns,
-                }
-
-            if is_closed or document.get("is_completed", False):
-                # close the poll and save the result (including the selected winner if there is a tie)
-                if len(sv_winners) > 1:
-                    selected_sv_winner = random.choice(sv_winners)
-                    result["selected_sv_winner"] = selected_sv_winner
-
-                await db.update_one( {"_id": ObjectId(id)}, {"$set": {"result": result, "is_completed": True}})
-            else:
-                # the poll is still open, so remove any saved result
-                await db.update_one( {"_id": ObjectId(id)}, {"$set": {"result": None}})
+            result, error_message, _ = await poll_result(document, can_view)
 
     result["title"] = title
     result["is_closed"] = is_closed
@@ -1177,64 +1024,18 @@ async def poll_outcome(id, owner_id, voter_id):
     return result
 
 
-def _tier_payload(prof, keep):
-    """Results-page payload (margins / defeats / explanations / splitting numbers /
-    linear order / sv+sc winners) for `prof` restricted to the candidates in `keep`.
-    This is the IDENTICAL computation to poll_outcome, so each ranking tier reuses
-    the exact same explanation the winner page shows."""
-    keep_set = set(keep)
-    rp = ProfileWithTies(
-        [{c: rk for c, rk in b.rmap.items() if c in keep_set} for b in prof.rankings],
-        rcounts=prof.rcounts,
-        candidates=sorted(keep),
-    )
-    cands = list(rp.candidates)
-    margins = {c1: {c2: rp.margin(c1, c2) for c2 in cands} for c1 in cands}
-    condorcet_winner = rp.condorcet_winner()
-    try:
-        sc_defeat = func_timeout(2, split_cycle_defeat, args=(rp,), kwargs=None)
-        sc_winners = [str(c) for c in cands if not any(sc_defeat.has_edge(c2, c) for c2 in cands)]
-        defeat_relation = {str(c): {str(c2): sc_defeat.has_edge(c, c2) for c2 in cands} for c in cands}
-    except FunctionTimedOut:
-        sc_winners = [str(c) for c in split_cycle(rp)]
-        defeat_relation = {str(c): {} for c in cands}
-    try:
-        sv_winners, _, explanations = func_timeout(
-            20, stable_voting_with_explanations_, args=(rp,),
-            kwargs={"curr_cands": None, "mem_sv_winners": {}, "explanations": {}})
-    except FunctionTimedOut:
-        sv_winners = stable_voting(rp)
-        explanations = {}
-    prof_is_linear, linear_order = is_linear(rp)
-    if condorcet_winner is None:
-        try:
-            splitting_numbers = func_timeout(2, get_splitting_numbers, args=(rp,), kwargs=None)
-        except FunctionTimedOut:
-            splitting_numbers = {}
-    else:
-        splitting_numbers = {}
-    return {
-        "margins": margins,
-        "sv_winners": [str(w) for w in sv_winners],
-        "sc_winners": sc_winners,
-        "condorcet_winner": str(condorcet_winner) if condorcet_winner is not None else None,
-        "explanations": explanations,
-        "defeats": defeat_relation,
-        "splitting_numbers": splitting_numbers,
-        "prof_is_linear": prof_is_linear,
-        "linear_order": [str(c) for c in linear_order] if prof_is_linear else [],
-    }
-
-
 async def poll_ranking(id, owner_id, voter_id):
     """Stable Voting ranking: the Stable Voting winner(s) are rank 1; set them aside
     and recompute for rank 2, and so on (dense numbering — a tie shares a rank, the
     next tier gets the next number). Each tier carries the same payload the results
     page uses, restricted to the candidates still in contention. Access control
-    mirrors poll_outcome."""
+    mirrors poll_outcome.
+
+    The tiers are cached by ballot version while the poll is open and saved in the
+    poll once it is closed, so views of a closed poll's ranking are plain reads."""
     if not ObjectId.is_valid(id):
         return {"error": "Poll not found."}
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await get_poll(id, RANKING_PROJECTION)
     if document is None:
         return {"error": "Poll not found."}
     cand_to_cidx = {c: str(i) for i, c in enumerate(document["candidates"])}
@@ -1247,25 +1048,23 @@ async def poll_ranking(id, owner_id, voter_id):
     base = {"cmap": cmap, "election_id": str(id), "title": str(document["title"]), "can_view": can_view}
     if not can_view:
         return {**base, "tiers": []}
-    if len(document.get("ballots", [])) == 0:
+    is_closed = document.get("is_completed", False) or poll_closed(
+        document.get("closing_datetime", None), document.get("timezone", None))
+    if is_closed and document.get("ranking", None) is not None:
+        return {**base, "tiers": document["ranking"]}
+    tally = await ensure_tally(document)
+    if tally["num_ballots"] == 0:
         return {**base, "tiers": []}
-    prof = ProfileWithTies([{cand_to_cidx[c]: rank for c, rank in r["ranking"].items()}
-                            for r in document["ballots"]])
-    if not any(len(list(r.rmap.keys())) > 0 for r in prof.rankings):
-        return {**base, "tiers": []}
-
-    remaining = sorted(prof.candidates)
-    tiers = []
-    rank = 1
-    while remaining and rank <= len(cmap) + 1:
-        payload = _tier_payload(prof, remaining)
-        winners = payload["sv_winners"]
-        if not winners:
-            break
-        tiers.append({"rank": rank, **payload})
-        win_set = set(winners)
-        remaining = [c for c in remaining if c not in win_set]
-        rank += 1
+    tiers = cached_ranking(document)
+    if tiers is None:
+        try:
+            tiers = await compute.run(tally_ranking_tiers, tally, len(cmap) + 1, timeout=compute.RANKING_TIMEOUT)
+        except compute.ComputeTimeout:
+            return {**base, "tiers": [], "error": "The ranking is taking too long to compute, please try again later."}
+        await store_ranking(document, tiers)
+    if is_closed:
+        # no more ballots can be submitted: save the ranking with the result
+        await db.update_one({"_id": ObjectId(id)}, {"$set": {"ranking": tiers}})
     return {**base, "tiers": tiers}
 
 
@@ -1277,28 +1076,18 @@ async def demo_poll_outcome(rankings):
     timezone = "N/A"
     is_closed = False
     show_rankings = True 
-    margins= {}
-    num_voters = 0
-
-    ballots = list()
-    for r in rankings: 
-        print(r)
-        for n in range(int(r["num"])): 
-            ballots.append(r["ranking"])
-    _prof = ProfileWithTies([r for r in ballots])
-    _prof.display()
-    curr_rankings, counts = _prof.rankings_as_dicts_counts
-    cand_to_cindex = {str(c): i for i,c in enumerate(_prof.candidates)}
-    cmap = {cindx: str(c) for c, cindx in cand_to_cindex.items()}
-
-    prof = ProfileWithTies([{cand_to_cindex[c]: r 
-                             for c, r in rank.items()} 
-                             for rank in curr_rankings], rcounts=counts)
-    
-    prof.display()
-    print(cmap)
-    num_ranked_cands = len(list(set([_c  for _r in prof.rankings for _c in _r.rmap.keys()])))
-    if num_ranked_cands == 0: #not any([len(list(r.rmap.keys())) > 0 for r in prof.rankings]):
+
+    # group identical rankings (as strings of candidates) in a single pass
+    cands = sorted(set(str(c) for r in rankings for c in r["ranking"].keys()))
+    cand_to_cindex = {c: i for i, c in enumerate(cands)}
+    cmap = {cindx: c for c, cindx in cand_to_cindex.items()}
+    prof = build_profile(
+        [{str(c): rank for c, rank in r["ranking"].items()} for r in rankings],
+        cand_to_cindex,
+        counts=[int(r["num"]) for r in rankings])
+
+    num_ranked_cands = len(prof.candidates)
+    if num_ranked_cands == 0:
         columns, num_rows = generate_columns_from_profiles(prof)
         result = {
             "no_candidates_ranked": True,
@@ -1319,55 +1108,18 @@ async def demo_poll_outcome(rankings):
             "cmap": cmap,
         }
     else:
-        margins = {c1: {c2: prof.margin(c1, c2) for c2 in prof.candidates} for c1 in prof.candidates}
-        condorcet_winner = prof.condorcet_winner()
-
         try:
-            sc_defeat = func_timeout(2, split_cycle_defeat, args=(prof,), kwargs=None)
-            sc_winners = [str(c) for c in prof.candidates if not any([c2 for c2 in prof.candidates if sc_defeat.has_edge(c2,c)])]
-            defeat_relation = {str(c): {str(c2): sc_defeat.has_edge(c,c2) for c2 in prof.candidates} for c in prof.candidates }
-        except FunctionTimedOut:
-            sc_defeat = dict()
-            sc_winners = split_cycle(prof)
-            defeat_relation = {str(c): {} for c in prof.candidates }
-
-        try:
-            sv_winners, _, explanations = func_timeout(2, stable_voting_with_explanations_, args=(prof,), kwargs = {"curr_cands": None, "mem_sv_winners": {}, "explanations": {}})
-        except FunctionTimedOut:
-            sv_winners = stable_voting(prof)
-            explanations = dict()
-
-        num_voters = prof.num_voters
-        prof_is_linear, linear_order = is_linear(prof)
-        columns, num_rows = generate_columns_from_profiles(prof)
-        if condorcet_winner is None: 
-            try:
-                splitting_numbers = func_timeout(2, get_splitting_numbers, args=(prof,), kwargs=None)
-            except FunctionTimedOut:
-                splitting_numbers = {}
-                        #splitting_numbers = get_splitting_numbers(prof)
-        else: 
-            splitting_numbers = {}
-
+            outcome = await compute.run(profile_outcome, prof, timeout=compute.OUTCOME_TIMEOUT)
+        except compute.ComputeTimeout:
+            outcome = {**EMPTY_OUTCOME, "error": "The outcome is taking too long to compute, please try again later."}
         result = {
-            "margins": margins, 
-            "num_voters": str(num_voters),
+            **outcome,
             "show_rankings": show_rankings, 
-            "sv_winners": sv_winners, 
-            "sc_winners": sc_winners, 
             "selected_sv_winner": None, # only set if the poll is completed
-            "condorcet_winner": condorcet_winner, 
-            "explanations": explanations,
-            "defeats": defeat_relation,
-            "splitting_numbers": splitting_numbers,
-            "prof_is_linear": prof_is_linear,
-            "linear_order": linear_order if prof_is_linear else [],
-            "num_rows": num_rows,
-            "columns":columns,
             "cmap": cmap,
             }
-        if len(sv_winners) > 1: 
-            selected_sv_winner = random.choice(sv_winners)
+        if len(result["sv_winners"]) > 1: 
+            selected_sv_winner = random.choice(result["sv_winners"])
             result["selected_sv_winner"] = selected_sv_winner
 
     if num_ranked_cands == 1: 
@@ -1394,12 +1146,12 @@ async def demo_poll_outcome(rankings):
     return result
 
 
-async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str, background_tasks: BackgroundTasks):
+async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str):
     """Resend invitation email to a voter with a new voting link."""
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await get_poll(poll_id, VOTER_FIELDS)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -1437,40 +1189,32 @@ async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str, back
     del voter_email_map[voter_id]
     voter_email_map[new_voter_id] = voter_email
     
-    # Update any existing ballot to use the new voter_id
-    ballots = document["ballots"]
-    for ballot in ballots:
-        if ballot.get("voter_id") == voter_id:
-            ballot["voter_id"] = new_voter_id
-    
     # Increment email send count
     email_send_counts[voter_email] = email_send_counts.get(voter_email, 1) + 1
     
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
+    # Update the database, moving any existing ballot over to the new voter_id
+    result = await rename_voter(document, voter_id, new_voter_id, {
+        "$set": {
             "voter_ids": voter_ids,
             "voter_email_map": voter_email_map,
             "email_send_counts": email_send_counts,
-            "ballots": ballots
-        }}
-    )
+        }})
     
     if result.modified_count > 0:
         # Send email with new link
         if not SKIP_EMAILS:
-            link = f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_id}"
+            link = vote_link(poll_id, new_voter_id)
             
-            background_tasks.add_task(
-                send_email,
-                to_email=voter_email,
-                subject=f"Reminder: Participate in the poll - {document['title']}",
-                html_body=f"""<p>This is a reminder to participate in the poll.</p>
+            await enqueue_emails(
+                [{
+                    "to_email": voter_email,
+                    "subject": f"Reminder: Participate in the poll - {document['title']}",
+                    "html_body": f"""<p>This is a reminder to participate in the poll.</p>
                 <p>Poll: {document['title']}</p>
                 <p>Description: {document.get('description', '')}</p>
                 <p>Your voting link: <a href="{link}">{link}</a></p>
                 <p>Note: This new link replaces any previous links sent to you.</p>""",
+                }],
                 tag="voter-invitation-resend"
             )
         
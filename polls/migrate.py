@@ -0,0 +1,52 @@
+#
+# Move the embedded ballots of existing polls into the Ballots collection:
+#
+#   python -m polls.migrate
+#
+# Rebuild the tallies of the polls whose ballots are in the Ballots collection
+# from their ballots (see rebuild_tally in polls/storage.py):
+#
+#   python -m polls.migrate tallies
+#
+
+import asyncio
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from polls.storage import db, ensure_indexes, migrate_to_collection, rebuild_tally, COLLECTION
+
+
+async def migrate_ballots():
+    await ensure_indexes()
+    num_polls = num_ballots = 0
+    cursor = db.find({"ballot_storage": {"$ne": COLLECTION}}, {"_id": 1})
+    async for doc in cursor:
+        moved = await migrate_to_collection(doc["_id"])
+        if moved is not None:
+            num_polls += 1
+            num_ballots += moved
+            print(f"moved {moved} ballots of poll {doc['_id']}")
+    print(f"moved {num_ballots} ballots of {num_polls} polls to the Ballots collection")
+
+
+async def rebuild_tallies():
+    num_polls = num_fixed = 0
+    cursor = db.find({"ballot_storage": COLLECTION}, {"tally": 1})
+    async for doc in cursor:
+        num_polls += 1
+        result = await rebuild_tally(doc)
+        if result is not None and result.matched_count > 0:
+            rebuilt = await db.find_one({"_id": doc["_id"]}, {"tally": 1})
+            if rebuilt["tally"] != doc.get("tally"):
+                num_fixed += 1
+                print(f"repaired the tally of poll {doc['_id']}")
+    print(f"rebuilt the tallies of {num_polls} polls, {num_fixed} of them were wrong")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["tallies"]:
+        asyncio.run(rebuild_tallies())
+    else:
+        asyncio.run(migrate_ballots())
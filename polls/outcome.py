@@ -0,0 +1,228 @@
+#
+# Outcome computations
+#
+# The CPU-heavy part of the results pages, as plain functions of a profile or a
+# tally with no database access, so they can run in the compute service's worker
+# processes (see polls/compute.py).
+#
+# pref_voting and the Stable Voting engine (numpy) are imported by the functions,
+# so they are only loaded in the processes that compute outcomes and importing
+# this module to submit its functions to the compute service stays cheap.
+#
+# Most polls are decided by their margin matrix alone: there is a Condorcet winner
+# (in particular when the majority relation is a linear order) or there are two
+# candidates. fast_outcome fills the results page of those directly and only the
+# other polls go through the Stable Voting engine. The outcome of a tally is
+# computed from its support matrix and ranking types, without building a profile.
+#
+
+from polls.voting import (
+    tuple_to_str, margin_matrix, majority_relations, linear_order,
+    columns_from_rankings, generate_columns_from_profiles,
+)
+from polls.tally import tally_rankings, tally_margin_matrix
+
+# the outcome shown when there are no ballots or the outcome cannot be viewed
+EMPTY_OUTCOME = {
+    "margins": {},
+    "num_voters": "0",
+    "sv_winners": [],
+    "sc_winners": [],
+    "condorcet_winner": "N/A",
+    "explanations": {},
+    "defeats": {},
+    "splitting_numbers": {},
+    "prof_is_linear": False,
+    "linear_order": [],
+    "num_rows": 0,
+    "columns": [[]],
+}
+
+
+def _majority(engine, curr_cands=None):
+    """The Condorcet winner (or None) and the linear order (see linear_order) of
+    the candidates in curr_cands (all of them by default), from the engine's
+    margin matrix."""
+    cands, margins = engine.submatrix(curr_cands)
+    relations = majority_relations(margins)
+    cw = relations["condorcet_winner"]
+    return (cands[cw] if cw is not None else None,
+            linear_order(cands, relations["num_losses"]))
+
+
+def fast_outcome(cands, margins):
+    """The part of the results page computed from the margins (see margins_outcome)
+    when the profile is decided without the Stable Voting recursion: there is a
+    Condorcet winner or there are two candidates. None for the other profiles. The
+    candidates must be sorted, as the engine sorts them."""
+    import numpy as np
+    from polls.sv_engine import split_cycle_defeats
+    M = np.asarray(margins, dtype=np.int64)
+    relations = majority_relations(M)
+    cw = relations["condorcet_winner"]
+    if len(cands) == 1:
+        sv_winners = list(cands)
+        explanations = {tuple_to_str(cands): {}}
+    elif cw is not None:
+        # the Condorcet winner is the only candidate Split Cycle does not defeat
+        sv_winners = [cands[cw]]
+        explanations = {tuple_to_str(cands): {"is_uniquely_undefeated": {
+            'winner': tuple_to_str(sv_winners), 'is_condorcet_winner': True}}}
+    elif len(cands) == 2:
+        # a tie: each candidate wins its match against the other one
+        a, b = cands
+        sv_winners = [a, b]
+        explanations = {
+            tuple_to_str([a]): {},
+            tuple_to_str(cands): {
+                tuple_to_str((x, y)): {
+                    'margin': str(int(M[0, 1])),
+                    'cands_minus_b': tuple_to_str([x]),
+                    'undefeated_cands': tuple_to_str(cands),
+                    'winner': tuple_to_str([x])}
+                for x, y in [(a, b), (b, a)]},
+            tuple_to_str([b]): {},
+        }
+    else:
+        return None
+    # without a majority cycle every majority edge is a Split Cycle defeat
+    D = split_cycle_defeats(M) if relations["cycle"] else M > 0
+    prof_is_linear, order = linear_order(cands, relations["num_losses"])
+    return {
+        "margins": {c1: {c2: int(M[i, j]) for j, c2 in enumerate(cands)}
+                    for i, c1 in enumerate(cands)},
+        "sv_winners": sv_winners,
+        "sc_winners": [str(c) for i, c in enumerate(cands) if not D[:, i].any()],
+        "condorcet_winner": cands[cw] if cw is not None else None,
+        "explanations": explanations,
+        "defeats": {str(a): {str(b): bool(D[i, j]) for j, b in enumerate(cands)}
+                    for i, a in enumerate(cands)},
+        "splitting_numbers": {},
+        "prof_is_linear": prof_is_linear,
+        "linear_order": order if prof_is_linear else [],
+    }
+
+
+def _engine_outcome(engine, curr_cands=None):
+    """margins_outcome for the candidates in curr_cands (all of them by default),
+    computed by the Stable Voting engine."""
+    cands, margins = engine.submatrix(curr_cands)
+    condorcet_winner, (prof_is_linear, order) = _majority(engine, curr_cands)
+    return {
+        "margins": {c1: {c2: int(margins[i, j]) for j, c2 in enumerate(cands)}
+                    for i, c1 in enumerate(cands)},
+        "sv_winners": engine.winners(curr_cands),
+        "sc_winners": engine.split_cycle_winners(curr_cands),
+        "condorcet_winner": condorcet_winner,
+        "explanations": engine.explanations(curr_cands),
+        "defeats": engine.defeat_relation(curr_cands),
+        "splitting_numbers": engine.splitting_numbers(curr_cands) if condorcet_winner is None else {},
+        "prof_is_linear": prof_is_linear,
+        "linear_order": order if prof_is_linear else [],
+    }
+
+
+def margins_outcome(cands, margins):
+    """The part of the results page computed from the margins between the candidates:
+    the margins, the winners and their explanations, the defeats, the splitting
+    numbers and the linear order."""
+    from polls.sv_engine import StableVotingEngine
+    engine = StableVotingEngine(cands, margins)
+    return fast_outcome(*engine.submatrix()) or _engine_outcome(engine)
+
+
+def profile_outcome(prof):
+    """The part of the results page computed from the ballots."""
+    if len(prof.candidates) == 0:
+        return {**EMPTY_OUTCOME, "error": "No candidates are ranked."}
+    columns, num_rows = generate_columns_from_profiles(prof)
+    return {
+        **margins_outcome(*margin_matrix(prof)),
+        "num_voters": str(prof.num_voters),
+        "num_rows": num_rows,
+        "columns": columns,
+    }
+
+
+def tally_outcome(tally):
+    """profile_outcome for the ballots summarized by a tally (see polls/tally.py)."""
+    # computed from the support matrix and the ranking types, so it does not depend
+    # on the number of ballots
+    cands, margins = tally_margin_matrix(tally)
+    if len(cands) == 0:
+        return {**EMPTY_OUTCOME, "error": "No candidates are ranked."}
+    rankings = tally_rankings(tally)
+    columns, num_rows = columns_from_rankings(rankings)
+    return {
+        **margins_outcome(cands, margins),
+        "num_voters": str(sum(n for _, n in rankings)),
+        "num_rows": num_rows,
+        "columns": columns,
+    }
+
+
+def tier_payload(engine, keep):
+    """Results-page payload (margins / defeats / explanations / splitting numbers /
+    linear order / sv+sc winners) for the engine's profile restricted to the
+    candidates in `keep`. This is the IDENTICAL computation to poll_outcome, so each
+    ranking tier reuses the exact same explanation the winner page shows."""
+    payload = fast_outcome(*engine.submatrix(keep)) or _engine_outcome(engine, keep)
+    condorcet_winner = payload["condorcet_winner"]
+    return {
+        **payload,
+        "sv_winners": [str(w) for w in payload["sv_winners"]],
+        "condorcet_winner": str(condorcet_winner) if condorcet_winner is not None else None,
+        "linear_order": [str(c) for c in payload["linear_order"]],
+    }
+
+
+def tally_ranking_tiers(tally, max_rank):
+    """Stable Voting ranking: the Stable Voting winner(s) are rank 1; set them aside
+    and recompute for rank 2, and so on, with the tier_payload of each rank.
+
+    All the tiers share one engine: its margin matrix is computed once and the
+    winners of every subset solved for one tier are memoized for the next ones."""
+    from polls.sv_engine import StableVotingEngine
+    engine = StableVotingEngine(*tally_margin_matrix(tally))
+    remaining = list(engine.candidates)
+    tiers = []
+    rank = 1
+    while remaining and rank <= max_rank:
+        payload = tier_payload(engine, remaining)
+        winners = payload["sv_winners"]
+        if not winners:
+            break
+        tiers.append({"rank": rank, **payload})
+        win_set = set(winners)
+        remaining = [c for c in remaining if c not in win_set]
+        rank += 1
+    return tiers
+
+
+def _sv_winners_only(prof, curr_cands=None):
+    """Stable Voting winners via the site's own routine (split-cycle based, so it
+    stays feasible on large polls) — matches what the results page shows, unlike
+    pref_voting's raw stable_voting which recurses over every candidate."""
+    from polls.sv_engine import StableVotingEngine
+    return StableVotingEngine.from_profile(prof).winners(curr_cands)
+
+
+# the names of the voting methods compared on the superuser dashboard
+SU_METHOD_NAMES = ["Minimax", "Copeland", "Stable Voting", "Split Cycle", "MWSL", "Borda", "IRV"]
+
+
+def su_method(name):
+    """The dashboard method with the given name."""
+    from pref_voting.voting_methods import (
+        split_cycle, minimax, copeland, MWSL, borda_for_profile_with_ties, approval_irv,
+    )
+    return {
+        "Minimax": minimax, "Copeland": copeland, "Stable Voting": _sv_winners_only,
+        "Split Cycle": split_cycle, "MWSL": MWSL,
+        "Borda": borda_for_profile_with_ties, "IRV": approval_irv,
+    }[name]
+
+
+def method_winners(name, prof):
+    """The winners (as strings) of the dashboard method with the given name."""
+    return frozenset(str(c) for c in su_method(name)(prof))
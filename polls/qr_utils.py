@@ -1,4 +1,3 @@
-import qrcode
 from io import BytesIO
 import base64
 from typing import Optional
@@ -12,6 +11,7 @@ def generate_poll_qr_code(
     light_color: str = "#FFFFFF"
 ) -> dict:
     """Generate a QR code for a poll URL"""
+    import qrcode  # loaded on first use, as it pulls in PIL
     
     # Create QR code instance
     qr = qrcode.QRCode(
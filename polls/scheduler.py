@@ -0,0 +1,86 @@
+#
+# Finalization of closed polls
+#
+# A poll with a closing time gets its result saved (and is marked completed) when
+# the outcome is first viewed after it closes, so without this the first visitors
+# of a popular poll would all compute it. The scheduler instead finds, every
+# FINALIZE_INTERVAL seconds, the polls that closed and are not completed and saves
+# their result, along with their ranking. It runs in every process serving the app,
+# under a lease so that only one of them finalizes polls at a time.
+#
+# A poll whose outcome does not finish in time (and takes a results page worker
+# with it, see polls/compute.py) is tried again after a backoff that doubles with
+# each attempt, and left to its first viewers after FINALIZE_MAX_ATTEMPTS attempts.
+# The attempts are recorded in the poll ("finalize_attempts" and "finalize_after"),
+# and reset when the poll is reopened.
+#
+
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument
+
+from polls.lease import single_flight
+from polls.manage import finalize_poll, poll_closed
+from polls.storage import db
+
+FINALIZE_POLLS = os.getenv('FINALIZE_POLLS', 'True').lower() == 'true'
+FINALIZE_INTERVAL = float(os.getenv('FINALIZE_INTERVAL', 60))
+FINALIZE_MAX_ATTEMPTS = int(os.getenv('FINALIZE_MAX_ATTEMPTS', 5))
+
+
+async def due_polls():
+    """The ids of the polls that closed but have no saved result, except those that
+    are waiting for their next attempt or used up their attempts."""
+    # the closing times are strings with a timezone, so they are compared here
+    # rather than in the query; only the open polls with a closing time are read
+    cursor = db.find(
+        {"closing_datetime": {"$ne": None}, "result": None,
+         "finalize_attempts": {"$not": {"$gte": FINALIZE_MAX_ATTEMPTS}},
+         "$or": [{"finalize_after": None},
+                 {"finalize_after": {"$lte": datetime.now(timezone.utc)}}]},
+        {"closing_datetime": 1, "timezone": 1})
+    return [doc["_id"] async for doc in cursor
+            if poll_closed(doc["closing_datetime"], doc.get("timezone", None))]
+
+
+async def finalize_due_polls():
+    """Save the result of the polls that closed, one at a time. Returns the number of
+    polls finalized (None if another process is finalizing them)."""
+    async with single_flight("finalize_polls") as acquired:
+        if not acquired:
+            return None
+        finalized = 0
+        for id in await due_polls():
+            if await finalize_poll(id):
+                finalized += 1
+            else:
+                await postpone(id)
+        return finalized
+
+
+async def postpone(id):
+    """Record a failed attempt to finalize the poll and when to try again."""
+    doc = await db.find_one_and_update(
+        {"_id": id}, {"$inc": {"finalize_attempts": 1}},
+        {"finalize_attempts": 1}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        return
+    attempts = doc["finalize_attempts"]
+    if attempts >= FINALIZE_MAX_ATTEMPTS:
+        print(f"Gave up finalizing poll {id} after {attempts} attempts")
+        return
+    delay = FINALIZE_INTERVAL * 2 ** attempts
+    await db.update_one(
+        {"_id": id}, {"$set": {"finalize_after": datetime.now(timezone.utc) + timedelta(seconds=delay)}})
+
+
+async def run_scheduler():
+    while True:
+        try:
+            finalized = await finalize_due_polls()
+            if finalized:
+                print(f"Finalized {finalized} closed polls")
+        except Exception as e:
+            print(f"Finalizing the closed polls failed: {e}")
+        await asyncio.sleep(FINALIZE_INTERVAL)
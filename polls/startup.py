@@ -0,0 +1,77 @@
+#
+# Startup cost
+#
+# The heavy libraries (pref_voting, which pulls in numba, nashpy and networkx,
+# numpy and qrcode/PIL) are imported by the functions that use them, so a cold
+# start only pays for the app itself and a request that, e.g., submits a ballot
+# never loads them. With WARM_UP=true they are loaded in the background right
+# after startup instead, in the app process and in the compute service's
+# processes, so the first results page does not pay for them either.
+#
+# The import cost of each module, imported cold in a fresh interpreter:
+#
+#     python -m polls.startup [module ...]
+#
+
+import asyncio
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+from polls import compute
+
+WARM_UP = os.getenv('WARM_UP', 'False').lower() == 'true'
+
+# the modules imported on first use
+HEAVY_MODULES = [
+    "numpy", "pref_voting.profiles_with_ties", "pref_voting.voting_methods",
+    "qrcode", "PIL.Image", "polls.sv_engine",
+]
+# the modules imported at startup
+APP_MODULES = ["polls.storage", "polls.manage", "routers.polls", "main"]
+
+
+def import_modules(modules=HEAVY_MODULES):
+    """Import the modules; returns the seconds each took (0 if already imported)."""
+    timings = dict()
+    for name in modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+async def warm_up():
+    """Import the heavy modules in the app process (in a thread, so requests are
+    served meanwhile) and in the compute service's processes."""
+    start = time.perf_counter()
+    await asyncio.to_thread(import_modules)
+    # the compute service's processes import the modules when they start
+    try:
+        await compute.start()
+    except Exception as e:
+        print(f"Starting the compute service failed: {e}")
+    print(f"Warm-up done in {time.perf_counter() - start:.2f}s")
+
+
+def cold_import_time(module):
+    """Seconds to import the module in a fresh interpreter."""
+    code = ("import time; start = time.perf_counter(); import " + module
+            + "; print(time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(modules=APP_MODULES + HEAVY_MODULES):
+    width = max(len(m) for m in modules)
+    print(f"{'module':<{width}}  cold import (s)")
+    for module in modules:
+        print(f"{module:<{width}}  {cold_import_time(module):.3f}")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:] or APP_MODULES + HEAVY_MODULES)
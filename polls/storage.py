@@ -0,0 +1,476 @@
+#
+# Storage of polls and ballots
+#
+# A poll's ballots are stored in one of two ways, recorded in the poll's
+# "ballot_storage" field:
+#
+#   "embedded"    the ballots are an array in the poll document (polls created
+#                 before the Ballots collection existed, which have no field)
+#   "collection"  one document per ballot in the Ballots collection, keyed by
+#                 poll_id; (poll_id, voter_id) is unique for the ballots of voters
+#                 in private polls and (poll_id, ip) for public polls that accept
+#                 one ballot per address
+#
+# Either way the poll document carries the pairwise tally (see polls/tally.py), so
+# reading the poll never depends on the number of ballots. In the collection mode a
+# ballot write and the matching tally update (computed from the ballot that was
+# actually replaced or removed) are made in one transaction when the deployment
+# supports them (a replica set, e.g., Atlas). On a standalone server they are two
+# single-document updates, applied ballot first, and rebuild_tally repairs a tally
+# left behind by a crash in between (python -m polls.migrate tallies).
+#
+# Every update of the tally also increments the poll's "ballot_version", so anything
+# computed from the ballots (e.g., the cached outcome in polls/cache.py) can be
+# keyed by it.
+#
+# A ballot may carry a "count": it then stands for that many identical ballots (the
+# rankings imported in bulk are stored this way, one ballot per distinct ranking),
+# and the tally and everything computed from the ballots weight it accordingly.
+# Ballots submitted by voters never have a count.
+#
+
+import os
+from bson import ObjectId
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import certifi
+
+from polls.tally import ballots_inc, replace_inc, tally_from_ballots
+
+# MongoDB connection
+mongo_details = os.getenv('MONGODB_URI')
+
+# Check if we're in development (local MongoDB doesn't use SSL)
+if mongo_details and ('localhost' in mongo_details or '127.0.0.1' in mongo_details):
+    # Local connection without SSL
+    client = AsyncMongoClient(mongo_details)
+else:
+    # Production connection with SSL
+    client = AsyncMongoClient(mongo_details, tlsCAFile=certifi.where(), tls=True)
+
+data_base = os.getenv('MONGO_DB_NAME', 'StableVoting')
+db = client[data_base].Polls
+ballots_db = client[data_base].Ballots
+superuser_cache = client[data_base]["superuser_cache"]
+
+EMBEDDED = "embedded"
+COLLECTION = "collection"
+
+# how the ballots of newly created polls are stored
+BALLOT_STORAGE = os.getenv('BALLOT_STORAGE', COLLECTION)
+
+# number of times an update conditioned on a ballot read just before it is retried
+# when the ballot changed in between (e.g., a voter submitting twice at once)
+_CAS_RETRIES = 3
+
+_transactions = None
+
+
+async def _supports_transactions():
+    global _transactions
+    if _transactions is None:
+        hello = await client.admin.command("hello")
+        _transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions
+
+
+async def _atomically(write):
+    """Run write(session) in a transaction or, on a deployment without transactions,
+    run write(None). write may be run again if the transaction has to be retried."""
+    if not await _supports_transactions():
+        return await write(None)
+    async with client.start_session() as session:
+        return await session.with_transaction(write)
+
+
+def _at_version(version):
+    """The filter matching the poll while its ballot_version is version."""
+    return {"$expr": {"$eq": [{"$ifNull": ["$ballot_version", 0]}, version]}}
+
+
+# added to the filter of every update of an embedded ballots array, so that a request
+# that read the poll before migrate_to_collection moved its ballots cannot recreate
+# the array (see _moved_to_collection)
+_EMBEDDED = {"ballot_storage": {"$ne": COLLECTION}}
+
+
+async def ensure_indexes():
+    """Create the indexes on the Ballots collection and the closing times of the
+    polls (run at startup)."""
+    await db.create_index([("closing_datetime", 1)])
+    await ballots_db.create_index([("poll_id", 1)])
+    await ballots_db.create_index(
+        [("poll_id", 1), ("voter_id", 1)], unique=True,
+        partialFilterExpression={"unique_voter": True})
+    await ballots_db.create_index(
+        [("poll_id", 1), ("ip", 1)], unique=True,
+        partialFilterExpression={"unique_ip": True})
+
+
+# The fields of a poll document fetched by each kind of request. None of them
+# include the ballots (see iter_ballots); "tally.num_ballots" is enough to count the
+# ballots and for ensure_tally to know the poll has a tally.
+POLL_FIELDS = [
+    "title", "description", "hide_description", "candidates", "is_private", "owner_id",
+    "show_rankings", "closing_datetime", "timezone", "can_view_outcome_before_closing",
+    "show_outcome", "allow_multiple_votes", "is_completed", "creation_dt",
+    "ballot_storage", "tally.num_ballots",
+]
+# plus the voter list of private polls, for requests that check a voter id
+BALLOT_FIELDS = POLL_FIELDS + ["voter_ids"]
+# plus the voters' emails, for the owner's management of the voters
+VOTER_FIELDS = BALLOT_FIELDS + ["voter_email_map", "email_send_counts"]
+# everything but the ballots and emails, for the outcome (which needs the whole tally
+# and the saved result) and the ranking (the tally and the saved ranking)
+OUTCOME_PROJECTION = {"ballots": 0, "voter_email_map": 0, "email_send_counts": 0,
+                      "ranking": 0, "ranking_cache": 0}
+RANKING_PROJECTION = {"ballots": 0, "voter_email_map": 0, "email_send_counts": 0,
+                      "result": 0, "outcome_cache": 0}
+
+
+def _ballot_count_expr():
+    """Number of ballots, computed by the server: the tally's count or, for polls
+    without a tally, the size of the embedded ballots array."""
+    return {"$ifNull": ["$tally.num_ballots", {"$size": {"$ifNull": ["$ballots", []]}}]}
+
+
+async def get_poll(id, fields=None, count_ballots=False):
+    """Fetch the poll with the given id (a string or ObjectId) or None if there is no
+    such poll. fields is a list of fields to fetch or a projection dict (None fetches
+    the whole document). With count_ballots, num_ballots is set to the number of
+    ballots, counted by the server so the ballots are never transferred."""
+    query = {"_id": ObjectId(id)}
+    projection = {f: 1 for f in fields} if isinstance(fields, list) else fields
+    if not count_ballots:
+        return await db.find_one(query, projection)
+    if projection is None or any(v == 0 for v in projection.values()):
+        pipeline = [{"$match": query}, {"$addFields": {"num_ballots": _ballot_count_expr()}}]
+        if projection:
+            pipeline.append({"$project": projection})
+    else:
+        pipeline = [{"$match": query}, {"$project": {**projection, "num_ballots": _ballot_count_expr()}}]
+    cursor = await db.aggregate(pipeline)
+    docs = await cursor.to_list(length=1)
+    return docs[0] if docs else None
+
+
+def _bump(inc):
+    """The tally $inc of a ballot write, plus the increment of the poll's
+    ballot_version, which versions everything computed from the ballots."""
+    return {**inc, "ballot_version": 1}
+
+
+def ballot_storage(document):
+    return document.get("ballot_storage", EMBEDDED)
+
+
+def ballot_count(document):
+    """Number of ballots in the poll."""
+    if document.get("num_ballots") is not None:
+        return document["num_ballots"]
+    if document.get("tally") is not None:
+        return document["tally"]["num_ballots"]
+    return len(document.get("ballots", []))
+
+
+def _stored_ballot(document, b, **flags):
+    """The Ballots collection document for ballot b in the poll."""
+    return {"poll_id": document["_id"], **b, **{k: True for k, v in flags.items() if v}}
+
+
+def _ballot_fields(stored):
+    """Ballot b as it is stored in an embedded ballots array."""
+    return {k: v for k, v in stored.items() if k not in ("_id", "poll_id", "unique_voter", "unique_ip")}
+
+
+async def _moved_to_collection(document):
+    """Whether the ballots of the poll were moved to the Ballots collection since
+    document was read; document is then updated to store them there, so the write
+    that did not match can be made again."""
+    stored = await db.find_one({"_id": document["_id"]}, {"ballot_storage": 1})
+    if stored is None or ballot_storage(stored) != COLLECTION:
+        return False
+    document["ballot_storage"] = COLLECTION
+    document.pop("ballots", None)
+    return True
+
+
+async def iter_ballots(document):
+    """Iterate over the ballots of the poll."""
+    if ballot_storage(document) == COLLECTION:
+        async for stored in ballots_db.find({"poll_id": document["_id"]}):
+            yield _ballot_fields(stored)
+    else:
+        ballots = document.get("ballots")
+        if ballots is None:
+            doc = await db.find_one({"_id": document["_id"]}, {"ballots": 1})
+            ballots = doc.get("ballots", []) if doc is not None else []
+        for b in ballots:
+            yield b
+
+
+async def load_ballots(document):
+    return [b async for b in iter_ballots(document)]
+
+
+async def ensure_tally(document):
+    """Return the poll's pairwise tally. Polls created before tallies were kept get
+    one built from their ballots and stored. Every ballot write ensures the tally
+    first, so the tally can only be missing while the ballots are unchanged. A tally
+    fetched only in part (e.g., tally.num_ballots) is fetched whole."""
+    tally = document.get("tally")
+    if tally is not None and "types" not in tally:
+        stored = await db.find_one({"_id": document["_id"]}, {"tally": 1})
+        tally = stored.get("tally") if stored is not None else None
+    if tally is not None:
+        document["tally"] = tally
+        return tally
+    tally = tally_from_ballots(await load_ballots(document), document["candidates"])
+    await db.update_one(
+        {"_id": document["_id"], "tally": {"$exists": False}},
+        {"$set": {"tally": tally}})
+    document["tally"] = tally
+    return tally
+
+
+async def get_voter_ballot(document, vid):
+    """The ballot submitted by voter vid (only that ballot is fetched), or None."""
+    if ballot_storage(document) == COLLECTION:
+        stored = await ballots_db.find_one({"poll_id": document["_id"], "voter_id": vid})
+        return _ballot_fields(stored) if stored is not None else None
+    doc = await db.find_one({"_id": document["_id"], "ballots.voter_id": vid}, {"ballots.$": 1})
+    return doc["ballots"][0] if doc is not None else None
+
+
+async def put_voter_ballot(document, vid, b):
+    """Store ballot b as the ballot of voter vid, replacing their previous ballot if
+    there is one. Returns False if the ballot could not be stored."""
+    await ensure_tally(document)
+    candidates = document["candidates"]
+    if ballot_storage(document) == COLLECTION:
+        async def write(session):
+            old = await ballots_db.find_one_and_replace(
+                {"poll_id": document["_id"], "voter_id": vid, "unique_voter": True},
+                _stored_ballot(document, b, unique_voter=True),
+                upsert=True, return_document=ReturnDocument.BEFORE, session=session)
+            inc = ballots_inc([b], candidates) if old is None else replace_inc(old, b, candidates)
+            await db.update_one({"_id": document["_id"]}, {"$inc": _bump(inc)}, session=session)
+
+        for _ in range(_CAS_RETRIES):
+            try:
+                await _atomically(write)
+            except DuplicateKeyError:  # a concurrent first ballot from this voter
+                continue
+            return True
+        return False
+
+    for _ in range(_CAS_RETRIES):
+        old = await get_voter_ballot(document, vid)
+        if old is None:
+            # append only if this voter has not submitted a ballot in the meantime
+            result = await db.update_one(
+                {"_id": document["_id"], "ballots.voter_id": {"$ne": vid}, **_EMBEDDED},
+                {"$push": {"ballots": b}, "$inc": _bump(ballots_inc([b], candidates))})
+        else:
+            # replace this voter's ballot, provided it is still the one just read
+            result = await db.update_one(
+                {"_id": document["_id"], "ballots": {"$elemMatch": {"voter_id": vid, "ranking": old["ranking"]}},
+                 **_EMBEDDED},
+                {"$set": {"ballots.$": b}, "$inc": _bump(replace_inc(old, b, candidates))})
+        if result.matched_count > 0:
+            return True
+        if await _moved_to_collection(document):
+            return await put_voter_ballot(document, vid, b)
+    return False
+
+
+async def add_ballot(document, b, unique_ip=None):
+    """Add ballot b to the poll. When unique_ip is given, the ballot is only added if
+    no other ballot was submitted from that address; returns False if one was."""
+    await ensure_tally(document)
+    inc = ballots_inc([b], document["candidates"])
+    if ballot_storage(document) == COLLECTION:
+        async def write(session):
+            await ballots_db.insert_one(
+                _stored_ballot(document, b, unique_ip=unique_ip is not None), session=session)
+            await db.update_one({"_id": document["_id"]}, {"$inc": _bump(inc)}, session=session)
+
+        try:
+            await _atomically(write)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    query = {"_id": document["_id"], **_EMBEDDED}
+    if unique_ip is not None:
+        # atomically append only if no ballot with this ip exists yet
+        query["ballots.ip"] = {"$ne": unique_ip}
+    result = await db.update_one(query, {"$push": {"ballots": b}, "$inc": _bump(inc)})
+    if result.matched_count == 0 and await _moved_to_collection(document):
+        return await add_ballot(document, b, unique_ip)
+    return result.matched_count > 0
+
+
+async def remove_voter_ballot(document, vid, poll_update=None):
+    """Remove the ballot of voter vid, applying poll_update (e.g., removing the voter
+    from the poll) to the poll document in the same update as the tally. Returns
+    the pymongo result of the poll update, or None if the update could not be made."""
+    await ensure_tally(document)
+    poll_update = dict(poll_update or {})
+    candidates = document["candidates"]
+    if ballot_storage(document) == COLLECTION:
+        async def write(session):
+            update = dict(poll_update)
+            old = await ballots_db.find_one_and_delete(
+                {"poll_id": document["_id"], "voter_id": vid}, session=session)
+            if old is not None:
+                update["$inc"] = _bump(ballots_inc([old], candidates, -1))
+            if not update:
+                return None
+            return await db.update_one({"_id": document["_id"]}, update, session=session)
+
+        return await _atomically(write)
+
+    for _ in range(_CAS_RETRIES):
+        query = {"_id": document["_id"], **_EMBEDDED}
+        update = {**poll_update, "$pull": {**poll_update.get("$pull", {}), "ballots": {"voter_id": vid}}}
+        old = await get_voter_ballot(document, vid)
+        if old is not None:
+            # provided the ballot is still the one just read
+            query["ballots"] = {"$elemMatch": {"voter_id": vid, "ranking": old["ranking"]}}
+            update["$inc"] = _bump(ballots_inc([old], candidates, -1))
+        else:
+            query["ballots.voter_id"] = {"$ne": vid}
+        result = await db.update_one(query, update)
+        if result.matched_count > 0:
+            return result
+        if await _moved_to_collection(document):
+            return await remove_voter_ballot(document, vid, poll_update)
+    return None
+
+
+async def rename_voter(document, vid, new_vid, poll_update):
+    """Move the ballot of voter vid (if any) over to new_vid and apply poll_update to
+    the poll. Returns the pymongo result of the poll update."""
+    if ballot_storage(document) == COLLECTION:
+        await ballots_db.update_one(
+            {"poll_id": document["_id"], "voter_id": vid}, {"$set": {"voter_id": new_vid}})
+        return await db.update_one({"_id": document["_id"]}, poll_update)
+    # rename in place: rewriting the whole ballots array could drop a concurrent vote
+    update = {**poll_update, "$set": {**poll_update.get("$set", {}), "ballots.$[ballot].voter_id": new_vid}}
+    result = await db.update_one(
+        {"_id": document["_id"], **_EMBEDDED}, update, array_filters=[{"ballot.voter_id": vid}])
+    if result.matched_count == 0 and await _moved_to_collection(document):
+        return await rename_voter(document, vid, new_vid, poll_update)
+    return result
+
+
+async def add_ballots(document, ballots):
+    """Append a list of ballots to the poll."""
+    if len(ballots) == 0:
+        return
+    await ensure_tally(document)
+    inc = ballots_inc(ballots, document["candidates"])
+    if ballot_storage(document) == COLLECTION:
+        async def write(session):
+            await ballots_db.insert_many(
+                [_stored_ballot(document, b) for b in ballots], ordered=False, session=session)
+            await db.update_one({"_id": document["_id"]}, {"$inc": _bump(inc)}, session=session)
+
+        await _atomically(write)
+    else:
+        result = await db.update_one(
+            {"_id": document["_id"], **_EMBEDDED},
+            {"$push": {"ballots": {"$each": ballots}}, "$inc": _bump(inc)})
+        if result.matched_count == 0 and await _moved_to_collection(document):
+            await add_ballots(document, ballots)
+
+
+async def replace_ballots(document, ballots):
+    """Replace all the ballots in the poll by a list of ballots (possibly empty).
+    Returns the pymongo result of the poll update."""
+    tally = tally_from_ballots(ballots, document["candidates"])
+    if ballot_storage(document) == COLLECTION:
+        async def write(session):
+            stored = await db.find_one({"_id": document["_id"]}, {"ballot_version": 1}, session=session)
+            version = stored.get("ballot_version", 0) if stored is not None else 0
+            await ballots_db.delete_many({"poll_id": document["_id"]}, session=session)
+            if len(ballots) > 0:
+                await ballots_db.insert_many(
+                    [_stored_ballot(document, b) for b in ballots], ordered=False, session=session)
+            # the tally is reset only if no ballot was written meanwhile
+            return await db.update_one(
+                {"_id": document["_id"], **_at_version(version)},
+                {"$set": {"tally": tally}, "$inc": _bump({})}, session=session)
+
+        result = await _atomically(write)
+        if result.matched_count == 0:
+            # a ballot was written meanwhile (only possible without transactions)
+            return await rebuild_tally(document) or result
+        return result
+    result = await db.update_one(
+        {"_id": document["_id"], **_EMBEDDED},
+        {"$set": {"ballots": ballots, "tally": tally}, "$inc": _bump({})})
+    if result.matched_count == 0 and await _moved_to_collection(document):
+        return await replace_ballots(document, ballots)
+    return result
+
+
+async def rebuild_tally(document):
+    """Rebuild the poll's tally from its ballots, e.g., to repair a tally left behind
+    by a crash between a ballot write and its tally update on a deployment without
+    transactions. The tally is only set if no ballot was written while the ballots
+    were read (and the rebuild is retried otherwise). Returns the pymongo result of
+    the poll update, or None if the poll does not exist."""
+    result = None
+    for _ in range(_CAS_RETRIES):
+        stored = await db.find_one(
+            {"_id": document["_id"]}, {"ballot_version": 1, "candidates": 1, "ballot_storage": 1})
+        if stored is None:
+            return None
+        tally = tally_from_ballots(await load_ballots(stored), stored["candidates"])
+        result = await db.update_one(
+            {"_id": document["_id"], **_at_version(stored.get("ballot_version", 0))},
+            {"$set": {"tally": tally}, "$inc": _bump({})})
+        if result.matched_count > 0:
+            break
+    return result
+
+
+async def delete_poll_ballots(poll_id):
+    await ballots_db.delete_many({"poll_id": ObjectId(poll_id)})
+
+
+async def migrate_to_collection(poll_id):
+    """Move the embedded ballots of a poll into the Ballots collection. The switch is
+    conditioned on the ballots being unchanged since they were copied, so a vote
+    arriving during the migration is never lost: the copy is discarded and the
+    migration retried. Returns the number of ballots moved, or None if the poll
+    does not exist or already stores its ballots in the collection."""
+    for _ in range(_CAS_RETRIES):
+        document = await db.find_one({"_id": ObjectId(poll_id)})
+        if document is None or ballot_storage(document) == COLLECTION:
+            return None
+        ballots = document.get("ballots", [])
+        one_per_ip = not document.get("is_private", False) and not document.get("allow_multiple_votes", False)
+        stored, seen_voters, seen_ips = [], set(), set()
+        for b in ballots:
+            unique_voter = document.get("is_private", False) and b.get("voter_id") is not None and b["voter_id"] not in seen_voters
+            unique_ip = one_per_ip and b.get("ip") not in (None, "n/a") and b["ip"] not in seen_ips
+            if unique_voter:
+                seen_voters.add(b["voter_id"])
+            if unique_ip:
+                seen_ips.add(b["ip"])
+            stored.append(_stored_ballot(document, b, unique_voter=unique_voter, unique_ip=unique_ip))
+        await ballots_db.delete_many({"poll_id": document["_id"]})  # left over from an earlier attempt
+        if len(stored) > 0:
+            await ballots_db.insert_many(stored, ordered=False)
+        result = await db.update_one(
+            {"_id": document["_id"], "ballots": ballots if "ballots" in document else {"$exists": False}},
+            {"$set": {"ballot_storage": COLLECTION,
+                      "tally": tally_from_ballots(ballots, document["candidates"])},
+             "$unset": {"ballots": ""}})
+        if result.modified_count > 0:
+            return len(ballots)
+        await ballots_db.delete_many({"poll_id": document["_id"]})
+    return None
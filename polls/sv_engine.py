@@ -0,0 +1,248 @@
+#
+# Stable Voting engine
+#
+# Computes the same winners and explanations as stable_voting_with_explanations_
+# (polls/voting.py) from a margin matrix computed once:
+#
+#   - the candidates are sorted and a subset of them is an int bitmask (bit i is
+#     the i-th candidate), so subsets are cheap to build, compare and memoize
+#   - the Split Cycle undefeated set of a subset is computed with a widest path
+#     (max-min) closure over the margin submatrix instead of calling pref_voting
+#   - the winners, the undefeated set and the explanation of every subset are
+#     memoized per mask, so each subset is solved at most once
+#
+# The explanations are rebuilt from the per-mask memo in exactly the order the
+# recursive function inserts them, so the payload is byte-for-byte the same.
+#
+# The same closure gives the Split Cycle defeat relation of all the candidates and,
+# for every edge in a majority cycle, the strongest cycle through it and its
+# splitting number, without enumerating the cycles of the margin graph.
+#
+# The margin between two candidates does not depend on the other candidates, so
+# the margins of a subset are a submatrix of the full one. The results of a subset
+# (curr_cands) are computed from that submatrix and share the memo, which is what
+# makes a tiered ranking (every tier a subset of the previous one) cheap.
+#
+
+import numpy as np
+
+from polls.voting import tuple_to_str
+
+
+def widest_paths(margins):
+    '''
+    W[a][b] is the strength of the strongest path from a to b in the margin graph,
+    where the strength of a path is its smallest margin (0 if there is no path).
+    '''
+    W = np.where(margins > 0, margins, 0)
+    for k in range(len(W)):
+        W = np.maximum(W, np.minimum(W[:, k:k + 1], W[k:k + 1, :]))
+    return W
+
+
+def split_cycle_defeats(margins, W=None):
+    '''
+    D[a][b] is True when a Split Cycle defeats b: a beats b by a margin larger
+    than the strongest path from b back to a (i.e., a -> b is not the weakest
+    edge of any majority cycle).
+    '''
+    W = widest_paths(margins) if W is None else W
+    return (margins > 0) & (margins > W.T)
+
+
+def split_cycle_undefeated(margins):
+    '''the indices of the candidates that are not Split Cycle defeated'''
+    return np.flatnonzero(~split_cycle_defeats(margins).any(axis=0))
+
+
+def _strongest_cycle(margins, a, b, strength):
+    '''
+    a cycle through the edge a -> b whose other edges all have a margin of at least
+    strength: the edge followed by a shortest path from b back to a over those edges.
+    '''
+    prev = {b: None}
+    queue = [b]
+    for x in queue:
+        if x == a:
+            break
+        for y in np.flatnonzero(margins[x] >= strength).tolist():
+            if y not in prev:
+                prev[y] = x
+                queue.append(y)
+    path = [a]
+    while path[-1] != b:
+        path.append(prev[path[-1]])
+    return [a] + path[::-1][:-1]
+
+
+def splitting_numbers(margins, W=None):
+    '''
+    for each majority edge a -> b that is in a cycle, the strongest cycle through it
+    and that cycle's splitting number (its smallest margin) as a dict from cycles
+    (lists of indices starting at the smallest index) to splitting numbers.
+    '''
+    W = widest_paths(margins) if W is None else W
+    cycles = dict()
+    for a, b in zip(*np.nonzero((margins > 0) & (W.T > 0))):
+        strength = int(W[b, a])
+        cycle = _strongest_cycle(margins, int(a), int(b), strength)
+        start = cycle.index(min(cycle))
+        cycles[tuple(cycle[start:] + cycle[:start])] = min(int(margins[a, b]), strength)
+    return cycles
+
+
+class StableVotingEngine:
+    '''
+    Stable Voting winners and explanations for the candidates of a profile (or a
+    margin matrix), memoized per subset of the candidates.
+    '''
+
+    def __init__(self, candidates, margins):
+        order = sorted(range(len(candidates)), key=lambda i: candidates[i])
+        self.candidates = [candidates[i] for i in order]
+        self.margins = np.asarray(margins, dtype=np.int64)[np.ix_(order, order)]
+        self._winners = dict()   # mask -> sorted list of winners
+        self._entries = dict()   # mask -> explanation of the subset
+        self._consulted = dict() # mask -> masks of the subsets its explanation refers to
+        self._W = dict()         # mask -> widest paths of the subset
+
+    @classmethod
+    def from_profile(cls, profile):
+        cands = list(profile.candidates)
+        return cls(cands, [[profile.margin(a, b) for b in cands] for a in cands])
+
+    def _mask(self, curr_cands):
+        if curr_cands is None:
+            return (1 << len(self.candidates)) - 1
+        cidx = {c: i for i, c in enumerate(self.candidates)}
+        mask = 0
+        for c in curr_cands:
+            mask |= 1 << cidx[c]
+        return mask
+
+    def _members(self, mask):
+        return [i for i in range(len(self.candidates)) if mask >> i & 1]
+
+    def _labels(self, idxs):
+        return [self.candidates[i] for i in idxs]
+
+    def _solve(self, mask):
+        if mask in self._winners:
+            return self._winners[mask]
+        idxs = self._members(mask)
+        key_cands = self._labels(idxs)
+        consulted = list()
+
+        if len(idxs) == 1:
+            ws = key_cands
+            entry = {}
+        else:
+            sub = self.margins[np.ix_(idxs, idxs)]
+            sc = [idxs[i] for i in split_cycle_undefeated(sub)]
+            sc_ws = self._labels(sc)
+            if len(sc) == 1:
+                ws = sc_ws
+                a = idxs.index(sc[0])
+                entry = {"is_uniquely_undefeated": {
+                    'winner': tuple_to_str(sc_ws),
+                    'is_condorcet_winner': bool(all(sub[a, j] > 0 for j in range(len(idxs)) if j != a))}}
+            else:
+                ws, entry = self._stable_voting(mask, idxs, sub, sc, sc_ws, consulted)
+
+        self._winners[mask] = ws
+        self._entries[mask] = entry
+        self._consulted[mask] = consulted
+        return ws
+
+    def _stable_voting(self, mask, idxs, sub, sc, sc_ws, consulted):
+        # the matches a vs. b with a undefeated, from the largest margin down, in the
+        # order the recursive function visits them
+        sc_set = set(sc)
+        matches = [(int(sub[i, j]), a, b)
+                   for i, a in enumerate(idxs) for j, b in enumerate(idxs)
+                   if a != b and a in sc_set]
+        levels = sorted(set(m for m, _, _ in matches), reverse=True)
+        sv_winners = list()
+        entry = dict()
+        for m in levels:
+            for _, a, b in [match for match in matches if match[0] == m]:
+                if a in sv_winners:
+                    continue
+                child = mask & ~(1 << b)
+                ws = self._solve(child)
+                consulted.append(child)
+                if self.candidates[a] in ws:
+                    sv_winners.append(a)
+                entry[tuple_to_str((self.candidates[a], self.candidates[b]))] = {
+                    'margin': str(m),
+                    'cands_minus_b': tuple_to_str(self._labels([c for c in idxs if c != b])),
+                    'undefeated_cands': tuple_to_str(sc_ws),
+                    'winner': tuple_to_str(ws)}
+            if len(sv_winners) > 0:
+                return sorted(self._labels(sv_winners)), entry
+        return None, entry
+
+    def _emit(self, mask, explanations):
+        # a subset's own key goes in right after the first subset it consults, as
+        # the recursive function creates it only once that first answer is known
+        key = tuple_to_str(self._labels(self._members(mask)))
+        consulted = self._consulted[mask]
+        if len(consulted) == 0:
+            explanations[key] = self._entries[mask]
+        for child in consulted:
+            child_key = tuple_to_str(self._labels(self._members(child)))
+            if child_key not in explanations:
+                self._emit(child, explanations)
+            if key not in explanations:
+                explanations[key] = self._entries[mask]
+
+    def submatrix(self, curr_cands=None):
+        '''the candidates in curr_cands (all the candidates by default), sorted, and their margin matrix'''
+        idxs = self._members(self._mask(curr_cands))
+        return self._labels(idxs), self.margins[np.ix_(idxs, idxs)]
+
+    def widest_paths(self, curr_cands=None):
+        mask = self._mask(curr_cands)
+        if mask not in self._W:
+            self._W[mask] = widest_paths(self.submatrix(curr_cands)[1])
+        return self._W[mask]
+
+    def defeat_relation(self, curr_cands=None):
+        '''{a: {b: whether a Split Cycle defeats b}} for the candidates (as strings)'''
+        cands, margins = self.submatrix(curr_cands)
+        D = split_cycle_defeats(margins, self.widest_paths(curr_cands))
+        return {str(a): {str(b): bool(D[i, j]) for j, b in enumerate(cands)}
+                for i, a in enumerate(cands)}
+
+    def split_cycle_winners(self, curr_cands=None):
+        '''the Split Cycle winners (as strings), i.e., the undefeated candidates'''
+        cands, margins = self.submatrix(curr_cands)
+        D = split_cycle_defeats(margins, self.widest_paths(curr_cands))
+        return [str(cands[i]) for i in np.flatnonzero(~D.any(axis=0))]
+
+    def splitting_numbers(self, curr_cands=None):
+        '''the splitting number of the strongest cycle through each edge in a cycle'''
+        cands, margins = self.submatrix(curr_cands)
+        return {tuple_to_str([cands[i] for i in cycle]): n
+                for cycle, n in splitting_numbers(margins, self.widest_paths(curr_cands)).items()}
+
+    def winners(self, curr_cands=None):
+        '''the Stable Voting winners among curr_cands (all the candidates by default)'''
+        return self._solve(self._mask(curr_cands))
+
+    def explanations(self, curr_cands=None):
+        '''the explanations of the winners among curr_cands, keyed like the recursive function'''
+        mask = self._mask(curr_cands)
+        self._solve(mask)
+        explanations = dict()
+        self._emit(mask, explanations)
+        return explanations
+
+
+def stable_voting_with_explanations(profile, curr_cands=None):
+    '''
+    drop-in for stable_voting_with_explanations_ that returns the winners and the
+    explanations.
+    '''
+    engine = StableVotingEngine.from_profile(profile)
+    return engine.winners(curr_cands), engine.explanations(curr_cands)
@@ -0,0 +1,125 @@
+#
+# Pairwise tally of the ballots in a poll
+#
+# Every poll document carries a "tally" that is kept in step with its ballots:
+#
+#   support[i][j]  number of ballots ranking candidate i strictly above candidate j
+#   ranked[i]      number of ballots that rank candidate i at all
+#   types          number of ballots of each ranking type (keyed by ranking_key)
+#   num_ballots    total number of ballots
+#
+# where i, j are indices into the poll's candidate list. Every ballot write applies
+# the matching $inc in the same update as the ballot itself, so reading the outcome
+# is O(n^2) in the number of candidates no matter how many ballots there are.
+#
+
+from collections import Counter
+
+from polls.voting import ranking_key, ranking_from_key
+
+
+def empty_tally(num_cands):
+    return {
+        "support": [[0] * num_cands for _ in range(num_cands)],
+        "ranked": [0] * num_cands,
+        "types": {},
+        "num_ballots": 0,
+    }
+
+
+def tally_inc(ranking, candidates, weight=1):
+    '''
+    the $inc update (as a Counter of field paths) that adds weight ballots with the
+    given ranking to the tally; use a negative weight to remove ballots.
+    '''
+    cand_to_cidx = {c: i for i, c in enumerate(candidates)}
+    ranks = {cand_to_cidx[c]: r for c, r in ranking.items() if c in cand_to_cidx}
+    inc = Counter()
+    for i, ri in ranks.items():
+        inc[f"tally.ranked.{i}"] += weight
+        for j, rj in ranks.items():
+            if ri < rj:
+                inc[f"tally.support.{i}.{j}"] += weight
+    inc[f"tally.types.{ranking_key(ranking, cand_to_cidx)}"] += weight
+    inc["tally.num_ballots"] += weight
+    return dict(inc)
+
+
+def ballots_inc(ballots, candidates, weight=1):
+    '''
+    the combined $inc update for a list of ballots; a ballot with a "count" stands
+    for that many voters with the same ranking.
+    '''
+    inc = Counter()
+    for b in ballots:
+        inc.update(tally_inc(b["ranking"], candidates, weight * b.get("count", 1)))
+    return dict(inc)
+
+
+def replace_inc(old_ballot, new_ballot, candidates):
+    '''the $inc update for replacing old_ballot by new_ballot'''
+    inc = Counter(ballots_inc([new_ballot], candidates))
+    inc.update(ballots_inc([old_ballot], candidates, -1))
+    return dict(inc)
+
+
+def tally_from_ballots(ballots, candidates):
+    '''build a tally from scratch, e.g., for polls created before tallies were kept'''
+    tally = empty_tally(len(candidates))
+    for path, n in ballots_inc(ballots, candidates).items():
+        keys = path.split(".")[1:]
+        if keys[0] == "support":
+            tally["support"][int(keys[1])][int(keys[2])] += n
+        elif keys[0] == "ranked":
+            tally["ranked"][int(keys[1])] += n
+        elif keys[0] == "types":
+            tally["types"][keys[1]] = n
+        else:
+            tally["num_ballots"] += n
+    return tally
+
+
+def tally_candidates(tally):
+    '''
+    the candidates (as strings of their indices) that are ranked by at least one
+    ballot, sorted the same way ProfileWithTies sorts them.
+    '''
+    return sorted(str(i) for i, n in enumerate(tally["ranked"]) if n > 0)
+
+
+def tally_margins(tally):
+    '''the margins between the ranked candidates, in the format of the results page'''
+    support = tally["support"]
+    cands = tally_candidates(tally)
+    return {c1: {c2: support[int(c1)][int(c2)] - support[int(c2)][int(c1)] for c2 in cands}
+            for c1 in cands}
+
+
+def tally_rankings(tally):
+    '''
+    the (rmap, count) pairs of the ranking types in the tally with at least one
+    ballot, with the candidate indices as strings.
+    '''
+    return [({str(cidx): r for cidx, r in ranking_from_key(key).items()}, n)
+            for key, n in tally["types"].items() if n > 0]
+
+
+def tally_margin_matrix(tally):
+    '''the ranked candidates (see tally_candidates) and the matrix of their margins'''
+    import numpy as np
+    cands = tally_candidates(tally)
+    idxs = [int(c) for c in cands]
+    n = len(tally["ranked"])
+    support = np.array(tally["support"], dtype=np.int64).reshape(n, n)
+    sub = support[np.ix_(idxs, idxs)]
+    return cands, sub - sub.T
+
+
+def tally_profile(tally):
+    '''
+    a ProfileWithTies (over the candidate indices as strings) with one ranking per
+    ranking type in the tally, weighted by the number of ballots of that type.
+    '''
+    from pref_voting.profiles_with_ties import ProfileWithTies
+    rankings = tally_rankings(tally)
+    return ProfileWithTies([rmap for rmap, _ in rankings], rcounts=[n for _, n in rankings])
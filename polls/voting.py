@@ -1,11 +1,7 @@
 
-from pref_voting.voting_methods import split_cycle
+# pref_voting is imported by the functions that use it, on first use, so that
+# importing this module (e.g., to submit a ballot) does not load it
  
-def is_same_ranking(r1, r2): 
-    if sorted(list(r1.keys())) == sorted(list(r2.keys())):
-        return all([r1[c] == r2[c] for c in r1.keys()])
-    return False
-
 def ws_to_str(ws): 
     if len(ws) == 1: 
         return f"Stable Voting winner is {ws[0]}"
@@ -28,83 +24,168 @@ def tuple_to_str(l):
     return f"{','.join(map(str,l))}"
 
 
+def ranking_key(ranking, cand_to_cidx):
+    '''
+    canonical key for a ranking (a dict from candidate names to ranks): the rank of
+    each candidate in poll order, with "_" for unranked candidates, e.g. "1,2,_,3".
+    Identical rankings get identical keys, and the key is safe to use as a mongo field name.
+    '''
+    ranks = ["_"] * len(cand_to_cidx)
+    for c, r in ranking.items():
+        if c in cand_to_cidx:
+            ranks[cand_to_cidx[c]] = str(r)
+    return ",".join(ranks)
+
+
+def ranking_from_key(key):
+    '''inverse of ranking_key: a dict from candidate indices to ranks'''
+    return {cidx: int(r) for cidx, r in enumerate(key.split(",")) if r != "_"}
+
+
+def group_rankings(rankings, cand_to_cidx, counts=None):
+    '''
+    group identical rankings in a single pass. rankings are dicts from candidate names
+    to ranks (candidates not in cand_to_cidx are dropped), counts the number of
+    ballots with each ranking (1 each by default). Returns the distinct rankings, as
+    dicts from candidate indices to ranks, and their total counts.
+    '''
+    grouped = dict()
+    counts = counts if counts is not None else (1 for _ in rankings)
+    for ranking, count in zip(rankings, counts):
+        if count <= 0:
+            continue
+        r = {cand_to_cidx[c]: rank for c, rank in ranking.items() if c in cand_to_cidx}
+        key = tuple(sorted(r.items()))
+        if key in grouped:
+            grouped[key][1] += count
+        else:
+            grouped[key] = [r, count]
+    return [r for r, _ in grouped.values()], [n for _, n in grouped.values()]
+
+
+def build_profile(rankings, cand_to_cidx, counts=None):
+    '''
+    a ProfileWithTies with one ranking per distinct ranking (see group_rankings),
+    so building it and computing margins scale with the number of distinct rankings
+    rather than the number of ballots.
+    '''
+    from pref_voting.profiles_with_ties import ProfileWithTies
+    rs, cs = group_rankings(rankings, cand_to_cidx, counts)
+    return ProfileWithTies(rs, rcounts=cs)
+
+
+def margin_matrix(profile):
+    '''the candidates of the profile and the matrix of the margins between them'''
+    import numpy as np
+    cands = list(profile.candidates)
+    return cands, np.array([[profile.margin(a, b) for b in cands] for a in cands], dtype=np.int64)
+
+
+def majority_relations(margins):
+    '''
+    the Condorcet winner and loser (or None), the weak Condorcet winners and losers,
+    whether the majority graph (a -> b when a's margin over b is positive) has a
+    cycle, and the number of candidates each candidate loses to, all computed from
+    one margin matrix and as indices into it.
+    '''
+    import numpy as np
+    M = np.asarray(margins)
+    others = ~np.eye(len(M), dtype=bool)
+    beats = (M > 0) & others
+    num_losses = beats.sum(axis=0)
+
+    # the majority graph is acyclic iff repeatedly removing the candidates that lose
+    # to no remaining candidate removes all of them
+    remaining = np.ones(len(M), dtype=bool)
+    while remaining.any():
+        unbeaten = remaining & ~beats[remaining].any(axis=0)
+        if not unbeaten.any():
+            break
+        remaining &= ~unbeaten
+
+    cw = np.flatnonzero(beats.sum(axis=1) == len(M) - 1)
+    cl = np.flatnonzero(num_losses == len(M) - 1)
+    return {
+        "condorcet_winner": int(cw[0]) if len(M) > 0 and len(cw) == 1 else None,
+        "condorcet_loser": int(cl[0]) if len(M) > 0 and len(cl) == 1 else None,
+        "weak_condorcet_winners": np.flatnonzero(((M >= 0) | ~others).all(axis=1)).tolist(),
+        "weak_condorcet_losers": np.flatnonzero(((M <= 0) | ~others).all(axis=1)).tolist(),
+        "cycle": bool(remaining.any()),
+        "num_losses": num_losses.tolist(),
+    }
+
+
+def linear_order(candidates, num_losses):
+    '''
+    whether the majority relation is a linear order (the candidates lose to 0, 1,
+    ..., n - 1 others) and the candidates sorted by the number of others they lose
+    to (num_losses, see majority_relations).
+    '''
+    is_lin = sorted(set(num_losses)) == list(range(len(candidates)))
+    return is_lin, [c for c, _ in sorted(zip(candidates, num_losses), key=lambda cl: cl[1])]
+
+
 def is_linear(profile): 
-    
-    num_incoming_edges = {c: len([_c for _c in profile.candidates if _c != c and profile.margin(_c,c) > 0]) 
-                          for c in profile.candidates}
-    
-    lin_profile = sorted(list(set(num_incoming_edges.values()))) == list(range(len(profile.candidates)))
-    
-    return lin_profile, [c for c,_ in sorted(num_incoming_edges.items(), key=lambda ces: ces[1] )]
+    cands, margins = margin_matrix(profile)
+    return linear_order(cands, majority_relations(margins)["num_losses"])
 
-def generate_columns_from_profiles(prof): 
-    cols = list()
-    max_rank = 0
-    for r in prof.rankings: 
-        if len(r.rmap.values()) > 0 and max_rank < max(r.rmap.values()):
-            max_rank = max(r.rmap.values())
-            
-    for r,c in zip(prof.rankings, prof.rcounts):
-        found_col=False
-        for col in cols: 
-            col_rmap = col["rmap"]
-            if is_same_ranking(r.rmap, col_rmap): 
-                col["count"] += c
-                found_col = True
-        if not found_col: 
-            cols.append({
-                "rmap": r.rmap,
+def columns_from_rankings(rankings_counts): 
+    '''
+    the columns of the rankings table: one column per distinct ranking, with its
+    count followed by the candidates at each rank (identical rankings are merged
+    with a hash lookup, in order of first occurrence), from (rmap, count) pairs.
+    '''
+    rankings_counts = list(rankings_counts)
+    max_rank = max((max(rmap.values()) for rmap, _ in rankings_counts if len(rmap) > 0), default=0)
+
+    cols = dict()
+    for rmap, c in rankings_counts:
+        key = frozenset(rmap.items())
+        if key in cols:
+            cols[key]["count"] += c
+        else:
+            cols[key] = {
                 "count": c,
-                "col_list": [", ".join([str(_c) for _c in r.cands_at_rank(rank)]) if rank in r.rmap.values() else "" 
-                            for rank in range(1, max_rank + 1)]
-            })
-    return [[str(c["count"])] + c["col_list"] for c in cols], max_rank
+                "col_list": [", ".join([str(_c) for _c, _r in rmap.items() if _r == rank])
+                             for rank in range(1, max_rank + 1)]
+            }
+    return [[str(col["count"])] + col["col_list"] for col in cols.values()], max_rank
+
+def generate_columns_from_profiles(prof): 
+    '''the columns of the rankings table of the profile (see columns_from_rankings)'''
+    rankings, counts = prof.rankings_counts
+    return columns_from_rankings((r.rmap, c) for r, c in zip(rankings, counts))
+
+def normalized_ranks(rmap): 
+    '''the ranks of rmap renumbered 1, 2, ... keeping their order and ties (without changing rmap)'''
+    levels = {r: i + 1 for i, r in enumerate(sorted(set(rmap.values())))}
+    return {c: levels[r] for c, r in rmap.items()}
+
+def iter_csv_rows(rankings_counts, candidates, cmap): 
+    '''
+    streaming variant of generate_csv_data: yield the header row and then one row
+    per (rmap, count) pair of the iterable rankings_counts, one at a time. The pairs
+    are not merged, so pass distinct rankings (e.g., the ranking types of a tally).
+    '''
+    yield [cmap[c] for c in candidates] + [""]
+    for rmap, count in rankings_counts: 
+        ranks = normalized_ranks(rmap)
+        yield [ranks.get(cand, "") for cand in candidates] + [count]
 
 def generate_csv_data(profile, cmap): 
-    candidates = profile.candidates
-    
-    # generate the anonymous profile
-    rs, cs = profile.rankings_counts
-    anon_rankings = [[rs[0], cs[0]]]
-    for r, c in zip(rs[1::], cs[1::]): 
-        r.normalize_ranks()
-        found_it = False
-        for r_c in anon_rankings[1::]: 
-            if r_c[0] == r: 
-                found_it = True
-                r_c[1] += c
-        if not found_it: 
-            anon_rankings.append([r, c])
-    
-    # generate the rows for the csv file
-    rows = [[cmap[c] for c in candidates] + [""]] 
-    for r,c in anon_rankings: 
-        row = list()
-        for cand in candidates: 
-            if cand in r.rmap.keys(): 
-                row.append(r.rmap[cand])
-            else: 
-                row.append("")
-        row.append(c)
-        rows.append(row)
-
-    return rows
-
-def get_splitting_numbers(profile): 
-    '''
-    return a dictionary associating each cycle with its splitting number
-    '''
-    cycles = profile.cycles()
-    splitting_numbers = dict()
-    for cycle in cycles: # for each cycle in the margin graph
-        # get all the margins (i.e., the weights) of the edges in the cycle
-        margins = list() 
-        for idx,c1 in enumerate(cycle): 
-            next_idx = idx + 1 if (idx + 1) < len(cycle) else 0
-            c2 = cycle[next_idx]
-            margins.append(profile.margin(c1, c2)) 
-        splitting_numbers[tuple_to_str(cycle)] = min(margins) # the split number of the cycle is the minimal margin
-    return splitting_numbers
+    '''
+    the rows of the csv file of the anonymous profile: a header with the candidates,
+    then one row per distinct ranking (up to normalizing the ranks) with its count.
+    '''
+    anon_rankings = dict()
+    for r, c in zip(*profile.rankings_counts): 
+        ranks = normalized_ranks(r.rmap)
+        key = frozenset(ranks.items())
+        if key in anon_rankings: 
+            anon_rankings[key][1] += c
+        else: 
+            anon_rankings[key] = [ranks, c]
+    return list(iter_csv_rows(anon_rankings.values(), profile.candidates, cmap))
 
 
 def stable_voting_with_explanations_(profile, curr_cands = None, mem_sv_winners = None, explanations = None):
@@ -124,6 +205,7 @@ def stable_voting_with_explanations_(profile, curr_cands = None, mem_sv_winners
         explanations[tuple_to_str(tuple(curr_cands))] = {} 
         return curr_cands, mem_sv_winners, explanations
 
+    from pref_voting.voting_methods import split_cycle
     sc_ws = split_cycle(profile, curr_cands = curr_cands)
     print("sc_ws", sc_ws)
     if len(sc_ws) == 1: 
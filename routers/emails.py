@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from messages.models import ContactFormMessage, VoterEmailsData, OwnerEmailData
 from typing import Optional  # Add this import if missing
 
@@ -14,11 +14,11 @@ router = APIRouter()
 '''
 
 @router.post("/emails/send_contact_form", tags=["emails"])
-async def sendmessage(contact_form_message: ContactFormMessage, background_tasks: BackgroundTasks, owner_id:Optional[str] = None, voter_id:str = None):
+async def sendmessage(contact_form_message: ContactFormMessage, owner_id:Optional[str] = None, voter_id:str = None):
     
     print("send contact form message to stablevoting.org@gmail.com")
     
-    response = await send_contact_form_email(contact_form_message, background_tasks, voter_id, owner_id)
+    response = await send_contact_form_email(contact_form_message, voter_id, owner_id)
 
     if response is not None and "error" not in response.keys():
         return response
@@ -32,10 +32,10 @@ async def sendmessage(contact_form_message: ContactFormMessage, background_tasks
 
 
 @router.post("/emails/send_to_voters/{id}", tags=["emails"])
-async def send_voter_emails(id, emails_data: VoterEmailsData, background_tasks: BackgroundTasks, oid:Optional[str] = None):
+async def send_voter_emails(id, emails_data: VoterEmailsData, oid:Optional[str] = None):
     print(emails_data)
     print("send emails to voters")
-    response = await send_emails_to_voters(emails_data, id, background_tasks, oid)
+    response = await send_emails_to_voters(emails_data, id, oid)
     if response is not None and "error" not in response.keys():
         return response
     elif response is not None:
@@ -48,10 +48,10 @@ async def send_voter_emails(id, emails_data: VoterEmailsData, background_tasks:
 
 
 @router.post("/emails/send_to_owner/{id}", tags=["emails"])
-async def send_owner_email(id, emails_data: OwnerEmailData, background_tasks: BackgroundTasks, oid:Optional[str] = None):
+async def send_owner_email(id, emails_data: OwnerEmailData, oid:Optional[str] = None):
     print(emails_data)
     print("send email to owner")
-    response = await send_email_to_owner(emails_data, id, background_tasks, oid)
+    response = await send_email_to_owner(emails_data, id, oid)
     if response is not None and "error" not in response.keys():
         return response
     elif response is not None:
@@ -4,7 +4,7 @@ from typing import Optional
 from io import BytesIO  # ADD THIS
 
 from bson import ObjectId
-from polls.manage import create_poll, update_poll, delete_poll, submit_ballot, delete_ballot, add_rankings, poll_outcome, poll_ranking, poll_information, submitted_ranking_information, poll_ranking_information, demo_poll_outcome, delete_voter, regenerate_voter_link, delete_all_ballots, delete_ballot, resend_voter_email, superuser_pwd_valid, superuser_list_polls, superuser_stats
+from polls.manage import create_poll, update_poll, delete_poll, submit_ballot, delete_ballot, add_rankings, poll_outcome, poll_ranking, poll_information, submitted_ranking_information, export_rankings, poll_ranking_information, demo_poll_outcome, delete_voter, regenerate_voter_link, delete_all_ballots, delete_ballot, resend_voter_email, superuser_pwd_valid, superuser_list_polls, superuser_stats
 from polls.models import CreatePoll, UpdatePoll, PollInfo,  Ballot, PollRankingInfo, RankingsInfo, OutcomeInfo, DemoRankingsInput
 from polls.qr_utils import generate_poll_qr_code  # ADD THIS (note the dot for relative import)
 
@@ -26,24 +26,24 @@ router = APIRouter()
 
 
 @router.post("/polls/create", tags=["polls"])
-async def create_a_poll(poll_data: CreatePoll, background_tasks: BackgroundTasks,):
+async def create_a_poll(poll_data: CreatePoll):
     '''
     create a poll
     '''
     print("POLL DATA")
     print(poll_data)
-    response = await create_poll(background_tasks, poll_data)
+    response = await create_poll(poll_data)
     print("returning ", response)
     if response:
         return response
     raise HTTPException(400, "Something went wrong")
 
 @router.post("/polls/update/{id}", tags=["polls"])
-async def update_a_poll(id, background_tasks: BackgroundTasks, poll_data: UpdatePoll, oid:Optional[str] = None):
+async def update_a_poll(id, poll_data: UpdatePoll, oid:Optional[str] = None):
     print("update a poll ", id)
     print("oid ", oid)
     print("poll_data ", poll_data)
-    response = await update_poll(id, oid, poll_data, background_tasks)
+    response = await update_poll(id, oid, poll_data)
 
     if response is not None and "error" not in response.keys():
         return response
@@ -91,6 +91,25 @@ async def get_submitted_ranking_information(id, oid:Optional[str]=None) -> Ranki
         )
     raise HTTPException(400, "Something went wrong")
 
+@router.get("/polls/export/{id}.csv", tags=["polls"])
+async def export_poll_rankings(id, oid: Optional[str] = None):
+    """Download the rankings of a poll as a csv file (streamed, one row per distinct
+    ranking with its count, in the format accepted by /polls/bulk_vote)."""
+    response = await export_rankings(id, oid)
+    if response is not None and "error" not in response.keys():
+        return StreamingResponse(
+            response["lines"],
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{response["filename"]}"'},
+        )
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not found"},
+        )
+    raise HTTPException(400, "Something went wrong")
+
 @router.get("/polls/data/{id}",  tags=["polls"])
 async def get_poll(id, oid:Optional[str]=None) -> PollInfo:
     print("getting poll data for ", id)
@@ -276,14 +295,15 @@ async def get_superuser_polls(pwd: str):
 
 
 @router.get("/polls/superuser/stats", tags=["polls"])
-async def get_superuser_stats(pwd: str, background_tasks: BackgroundTasks, refresh: bool = False):
+async def get_superuser_stats(pwd: str, background_tasks: BackgroundTasks, refresh: bool = False, full: bool = False):
     """Password-gated analytics over all polls, for the super-user dashboard.
 
     Returns the cached result immediately; recomputes in the background when the
-    cache is stale or refresh=true is passed."""
+    cache is stale or refresh=true is passed; full=true recomputes the analytics
+    of every poll."""
     if not superuser_pwd_valid(pwd):
         raise HTTPException(status_code=403, detail="Invalid or missing super-user password.")
-    return await superuser_stats(background_tasks, refresh)
+    return await superuser_stats(background_tasks, refresh, full)
 
 
 @router.delete("/polls/voters/{poll_id}/{voter_id}", tags=["polls"])
@@ -334,14 +354,13 @@ async def delete_all_ballots_endpoint(
 async def regenerate_voter_link_endpoint(
     poll_id: str,
     voter_id: str,
-    background_tasks: BackgroundTasks,
     oid: Optional[str] = None
 ):
     """Generate a new voter ID/link for an existing voter"""
     print(f"Regenerating link for voter {voter_id} in poll {poll_id}")
     print(f"Owner ID: {oid}")
     
-    response = await regenerate_voter_link(poll_id, voter_id, oid, background_tasks)
+    response = await regenerate_voter_link(poll_id, voter_id, oid)
     
     if response is not None and "error" not in response.keys():
         return response
@@ -357,7 +376,6 @@ async def regenerate_voter_link_endpoint(
 @router.post("/polls/voters/{poll_id}/resend", tags=["polls"])
 async def resend_voter_email_endpoint(
     poll_id: str,
-    background_tasks: BackgroundTasks,
     request_body: dict,
     oid: Optional[str] = None
 ):
@@ -372,7 +390,7 @@ async def resend_voter_email_endpoint(
     print(f"Resending email to {email} for poll {poll_id}")
     print(f"Owner ID: {oid}")
     
-    response = await resend_voter_email(poll_id, email, oid, background_tasks)
+    response = await resend_voter_email(poll_id, email, oid)
     
     if response is not None and "error" not in response.keys():
         return response
@@ -16,12 +16,21 @@ os.environ["POSTMARK_SERVER_TOKEN"] = "POSTMARK_API_TEST"
 # all TestClient requests share one client address, so tests that cast several
 # ballots in a public poll must use the multiple-vote debug password
 os.environ["ALLOW_MULTIPLE_VOTE_PWD"] = "test-multi"
+# the tests run the closed poll scheduler themselves (see finalize_due_polls)
+os.environ["FINALIZE_POLLS"] = "False"
 
+import json
+
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from pymongo import MongoClient
 
 from main import app
+from messages import conf as email_conf
+from polls import manage as polls_manage
+from messages.transport import PostmarkTransport, set_transport
+from messages import worker as email_worker
 
 
 @pytest.fixture(scope="session")
@@ -31,10 +40,19 @@ def client():
 
 
 @pytest.fixture(autouse=True)
-def clean_db():
-    """Drop the test polls collection before every test."""
+def clean_db(request):
+    """Drop the test polls collection, the cached superuser stats and the leases,
+    and empty the ballots and outbox collections (keeping their indexes) before
+    every test, except the tests marked no_db."""
+    if request.node.get_closest_marker("no_db") is not None:
+        yield
+        return
     sync_client = MongoClient("mongodb://localhost:27017")
     sync_client["StableVotingTest"].Polls.drop()
+    sync_client["StableVotingTest"].Ballots.delete_many({})
+    sync_client["StableVotingTest"].Outbox.delete_many({})
+    sync_client["StableVotingTest"].superuser_cache.drop()
+    sync_client["StableVotingTest"].Leases.drop()
     yield
     sync_client.close()
 
@@ -43,6 +61,18 @@ def mongo():
     return MongoClient("mongodb://localhost:27017")["StableVotingTest"].Polls
 
 
+def mongo_ballots():
+    return MongoClient("mongodb://localhost:27017")["StableVotingTest"].Ballots
+
+
+def mongo_outbox():
+    return MongoClient("mongodb://localhost:27017")["StableVotingTest"].Outbox
+
+
+def mongo_leases():
+    return MongoClient("mongodb://localhost:27017")["StableVotingTest"].Leases
+
+
 @pytest.fixture
 def make_poll(client):
     """Create a poll and return the response data (id and owner_id)."""
@@ -97,3 +127,47 @@ def get_outcome(client):
         return client.post(f"/polls/outcome/{poll_id}", params=params)
 
     return _get_outcome
+
+
+class PostmarkStandIn:
+    """A stand-in for the Postmark API. It records the requests it gets, as (path,
+    token, payload), rejects the messages to addresses starting with "inactive" and,
+    while unavailable is True, answers every request with a 503."""
+
+    def __init__(self):
+        self.requests = []
+        self.unavailable = False
+
+    def _result(self, message, i=0):
+        if message["To"].startswith("inactive"):
+            return {"ErrorCode": 406, "Message": "Inactive recipient", "To": message["To"]}
+        return {"ErrorCode": 0, "MessageID": f"m{i}", "To": message["To"]}
+
+    def __call__(self, request):
+        payload = json.loads(request.content)
+        self.requests.append((request.url.path, request.headers["X-Postmark-Server-Token"], payload))
+        if self.unavailable:
+            return httpx.Response(503, text="Service Unavailable")
+        if request.url.path == "/email/batch":
+            return httpx.Response(200, json=[self._result(m, i) for i, m in enumerate(payload)])
+        return httpx.Response(200, json=self._result(payload))
+
+
+@pytest.fixture
+def postmark(monkeypatch):
+    """Send email for real, to a PostmarkStandIn (which is returned)."""
+    stand_in = PostmarkStandIn()
+    monkeypatch.setattr(email_conf, "SKIP_EMAILS", False)
+    monkeypatch.setattr(polls_manage, "SKIP_EMAILS", False)
+    previous = set_transport(PostmarkTransport(
+        server_token="test-token", base_url="http://postmark.test",
+        http_transport=httpx.MockTransport(stand_in)))
+    yield stand_in
+    set_transport(previous)
+
+
+@pytest.fixture
+def run_email_worker(client):
+    """Run one round of the email worker (in the app's event loop, which the app's
+    database client is bound to). Returns the number of messages claimed."""
+    return lambda: client.portal.call(email_worker.drain_once)
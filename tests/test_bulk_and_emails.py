@@ -2,7 +2,9 @@
 # Tests for CSV bulk upload and the email endpoint authorization.
 #
 
-from tests.conftest import mongo
+from datetime import datetime, timezone
+
+from tests.conftest import mongo, mongo_ballots, mongo_outbox
 
 CSV_OK = "A,B,C\n1,2,3\n2,1,3,2\n"
 
@@ -30,6 +32,45 @@ def test_bulk_upload_overwrite(client, make_poll, vote):
     assert info["num_ballots"] == 3
 
 
+def test_bulk_upload_overwrite_in_one_update(client, make_poll, vote, monkeypatch):
+    import polls.manage
+    monkeypatch.setattr(polls.manage, "BULK_BATCH_SIZE", 1)
+    poll = make_poll()
+    vote(poll["id"], {"C": 1})
+    assert upload(client, poll, "A,B,C\n1,2,3\n3,1,2\n2,3,1\n", overwrite=True).status_code == 200
+    # the ballots are replaced at once, not emptied and then refilled batch by batch
+    doc = mongo().find_one()
+    assert doc["ballot_version"] == 2 and doc["tally"]["num_ballots"] == 3
+    assert mongo_ballots().count_documents({}) == 3
+
+
+def test_bulk_upload_stores_weighted_ballots(client, make_poll, get_outcome):
+    poll = make_poll()
+    resp = upload(client, poll, "A,B,C\n1,2,3,100000\n1,2,3,5\n3,1,2,99999\n,,\n")
+    assert resp.status_code == 200
+    assert resp.json()["num_ballots"] == 200004
+    # identical rankings are aggregated into one weighted ballot
+    stored = sorted(b["count"] for b in mongo_ballots().find())
+    assert stored == [99999, 100005]
+    outcome = get_outcome(poll["id"], oid=poll["owner_id"]).json()
+    assert outcome["num_voters"] == "200004"
+    assert outcome["margins"]["0"]["1"] == 6
+
+
+def test_weighted_ballots_in_export(client, make_poll, vote):
+    poll = make_poll()
+    assert upload(client, poll, "A,B,C\n1,2,3,1000\n3,1,2,7\n").status_code == 200
+    vote(poll["id"], {"A": 1, "B": 2, "C": 3})
+    resp = client.get(f"/polls/export/{poll['id']}.csv", params={"oid": poll["owner_id"]})
+    assert resp.text.splitlines() == ["A,B,C,", "1,2,3,1001", "3,1,2,7"]
+
+
+def test_bulk_upload_bad_row_writes_nothing(client, make_poll):
+    poll = make_poll()
+    assert upload(client, poll, "A,B,C\n1,2,3\n1,x,3\n").status_code == 403
+    assert mongo().find_one()["tally"]["num_ballots"] == 0
+
+
 def test_bulk_upload_mismatched_candidates(client, make_poll):
     poll = make_poll()
     resp = upload(client, poll, "X,Y,Z\n1,2,3\n")
@@ -102,3 +143,51 @@ def test_send_to_owner_as_owner(client, make_poll):
 def test_contact_form(client):
     resp = client.post("/emails/send_contact_form", json={"name": "T", "email": "t@example.com", "message": "Hi"})
     assert resp.status_code == 200
+
+
+def test_emails_queued_then_sent_by_worker(client, make_poll, postmark, run_email_worker):
+    poll = make_poll()
+    payload = {**VOTER_PAYLOAD, "emails": ["a@example.com", "b@example.com"]}
+    assert client.post(f"/emails/send_to_voters/{poll['id']}", params={"oid": poll["owner_id"]}, json=payload).status_code == 200
+    assert client.post("/emails/send_contact_form", json={"name": "T", "email": "t@example.com", "message": "Hi"}).status_code == 200
+    # nothing is sent by the web app
+    assert postmark.requests == []
+    # the invitations, the contact form message (to three admins) and the
+    # notification of the poll's creation (to two admins)
+    assert mongo_outbox().count_documents({"status": "pending"}) == 7
+    assert run_email_worker() == 7
+    assert [path for path, _, _ in postmark.requests] == ["/email/batch"]
+    _, token, batch = postmark.requests[0]
+    assert token == "test-token"
+    assert {"a@example.com", "b@example.com"} <= {m["To"] for m in batch}
+    assert mongo_outbox().count_documents({"status": "sent"}) == 7
+    assert run_email_worker() == 0
+
+
+def test_invitations_sent_in_one_batch(make_poll, postmark, run_email_worker):
+    emails = [f"v{i}@example.com" for i in range(20)]
+    poll = make_poll(is_private=True, voter_emails=emails)
+    vids = mongo().find_one()["voter_ids"]
+    run_email_worker()
+    batches = [p for path, _, p in postmark.requests if path == "/email/batch"]
+    assert len(batches) == 1
+    invitations = {m["To"]: m for m in batches[0] if m["Tag"] == "voter-invitation"}
+    assert sorted(invitations) == sorted(emails)
+    for email, vid in zip(emails, vids):
+        assert f"/vote/{poll['id']}?vid={vid}" in invitations[email]["HtmlBody"]
+
+
+def test_worker_retries_failed_batch(make_poll, postmark, run_email_worker):
+    make_poll(is_private=True, voter_emails=["a@example.com", "inactive@example.com"])
+    postmark.unavailable = True
+    assert run_email_worker() == 4
+    assert mongo_outbox().count_documents({"status": "pending", "attempts": 1}) == 4
+    # the messages wait for their backoff
+    assert run_email_worker() == 0
+    mongo_outbox().update_many({}, {"$set": {"next_attempt": datetime.now(timezone.utc)}})
+    postmark.unavailable = False
+    assert run_email_worker() == 4
+    assert mongo_outbox().count_documents({"status": "sent"}) == 3
+    # a rejected message is not retried
+    failed = mongo_outbox().find_one({"status": "failed"})
+    assert failed["message"]["To"] == "inactive@example.com"
@@ -0,0 +1,44 @@
+#
+# Tests of the compute service (polls/compute.py). The computations run in
+# worker processes, so they are module-level functions of this module.
+#
+
+import asyncio
+import time
+
+import pytest
+
+from polls.compute import ComputePool, ComputeTimeout
+
+pytestmark = pytest.mark.no_db
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def fail():
+    raise ValueError("failed")
+
+
+def test_timeout_stops_only_its_own_computation():
+    async def run():
+        pool = ComputePool(2)
+        await pool.start()
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                pool.run(sleep, 1.5, timeout=3), pool.run(sleep, 30, timeout=0.5),
+                return_exceptions=True)
+            assert results[0] == 1.5 and isinstance(results[1], ComputeTimeout)
+            assert time.perf_counter() - start < 3
+            # the deadline starts when a computation runs, not while it waits
+            assert await asyncio.gather(*[pool.run(sleep, 0.4, timeout=0.8) for _ in range(4)]) == [0.4] * 4
+            with pytest.raises(ValueError):
+                await pool.run(fail)
+            assert len(pool._live) <= 2
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
@@ -2,6 +2,9 @@
 # API tests for poll creation, information, update, and deletion.
 #
 
+import subprocess
+import sys
+
 
 def test_create_poll_returns_id_and_owner_id(make_poll):
     data = make_poll()
@@ -73,3 +76,11 @@ def test_private_poll_creates_voter_ids(client, make_poll):
     info = client.get(f"/polls/data/{data['id']}", params={"oid": data["owner_id"]}).json()
     assert info["is_private"] is True
     assert info["num_invited_voters"] == 2
+
+
+def test_app_starts_without_heavy_libraries():
+    """The voting and graph libraries are imported on first use, not at startup."""
+    code = ("import sys, main; "
+            "print([m for m in sys.modules if m.split('.')[0] in ('pref_voting', 'networkx', 'numpy', 'qrcode')])")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
@@ -0,0 +1,105 @@
+#
+# Tests of the voting computations (the Stable Voting engine, the majority
+# relations, the fast-path outcomes and the ranking tiers) against the reference
+# implementations, on random profiles. They do not use the database.
+#
+
+import json
+import random
+
+import pytest
+
+pytestmark = pytest.mark.no_db
+
+
+def random_ballots(seed, num_profiles, min_cands=1, max_cands=6):
+    """num_profiles random (candidates, ballots) pairs, where a ballot is a ranking
+    (possibly truncated and with ties) and a count."""
+    rng = random.Random(seed)
+    for _ in range(num_profiles):
+        cands = [f"c{i}" for i in range(rng.randint(min_cands, max_cands))]
+        ballots = []
+        for _ in range(rng.randint(1, 7)):
+            ranked = rng.sample(cands, rng.randint(1, len(cands)))
+            ballots.append({"ranking": {c: rng.randint(1, len(ranked)) for c in ranked},
+                            "count": rng.randint(1, 3)})
+        yield cands, ballots
+
+
+def profile(ballots):
+    from pref_voting.profiles_with_ties import ProfileWithTies
+    return ProfileWithTies([b["ranking"] for b in ballots], rcounts=[b["count"] for b in ballots])
+
+
+def test_engine_matches_recursive_stable_voting():
+    from polls.voting import stable_voting_with_explanations_
+    from polls.sv_engine import stable_voting_with_explanations
+
+    for _, ballots in random_ballots(0, 100, min_cands=2):
+        prof = profile(ballots)
+        ws, _, explanations = stable_voting_with_explanations_(prof, None, {}, {})
+        engine_ws, engine_explanations = stable_voting_with_explanations(prof)
+        assert engine_ws == ws
+        assert json.dumps(engine_explanations) == json.dumps(explanations)
+
+
+def test_majority_relations_match_pref_voting():
+    from polls.voting import margin_matrix, majority_relations
+
+    for _, ballots in random_ballots(1, 100):
+        prof = profile(ballots)
+        order, margins = margin_matrix(prof)
+        relations = majority_relations(margins)
+        cw = relations["condorcet_winner"]
+        assert (order[cw] if cw is not None else None) == prof.condorcet_winner()
+        cl = relations["condorcet_loser"]
+        assert (order[cl] if cl is not None else None) == prof.condorcet_loser()
+        assert sorted(order[c] for c in relations["weak_condorcet_winners"]) == sorted(prof.weak_condorcet_winner() or [])
+        # the majority graph has a cycle iff some candidate reaches itself
+        n = len(order)
+        reach = [[margins[a][b] > 0 for b in range(n)] for a in range(n)]
+        for k in range(n):
+            reach = [[reach[a][b] or (reach[a][k] and reach[k][b]) for b in range(n)] for a in range(n)]
+        assert relations["cycle"] == any(reach[a][a] for a in range(n))
+
+
+def test_ranking_tiers_share_one_engine():
+    from pref_voting.profiles_with_ties import ProfileWithTies
+    from polls.outcome import tally_ranking_tiers, tier_payload
+    from polls.sv_engine import StableVotingEngine
+    from polls.tally import tally_from_ballots, tally_profile
+
+    for cands, ballots in random_ballots(2, 50):
+        tally = tally_from_ballots(ballots, cands)
+        prof = tally_profile(tally)
+        tiers = tally_ranking_tiers(tally, len(cands) + 1)
+        assert sorted(w for t in tiers for w in t["sv_winners"]) == sorted(prof.candidates)
+        # each tier is what a fresh engine computes for the profile restricted to
+        # the candidates left
+        remaining = sorted(prof.candidates)
+        for tier in tiers:
+            rankings, rcounts = prof.rankings_counts
+            restricted = ProfileWithTies(
+                [{c: r for c, r in b.rmap.items() if c in remaining} for b in rankings],
+                rcounts=rcounts, candidates=remaining)
+            fresh = tier_payload(StableVotingEngine.from_profile(restricted), None)
+            assert json.dumps({**fresh, "rank": tier["rank"]}, sort_keys=True) == json.dumps(tier, sort_keys=True)
+            remaining = [c for c in remaining if c not in tier["sv_winners"]]
+
+
+def test_fast_outcome_matches_engine():
+    from polls.outcome import fast_outcome, _engine_outcome
+    from polls.sv_engine import StableVotingEngine
+    from polls.tally import tally_from_ballots, tally_margin_matrix
+
+    decided = 0
+    for cands, ballots in random_ballots(3, 200):
+        engine = StableVotingEngine(*tally_margin_matrix(tally_from_ballots(ballots, cands)))
+        fast = fast_outcome(*engine.submatrix())
+        if fast is None:
+            assert len(engine.candidates) > 2 and _engine_outcome(engine)["condorcet_winner"] is None
+            continue
+        decided += 1
+        # the same payload, with the explanations in the same order
+        assert json.dumps(fast) == json.dumps(_engine_outcome(engine))
+    assert decided > 100
@@ -3,7 +3,11 @@
 # tests for the ported bug fixes.
 #
 
-from tests.conftest import mongo
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from tests.conftest import mongo, mongo_ballots, mongo_leases
 
 PAST = "2020-01-01T00:00:00+00:00"
 
@@ -46,7 +50,10 @@ def test_condorcet_cycle(make_poll, vote, get_outcome):
     outcome = get_outcome(poll["id"], oid=poll["owner_id"]).json()
     assert outcome["condorcet_winner"] is None
     assert winners(outcome) == ["A"]
-    assert outcome["splitting_numbers"] != {}
+    assert outcome["splitting_numbers"] == {"0,1,2": 1}
+    assert outcome["sc_winners"] == ["0"]
+    assert outcome["defeats"]["0"] == {"0": False, "1": True, "2": False}
+    assert outcome["defeats"]["2"]["0"] is False
 
 
 def test_demo_outcome(client):
@@ -127,6 +134,29 @@ def test_regression_tiebreak_winner_stable(client, make_poll, vote, get_outcome)
     assert selected[0] is not None and all(s == selected[0] for s in selected)
 
 
+def test_closed_poll_result_saved_once(client, make_poll, vote, get_outcome):
+    poll = make_poll(candidates=["A", "B"])
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"B": 1, "A": 2})
+    close_poll(client, poll)
+    # a result saved by another process first is kept, with its tie-break
+    saved = {**get_outcome(poll["id"], oid=poll["owner_id"]).json(), "selected_sv_winner": "1"}
+    mongo().update_one({}, {"$set": {"result": saved, "is_completed": False}})
+    assert get_outcome(poll["id"], oid=poll["owner_id"]).json()["selected_sv_winner"] == "1"
+    assert mongo().find_one()["result"]["selected_sv_winner"] == "1"
+
+
+def test_closed_poll_not_finalized_by_non_viewer(client, make_poll, vote, get_outcome):
+    poll = make_poll(show_outcome=False)
+    vote(poll["id"], {"A": 1, "B": 2})
+    close_poll(client, poll)
+    outcome = get_outcome(poll["id"]).json()
+    assert outcome["can_view"] is False and outcome["sv_winners"] == []
+    assert mongo().find_one()["result"] is None
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["A"]
+    assert get_outcome(poll["id"]).json()["sv_winners"] == []
+
+
 def test_regression_no_voting_after_close(client, make_poll, vote):
     poll = make_poll()
     close_poll(client, poll)
@@ -173,6 +203,308 @@ def test_submitted_rankings_zero_ballots(client, make_poll):
     assert resp.json()["num_voters"] == 0
 
 
+def test_submitted_rankings_grouped(client, make_poll, vote):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"C": 1})
+    vote(poll["id"], {})
+    data = client.get(f"/polls/submitted_rankings/{poll['id']}", params={"oid": poll["owner_id"]}).json()
+    assert data["num_voters"] == 4
+    assert data["num_empty_ballots"] == 1
+    assert data["unranked_candidates"] == []
+    assert sorted(col[0] for col in data["columns"]) == ["1", "1", "2"]
+
+
+def test_export_rankings_csv(client, make_poll, vote):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"A": 1, "B": 3})
+    vote(poll["id"], {"C": 1})
+    resp = client.get(f"/polls/export/{poll['id']}.csv", params={"oid": poll["owner_id"]})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+    assert resp.text.splitlines() == ["A,B,C,", "1,2,,2", ",,1,1"]
+    assert client.get(f"/polls/export/{poll['id']}.csv", params={"oid": "wrong"}).status_code == 403
+
+
 def test_submitted_rankings_requires_owner(client, make_poll):
     poll = make_poll()
     assert client.get(f"/polls/submitted_rankings/{poll['id']}", params={"oid": "wrong"}).status_code == 403
+
+
+# --- pairwise tally ---
+
+
+def test_tally_follows_ballot_writes(client, make_poll, vote, get_outcome):
+    poll = make_poll(is_private=True, voter_emails=["a@example.com", "b@example.com"])
+    vid1, vid2 = mongo().find_one()["voter_ids"]
+    vote(poll["id"], {"A": 1, "B": 2, "C": 3}, vid=vid1)
+    vote(poll["id"], {"B": 1, "A": 2}, vid=vid2)
+    vote(poll["id"], {"C": 1, "A": 2, "B": 3}, vid=vid1)  # replaces vid1's ballot
+    tally = mongo().find_one()["tally"]
+    assert tally["num_ballots"] == 2
+    assert tally["types"] == {"1,2,3": 0, "2,1,_": 1, "2,3,1": 1}
+    outcome = get_outcome(poll["id"], oid=poll["owner_id"]).json()
+    assert outcome["margins"]["0"]["1"] == 0
+    assert outcome["margins"]["2"]["0"] == 1
+
+    client.request("DELETE", f"/polls/delete_ballot/{poll['id']}", params={"vid": vid2})
+    client.request("DELETE", f"/polls/voters/{poll['id']}/{vid1}", params={"oid": poll["owner_id"]})
+    tally = mongo().find_one()["tally"]
+    assert tally["num_ballots"] == 0
+    assert all(v == 0 for row in tally["support"] for v in row)
+
+
+def test_tally_built_for_polls_without_one(make_poll, vote, get_outcome):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"B": 1, "A": 2, "C": 3})
+    mongo().update_one({}, {"$unset": {"tally": ""}})
+    outcome = get_outcome(poll["id"], oid=poll["owner_id"]).json()
+    assert outcome["margins"]["1"]["2"] == 1
+    assert mongo().find_one()["tally"]["num_ballots"] == 2
+
+
+# --- ballot storage ---
+
+
+def test_ballots_stored_in_their_own_collection(client, make_poll, vote):
+    poll = make_poll(is_private=True, voter_emails=["a@example.com"])
+    vid = mongo().find_one()["voter_ids"][0]
+    vote(poll["id"], {"A": 1, "B": 2}, vid=vid)
+    vote(poll["id"], {"B": 1}, vid=vid)
+    doc = mongo().find_one()
+    assert "ballots" not in doc
+    stored = list(mongo_ballots().find())
+    assert len(stored) == 1
+    assert stored[0]["voter_id"] == vid and stored[0]["ranking"] == {"B": 1}
+
+
+def test_tally_rebuilt_from_ballots(client, make_poll, vote):
+    from polls.storage import rebuild_tally
+
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"B": 1})
+    expected = mongo().find_one()["tally"]
+    # a tally left behind, e.g., by a crash between a ballot write and its tally update
+    mongo().update_one({}, {"$inc": {"tally.num_ballots": -1, "tally.ranked.1": -1}})
+    client.portal.call(rebuild_tally, {"_id": ObjectId(poll["id"])})
+    doc = mongo().find_one()
+    assert doc["tally"] == expected and doc["ballot_version"] == 3
+
+
+def test_embedded_ballots_still_supported(client, make_poll, vote, get_outcome):
+    poll = make_poll()
+    mongo().update_one({}, {
+        "$unset": {"ballot_storage": "", "tally": ""},
+        "$set": {"ballots": [{"ranking": {"A": 1, "B": 2}, "voter_id": None, "submission_date": None, "ip": "x"}]}})
+    vote(poll["id"], {"A": 1, "C": 2})
+    info = client.get(f"/polls/data/{poll['id']}", params={"oid": poll["owner_id"]}).json()
+    assert info["num_ballots"] == 2
+    assert len(mongo().find_one()["ballots"]) == 2
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["A"]
+
+
+def test_ballot_read_before_migration_goes_to_collection(client, make_poll):
+    from polls.storage import add_ballot, migrate_to_collection, iter_ballots
+
+    poll = make_poll()
+    ballot = {"ranking": {"A": 1}, "voter_id": None, "submission_date": None, "ip": "x"}
+    mongo().update_one({}, {"$unset": {"ballot_storage": "", "tally": ""}, "$set": {"ballots": [ballot]}})
+    # a request that read the poll before its ballots were moved to the collection
+    stale = mongo().find_one()
+    assert client.portal.call(migrate_to_collection, poll["id"]) == 1
+    new = {"ranking": {"B": 1}, "voter_id": None, "submission_date": None, "ip": "y"}
+    assert client.portal.call(add_ballot, stale, new, "y")
+
+    async def ballots():
+        return [b async for b in iter_ballots({"_id": ObjectId(poll["id"]), "ballot_storage": "collection"})]
+
+    doc = mongo().find_one()
+    assert "ballots" not in doc and doc["tally"]["num_ballots"] == 2
+    assert sorted(b["ip"] for b in client.portal.call(ballots)) == ["x", "y"]
+
+
+def test_ballots_counted_without_fetching_them(client, make_poll):
+    poll = make_poll()
+    ballot = {"ranking": {"A": 1}, "voter_id": None, "submission_date": None, "ip": "x"}
+    mongo().update_one({}, {
+        "$unset": {"ballot_storage": "", "tally": ""},
+        "$set": {"ballots": [ballot] * 3}})
+    info = client.get(f"/polls/data/{poll['id']}", params={"oid": poll["owner_id"]}).json()
+    assert info["num_ballots"] == 3
+    assert "tally" not in mongo().find_one()
+
+
+# --- outcome cache ---
+
+
+def test_outcome_cached_by_ballot_version(make_poll, vote, get_outcome):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    vote(poll["id"], {"A": 1, "B": 2})
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["A"]
+    doc = mongo().find_one()
+    assert doc["ballot_version"] == 2
+    assert doc["outcome_cache"]["version"] == 2
+    assert doc["result"] is None
+    # a stale cached outcome is never served once the ballots change
+    for _ in range(3):
+        vote(poll["id"], {"B": 1, "A": 2})
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["B"]
+    assert mongo().find_one()["outcome_cache"]["version"] == 5
+
+
+def test_reopened_poll_result_recomputed(client, make_poll, vote, get_outcome):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    close_poll(client, poll)
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["A"]
+    assert mongo().find_one()["result"] is not None
+    client.post(f"/polls/update/{poll['id']}", params={"oid": poll["owner_id"]},
+                json={"closing_datetime": "del", "is_completed": False})
+    assert mongo().find_one()["result"] is None
+    for _ in range(2):
+        vote(poll["id"], {"B": 1, "A": 2})
+    assert winners(get_outcome(poll["id"], oid=poll["owner_id"]).json()) == ["B"]
+
+
+def test_ranking_cached_then_saved_when_closed(client, make_poll, vote):
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2, "C": 3})
+    vote(poll["id"], {"B": 1, "A": 2, "C": 3})
+    vote(poll["id"], {"A": 1, "C": 2, "B": 3})
+
+    def ranking():
+        resp = client.get(f"/polls/ranking/{poll['id']}", params={"oid": poll["owner_id"]})
+        assert resp.status_code == 200
+        return [(t["rank"], t["sv_winners"]) for t in resp.json()["tiers"]]
+
+    assert ranking() == [(1, ["0"]), (2, ["1"]), (3, ["2"])]
+    doc = mongo().find_one()
+    assert doc["ranking_cache"]["version"] == 3 and "ranking" not in doc
+    vote(poll["id"], {"B": 1, "C": 2, "A": 3})
+    vote(poll["id"], {"B": 1, "C": 2, "A": 3})
+    assert ranking() == [(1, ["1"]), (2, ["0"]), (3, ["2"])]
+    assert mongo().find_one()["ranking_cache"]["version"] == 5
+
+    close_poll(client, poll)
+    assert ranking() == [(1, ["1"]), (2, ["0"]), (3, ["2"])]
+    assert len(mongo().find_one()["ranking"]) == 3
+    # the saved ranking is served as is, without the tally
+    mongo().update_one({}, {"$set": {"ranking.0.sv_winners": ["2"]}})
+    assert ranking()[0] == (1, ["2"])
+    # reopening the poll discards it
+    client.post(f"/polls/update/{poll['id']}", params={"oid": poll["owner_id"]},
+                json={"closing_datetime": "del", "is_completed": False})
+    assert mongo().find_one()["ranking"] is None
+    assert ranking()[0] == (1, ["1"])
+
+
+def test_scheduler_finalizes_closed_polls(client, make_poll, vote, get_outcome):
+    from polls.scheduler import finalize_due_polls
+
+    closed, still_open, no_closing = make_poll(), make_poll(), make_poll()
+    for poll in (closed, still_open, no_closing):
+        vote(poll["id"], {"A": 1, "B": 2})
+    close_poll(client, closed)
+    future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    close_poll(client, still_open, closing_datetime=future)
+
+    assert client.portal.call(finalize_due_polls) == 1
+    docs = {str(d["_id"]): d for d in mongo().find()}
+    assert docs[closed["id"]]["is_completed"] is True
+    assert docs[closed["id"]]["result"]["sv_winners"] == ["0"]
+    # the ranking is saved with the result
+    assert [t["sv_winners"] for t in docs[closed["id"]]["ranking"]] == [["0"], ["1"]]
+    assert docs[still_open["id"]]["result"] is None and docs[no_closing["id"]]["result"] is None
+    # the outcome page serves the saved result, and there is nothing left to finalize
+    assert winners(get_outcome(closed["id"], oid=closed["owner_id"]).json()) == ["A"]
+    assert client.portal.call(finalize_due_polls) == 0
+
+
+def test_scheduler_backs_off_polls_that_time_out(client, make_poll, vote, monkeypatch):
+    from polls import compute, scheduler
+
+    poll = make_poll()
+    vote(poll["id"], {"A": 1, "B": 2})
+    close_poll(client, poll)
+    calls = []
+
+    async def timed_out(fn, *args, timeout=None):
+        calls.append(fn.__name__)
+        raise compute.ComputeTimeout(f"{fn.__name__} did not finish within {timeout} seconds.")
+
+    monkeypatch.setattr(compute, "run", timed_out)
+    monkeypatch.setattr(scheduler, "FINALIZE_MAX_ATTEMPTS", 2)
+    assert client.portal.call(scheduler.finalize_due_polls) == 0
+    doc = mongo().find_one()
+    assert doc["result"] is None and doc["finalize_attempts"] == 1
+    num_calls = len(calls)
+    # the next tick leaves the poll alone until its backoff is over
+    assert client.portal.call(scheduler.finalize_due_polls) == 0
+    assert len(calls) == num_calls
+    mongo().update_one({}, {"$set": {"finalize_after": datetime(2020, 1, 1)}})
+    assert client.portal.call(scheduler.finalize_due_polls) == 0
+    assert len(calls) > num_calls and mongo().find_one()["finalize_attempts"] == 2
+    # and after its last attempt the poll is not tried again
+    num_calls = len(calls)
+    mongo().update_one({}, {"$set": {"finalize_after": datetime(2020, 1, 1)}})
+    assert client.portal.call(scheduler.finalize_due_polls) == 0
+    assert len(calls) == num_calls
+
+
+def test_superuser_stats_from_poll_records(client, make_poll, vote, monkeypatch):
+    monkeypatch.setenv("SUPERUSER_PWD", "su")
+    poll = make_poll()
+    for ranking in [{"A": 1, "B": 2}, {"A": 1, "C": 2}, {"B": 1}, {"C": 1, "A": 2}, {"A": 1}]:
+        vote(poll["id"], ranking)
+    make_poll()
+
+    def stats(refresh=False):
+        # a refresh computes the stats in a background task, which the test client
+        # runs before returning, so the next request gets the fresh stats
+        client.get("/polls/superuser/stats", params={"pwd": "su", "refresh": refresh})
+        return client.get("/polls/superuser/stats", params={"pwd": "su"}).json()
+
+    data = stats(refresh=True)
+    assert (data["total"], data["withb"], data["total_votes"], data["restricted"]) == (2, 1, 5, 1)
+    assert data["cond"]["base"] == 1 and data["sv"]["base"] == 1
+    # each poll's record is saved with the ballot version it was computed for
+    doc = mongo().find_one({"_id": ObjectId(poll["id"])})
+    assert doc["analytics"]["version"] == doc["ballot_version"] == 5
+    assert doc["analytics"]["record"]["nb"] == 5
+
+    vote(poll["id"], {"B": 1, "A": 2})
+    assert stats(refresh=True)["total_votes"] == 6
+
+
+def test_superuser_stats_full_recompute(client, make_poll, vote, monkeypatch):
+    monkeypatch.setenv("SUPERUSER_PWD", "su")
+    for _ in range(3):
+        poll = make_poll()
+        vote(poll["id"], {"A": 1, "B": 2})
+    client.get("/polls/superuser/stats", params={"pwd": "su", "refresh": True})
+    mongo().update_many({}, {"$set": {"analytics.record.nb": 0}})
+    client.get("/polls/superuser/stats", params={"pwd": "su", "full": True})
+    data = client.get("/polls/superuser/stats", params={"pwd": "su"}).json()
+    assert (data["total"], data["withb"], data["total_votes"]) == (3, 3, 3)
+
+
+def test_superuser_stats_single_flight(client, make_poll, vote, monkeypatch):
+    monkeypatch.setenv("SUPERUSER_PWD", "su")
+    poll = make_poll()
+    vote(poll["id"], {"A": 1})
+    # another process holds the lease: this one keeps serving the (missing) cache
+    expires = datetime.now(timezone.utc) + timedelta(minutes=1)
+    mongo_leases().insert_one({"_id": "superuser_stats", "owner": "other", "expires_at": expires})
+    client.get("/polls/superuser/stats", params={"pwd": "su", "refresh": True})
+    assert client.get("/polls/superuser/stats", params={"pwd": "su"}).json()["computing"] is True
+    assert "analytics" not in mongo().find_one()
+    # once the lease expires, the next refresh takes it over and releases it
+    mongo_leases().update_one({}, {"$set": {"expires_at": datetime.now(timezone.utc)}})
+    client.get("/polls/superuser/stats", params={"pwd": "su", "refresh": True})
+    assert client.get("/polls/superuser/stats", params={"pwd": "su"}).json()["total_votes"] == 1
+    assert mongo_leases().count_documents({}) == 0